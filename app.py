@@ -2,11 +2,12 @@ import os
 import logging
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, abort, session
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask import send_from_directory
-from celery_config import create_celery_app
-from models import db, HealthRecord, Report, User, ReportTemplate, TaskMonitor, TaskLog
+from celery_config import create_celery_app, BROKER_URL, RESULT_BACKEND
+from models import db, HealthRecord, Report, User, ReportTemplate, TaskLog, RecordStatus
 from celery import chain
-from tasks import process_pdfs, create_report, process_record, regenerate_report_task, generate_single_report, extract_medical_codes, parse_medical_codes_xml, save_medical_codes, update_medical_codes_descriptions
+from tasks import process_pdfs, create_report, process_record, regenerate_report_task, generate_single_report, extract_medical_codes, coerce_medical_codes, save_medical_codes, update_medical_codes_descriptions
 from datetime import datetime, timedelta
 from flask_login import login_user, login_required, logout_user, LoginManager, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
@@ -15,6 +16,14 @@ from celery.result import AsyncResult
 from sqlalchemy.exc import IntegrityError
 import re
 from utils import count_tokens
+from report_cache import invalidate_text_years
+from reports import warm_template_schema, invalidate_system_pdf
+from scheduling import upload_priority
+from task_stats import kpi_summary
+from record_status import processing_state, running_tasks, task_page
+from usage import record_usage
+import metrics
+from ingestion import UPLOAD_FOLDER, ingest_upload, release_upload, max_request_bytes, UploadRejected
 from flask_mail import Mail, Message
 import secrets
 import string
@@ -47,10 +56,12 @@ app = Flask(__name__)
 
 # Konfiguration aus Azure Key Vault laden
 app.config['SECRET_KEY'] = get_config('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///health_records.db'
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['CELERY_BROKER_URL'] = 'redis://localhost:6380/0'
-app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6380/0'
+app.config['SQLALCHEMY_DATABASE_URI'] = get_config('DATABASE_URL', 'sqlite:///health_records.db')
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Zu große Requests werden von Werkzeug abgewiesen, bevor der Upload gelesen wird
+app.config['MAX_CONTENT_LENGTH'] = max_request_bytes()
+app.config['CELERY_BROKER_URL'] = BROKER_URL
+app.config['CELERY_RESULT_BACKEND'] = RESULT_BACKEND
 
 # Mail-Konfiguration aus Azure Key Vault
 app.config['MAIL_SERVER'] = get_config('MAIL_SERVER')
@@ -122,6 +133,30 @@ def index():
     return render_template('index.html', records=records, report_templates=report_templates, users=users, is_admin=(current_user.level == 'admin'))
 
 
+def ingest_uploads(files):
+    """
+    Legt alle PDFs eines Requests per Streaming inhaltsadressiert ab (siehe ingestion.py).
+    Wird eine Datei abgelehnt, werden die bereits abgelegten Dateien wieder freigegeben.
+    """
+    uploads = []
+    try:
+        for file in files:
+            if file and file.filename.endswith('.pdf'):
+                upload = ingest_upload(file, app.config['UPLOAD_FOLDER'])
+                uploads.append(upload)
+                logger.info(f"Saved file: {upload.path} ({upload.size} bytes, {upload.page_count} pages)")
+    except UploadRejected:
+        for upload in uploads:
+            release_upload(upload.path, app.config['UPLOAD_FOLDER'])
+        raise
+    return uploads
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({'error': f"Upload überschreitet {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB"}), 413
+
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -154,9 +189,6 @@ def upload_file():
         if not record:
             return jsonify({'error': 'Record not found'}), 404
         patient_name = record.patient_name
-        # Setze Status auf processing für bestehende Records
-        record.processing_status = 'processing'
-        db.session.commit()
         
     else:
         # Neuen Datensatz erstellen
@@ -167,17 +199,21 @@ def upload_file():
             return jsonify({'error': 'First name and last name are required'}), 400
         patient_name = f"{first_name} {last_name}"
 
-    for file in files:
-        if file and file.filename.endswith('.pdf'):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            filenames.append(filename)
-            logger.info(f"Saved file: {filename}")
+    try:
+        uploads = ingest_uploads(files)
+    except UploadRejected as e:
+        logger.warning(f"Upload rejected: {e}")
+        return jsonify({'error': str(e)}), e.status_code
+    filenames = [upload.path for upload in uploads]
 
     if filenames:
         logger.info(f"Starting process_pdfs task for files: {filenames}")
 
+        if record_id:
+            # Setze Status auf processing für bestehende Records
+            record.processing_status = 'processing'
+            db.session.commit()
+
         # Wenn es ein neuer Datensatz ist, erstelle ihn sofort
         if record_id is None:
             # Erstelle neuen HealthRecord sofort mit processing_status
@@ -195,14 +231,9 @@ def upload_file():
             logger.info(f"Created new HealthRecord with ID: {record_id}, status: processing")
 
         # Starte den process_pdfs Task und übergebe die user_id, custom_instructions und birth_date
-        result = process_pdfs.delay(
-            filenames, 
-            patient_name, 
-            record_id, 
-            create_reports, 
-            user_id,
-            custom_instructions,
-            birth_date
+        result = process_pdfs.apply_async(
+            args=[filenames, patient_name, record_id, create_reports, user_id, custom_instructions, birth_date],
+            priority=upload_priority(user_id, filenames, sum(upload.page_count for upload in uploads))
         )
 
         logger.info(f"Started process_pdfs task for patient: {patient_name}")
@@ -329,7 +360,8 @@ def get_record(record_id):
         'medical_history_end': record.medical_history_end.year if record.medical_history_end else None,
         'create_reports': record.create_reports,
         'custom_instructions': record.custom_instructions or 'Keine Custom Instructions definiert',
-        'token_count': record.token_count
+        'token_count': record.token_count,
+        'usage': record_usage(record.id)
     }), 200
 
 
@@ -487,121 +519,99 @@ def get_task_logs(record_id):
 def get_processing_status(record_id):
     """API-Endpoint zum Abrufen des aktuellen Verarbeitungsstatus eines Health Records"""
     try:
-        # Prüfe ob der Record dem aktuellen User gehört
-        health_record = HealthRecord.query.filter_by(id=record_id, user_id=current_user.id).first()
-        if not health_record:
+        # Ein Zugriff über den Primärschlüssel: Besitz prüfen und Projektion lesen (record_status.py)
+        row = db.session.query(HealthRecord.create_reports, RecordStatus).outerjoin(
+            RecordStatus, RecordStatus.health_record_id == HealthRecord.id
+        ).filter(HealthRecord.id == record_id, HealthRecord.user_id == current_user.id).first()
+        if not row:
             return jsonify({'error': 'Health record not found or access denied'}), 404
+        create_reports, status = row
         
-        # Hole die letzten Task-Logs (letzten 2 Stunden für bessere Status-Erkennung)
-        from datetime import datetime, timedelta
-        two_hours_ago = datetime.utcnow() - timedelta(hours=2)
+        current_status = processing_state(status, create_reports)
+        current_task = status.current_task if current_status == 'processing' else None
+        running = running_tasks(status)
+        succeeded = status.success_count if status else 0
+        failed = status.failed_count if status else 0
         
-        recent_logs = TaskLog.query.filter(
-            TaskLog.health_record_id == record_id,
-            TaskLog.started_at >= two_hours_ago
-        ).order_by(TaskLog.started_at.asc()).all()  # Chronologische Reihenfolge
-        
-        # Prüfe auf laufende Tasks
-        running_tasks = [log for log in recent_logs if log.status == 'started']
-        completed_tasks = [log for log in recent_logs if log.status in ['success', 'failed']]
-        failed_tasks = [log for log in recent_logs if log.status == 'failed']
+        last_error = None
+        if status and status.last_error_task:
+            last_error = {
+                'task_name': status.last_error_task,
+                'display_name': get_task_display_name(status.last_error_task),
+                'error_type': status.last_error_type,
+                'error_message': status.last_error_message,
+                'failed_at': status.last_error_at.isoformat() if status.last_error_at else None
+            }
         
-        # Bestimme aktuellen Status
-        if running_tasks:
-            current_status = 'processing'
-            current_task = running_tasks[0].task_name
-        else:
-            # Prüfe ob eine vollständige Verarbeitung stattgefunden hat
-            # Ein Record gilt als vollständig verarbeitet wenn:
-            # 1. Keine laufenden Tasks
-            # 2. Mindestens ein erfolgreiches process_pdfs UND combine_extractions
-            # 3. Wenn create_reports aktiviert: auch create_report erfolgreich
-            successful_logs = [log for log in recent_logs if log.status == 'success']
-            core_tasks_completed = any(log.task_name == 'process_pdfs' for log in successful_logs) and \
-                                  any(log.task_name == 'combine_extractions' for log in successful_logs)
-            
-            # Prüfe ob Reports erstellt werden sollten
-            reports_needed = health_record.create_reports
-            reports_completed = any(log.task_name == 'create_report' for log in successful_logs) if reports_needed else True
-            
-            if core_tasks_completed and reports_completed and not failed_tasks:
-                current_status = 'completed'
-                logger.info(f"Record {record_id} marked as COMPLETED: core_tasks={core_tasks_completed}, reports_completed={reports_completed}, failed_tasks={len(failed_tasks)}")
-            elif failed_tasks and not running_tasks:
-                current_status = 'failed'
-                logger.info(f"Record {record_id} marked as FAILED: failed_tasks={len(failed_tasks)}, running_tasks={len(running_tasks)}")
-            else:
-                current_status = 'idle'
-                logger.info(f"Record {record_id} marked as IDLE: core_tasks={core_tasks_completed}, reports_needed={reports_needed}, reports_completed={reports_completed}, failed_tasks={len(failed_tasks)}")
-                
-            # Debug: Liste alle erfolgreichen Tasks auf
-            successful_task_names = [log.task_name for log in successful_logs]
-            logger.info(f"Record {record_id} successful tasks: {successful_task_names}")
-            
-            current_task = None
+        # Die einzelnen Tasks liefert /get_processing_tasks seitenweise (nur bei geänderter version laden)
+        return jsonify({
+            'record_id': record_id,
+            'status': current_status,
+            'version': status.version if status else 0,
+            'run_started_at': status.run_started_at.isoformat() if status else None,
+            'updated_at': status.updated_at.isoformat() if status else None,
+            'current_task': current_task,
+            'current_task_display': get_task_display_name(current_task) if current_task else None,
+            'total_tasks': running + succeeded + failed,
+            'completed_tasks': succeeded,
+            'running_tasks': running,
+            'failed_tasks': failed,
+            'last_error': last_error,
+            'tasks_url': url_for('get_processing_tasks', record_id=record_id)
+        })
         
-        # Sammle ALLE Tasks für Display (nicht nur bekannte)
-        task_progress = []
+    except Exception as e:
+        logger.error(f"Error getting processing status for record {record_id}: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/get_processing_tasks/<int:record_id>')
+@login_required
+def get_processing_tasks(record_id):
+    """API-Endpoint für die Tasks des aktuellen Verarbeitungslaufs, seitenweise (page, per_page)"""
+    try:
+        row = db.session.query(HealthRecord.id, RecordStatus.run_started_at).outerjoin(
+            RecordStatus, RecordStatus.health_record_id == HealthRecord.id
+        ).filter(HealthRecord.id == record_id, HealthRecord.user_id == current_user.id).first()
+        if not row:
+            return jsonify({'error': 'Health record not found or access denied'}), 404
         
-        # Erstelle Task-Map für bessere Performance
-        task_map = {}
-        for log in recent_logs:
-            task_key = f"{log.task_name}_{log.task_id}"
-            if task_key not in task_map:
-                task_map[task_key] = []
-            task_map[task_key].append(log)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+        # Ohne Projektion (noch nicht migriert) wie bisher die letzten zwei Stunden
+        since = row.run_started_at or datetime.utcnow() - timedelta(hours=2)
+        total, logs = task_page(record_id, since, page, per_page)
         
-        # Verarbeite alle gefundenen Tasks
-        for task_key, task_logs in task_map.items():
-            # Neuester Log für diesen Task
-            latest_log = max(task_logs, key=lambda x: x.started_at)
-            
-            status = latest_log.status
-            if status == 'started':
-                task_status = 'running'
-            elif status == 'success':
-                task_status = 'completed'
-            elif status == 'failed':
-                task_status = 'failed'
-            else:
-                task_status = 'pending'
-            
-            # Berechne Dauer falls verfügbar
+        status_map = {'started': 'running', 'success': 'completed', 'failed': 'failed'}
+        tasks = []
+        for log in logs:
             duration = None
-            if latest_log.duration_seconds:
-                duration = round(latest_log.duration_seconds, 2)
-            elif latest_log.started_at and latest_log.completed_at:
-                duration = (latest_log.completed_at - latest_log.started_at).total_seconds()
-                duration = round(duration, 2)
+            if log.duration_seconds:
+                duration = round(log.duration_seconds, 2)
+            elif log.started_at and log.completed_at:
+                duration = round((log.completed_at - log.started_at).total_seconds(), 2)
             
-            task_progress.append({
-                'name': latest_log.task_name,
-                'task_id': latest_log.task_id,
-                'display_name': get_task_display_name(latest_log.task_name),
-                'status': task_status,
-                'started_at': latest_log.started_at.isoformat() if latest_log.started_at else None,
-                'completed_at': latest_log.completed_at.isoformat() if latest_log.completed_at else None,
+            tasks.append({
+                'name': log.task_name,
+                'task_id': log.task_id,
+                'display_name': get_task_display_name(log.task_name),
+                'status': status_map.get(log.status, 'pending'),
+                'started_at': log.started_at.isoformat() if log.started_at else None,
+                'completed_at': log.completed_at.isoformat() if log.completed_at else None,
                 'duration': duration,
-                'retry_count': latest_log.retry_count or 0
+                'retry_count': log.retry_count or 0
             })
         
-        # Sortiere Tasks chronologisch
-        task_progress.sort(key=lambda x: x['started_at'] or '')
-        
         return jsonify({
             'record_id': record_id,
-            'status': current_status,
-            'current_task': current_task,
-            'current_task_display': get_task_display_name(current_task) if current_task else None,
-            'task_progress': task_progress,
-            'total_tasks': len(task_progress),
-            'completed_tasks': len([t for t in task_progress if t['status'] == 'completed']),
-            'running_tasks': len([t for t in task_progress if t['status'] == 'running']),
-            'failed_tasks': len([t for t in task_progress if t['status'] == 'failed'])
+            'since': since.isoformat(),
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'task_progress': tasks
         })
         
     except Exception as e:
-        logger.error(f"Error getting processing status for record {record_id}: {e}")
+        logger.error(f"Error getting processing tasks for record {record_id}: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/debug_processing_status/<int:record_id>')
@@ -962,6 +972,8 @@ def update_template():
         template.last_updated = datetime.utcnow()
         
         db.session.commit()
+        # Schema einmalig beim Speichern kompilieren statt bei jedem Gemini-Aufruf
+        warm_template_schema(template.output_format, template.example_structure)
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
@@ -1058,6 +1070,8 @@ def create_template():
         )
         db.session.add(template)
         db.session.commit()
+        # Schema einmalig beim Speichern kompilieren statt bei jedem Gemini-Aufruf
+        warm_template_schema(template.output_format, template.example_structure)
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
@@ -1068,36 +1082,20 @@ def create_template():
 @app.route('/kpi')
 @login_required
 def kpi():
-    from sqlalchemy import func
-    # Berechnungen für create_reports = True
-    tasks_with_reports = TaskMonitor.query.join(HealthRecord).filter(HealthRecord.create_reports == True, TaskMonitor.end_date != None).all()
-    total_tokens_reports = 0
-    total_time_reports = 0
-    for task in tasks_with_reports:
-        if task.health_record.token_count and task.start_date and task.end_date:
-            duration = (task.end_date - task.start_date).total_seconds()
-            total_tokens_reports += task.health_record.token_count
-            total_time_reports += duration
-    if total_time_reports > 0:
-        tps_reports = total_tokens_reports / total_time_reports
-    else:
-        tps_reports = 0
-
-    # Berechnungen für create_reports = False
-    tasks_without_reports = TaskMonitor.query.join(HealthRecord).filter(HealthRecord.create_reports == False, TaskMonitor.end_date != None).all()
-    total_tokens_no_reports = 0
-    total_time_no_reports = 0
-    for task in tasks_without_reports:
-        if task.health_record.token_count and task.start_date and task.end_date:
-            duration = (task.end_date - task.start_date).total_seconds()
-            total_tokens_no_reports += task.health_record.token_count
-            total_time_no_reports += duration
-    if total_time_no_reports > 0:
-        tps_no_reports = total_tokens_no_reports / total_time_no_reports
-    else:
-        tps_no_reports = 0
-
-    return render_template('kpi.html', tps_reports=tps_reports, tps_no_reports=tps_no_reports)
+    # Kennzahlen kommen aus den Rollup-Tabellen bzw. SQL-Aggregaten (siehe task_stats.py)
+    summary = kpi_summary(request.args.get('days', type=int))
+    return render_template('kpi.html', tps_reports=summary['tps_reports'], tps_no_reports=summary['tps_no_reports'], summary=summary)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus-Scrape ohne Login; optional per Bearer-Token (METRICS_TOKEN) geschützt
+    if not metrics.enabled():
+        abort(404)
+    token = get_config("METRICS_TOKEN", "")
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(401)
+    body, content_type = metrics.render_latest()
+    return app.response_class(body, content_type=content_type)
 
 @app.route('/generate_report/<int:record_id>/<int:template_id>', methods=['POST'])
 @login_required
@@ -1322,14 +1320,11 @@ def update_record(record_id):
         # Handle file upload if files are included
         if 'files[]' in request.files:
             files = request.files.getlist('files[]')
-            filenames = []
-            
-            for file in files:
-                if file and file.filename.endswith('.pdf'):
-                    filename = secure_filename(file.filename)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    filenames.append(filename)
+            try:
+                uploads = ingest_uploads(files)
+            except UploadRejected as e:
+                return jsonify({'success': False, 'error': str(e)}), e.status_code
+            filenames = [upload.path for upload in uploads]
 
             if filenames:
                 # Setze Status auf processing bevor der Task startet
@@ -1338,14 +1333,17 @@ def update_record(record_id):
                 
                 # Starte den process_pdfs Task für neue Dateien
                 # und übergebe dabei auch die aktualisierten Metadaten
-                result = process_pdfs.delay(
-                    filenames,
-                    record.patient_name,
-                    record.id,
-                    record.create_reports,
-                    record.user_id,
-                    record.custom_instructions,  # Übergebe die aktualisierten Custom Instructions
-                    record.birth_date  # Übergebe das aktualisierte Geburtsdatum
+                result = process_pdfs.apply_async(
+                    args=[
+                        filenames,
+                        record.patient_name,
+                        record.id,
+                        record.create_reports,
+                        record.user_id,
+                        record.custom_instructions,  # Übergebe die aktualisierten Custom Instructions
+                        record.birth_date  # Übergebe das aktualisierte Geburtsdatum
+                    ],
+                    priority=upload_priority(record.user_id, filenames, sum(upload.page_count for upload in uploads))
                 )
                 return jsonify({'success': True, 'task_id': result.id, 'record_id': record.id})
 
@@ -1396,9 +1394,11 @@ def remove_file_from_record(record_id, filename):
             # Remove each pattern from the text
             text = record.text
             logger.info(f"Original text snippet: {text[:500]}...")  # First 500 chars
+            removed_text = []
             
             for pattern in patterns:
                 logger.info(f"Applying pattern: {pattern}")
+                removed_text.extend(re.findall(pattern, text, flags=re.DOTALL))
                 new_text = re.sub(pattern, '', text, flags=re.DOTALL)
                 if new_text != text:
                     logger.info(f"Pattern matched and removed content")
@@ -1411,6 +1411,10 @@ def remove_file_from_record(record_id, filename):
             
             record.text = text if text.strip() else None
 
+            # Nur die Jahre des entfernten Dokuments müssen in den Berichten neu generiert werden
+            if removed_text:
+                invalidate_text_years(record_id, "\n".join(removed_text), record.birth_date)
+
             # Update token count using the utility function
             if record.text:
                 old_token_count = record.token_count
@@ -1424,7 +1428,7 @@ def remove_file_from_record(record_id, filename):
             if record.text:
                 extraction_result = extract_medical_codes.apply_async((record.text,)).get()
                 if not isinstance(extraction_result, dict) or 'exc_type' not in extraction_result:
-                    parsed_result = parse_medical_codes_xml(extraction_result)
+                    parsed_result = coerce_medical_codes(extraction_result)
                     if parsed_result:
                         save_result = save_medical_codes.apply_async((parsed_result, record_id)).get()
                         logger.info(f"Updated medical codes after file removal: {save_result}")
@@ -1485,6 +1489,7 @@ def upload_system_pdf(template_id):
         
         # Lösche alte PDF falls vorhanden
         if template.system_pdf_filename:
+            invalidate_system_pdf(template.system_pdf_filename)
             old_path = os.path.join(system_prompts_dir, template.system_pdf_filename)
             if os.path.exists(old_path):
                 os.remove(old_path)
@@ -1492,6 +1497,7 @@ def upload_system_pdf(template_id):
         # Speichere neue PDF
         file_path = os.path.join(system_prompts_dir, safe_filename)
         file.save(file_path)
+        invalidate_system_pdf(safe_filename)
         
         # Update Template
         template.system_pdf_filename = safe_filename
@@ -1554,6 +1560,7 @@ def delete_system_pdf(template_id):
         
         if os.path.exists(file_path):
             os.remove(file_path)
+        invalidate_system_pdf(template.system_pdf_filename)
         
         # Update Template in Datenbank
         template.system_pdf_filename = None
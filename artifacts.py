@@ -0,0 +1,272 @@
+# artifacts.py
+"""
+Lebenszyklus der temporären Artefakte der Extraktion.
+
+convert_pdf_to_images legt die Seitenbilder (Pickle plus Seiten-Batches mit gleichem Namensstamm)
+als Artefakt in ARTIFACT_DIR ab. Redis zählt pro Artefakt die Tasks, die es noch lesen werden:
+    - create() vergibt die erste Referenz an den Task, der images_info als Nächstes erhält
+      (distribute_extraction_tasks),
+    - wer weitere Tasks mit dem Artefakt publiziert, zählt sie vorher mit acquire() hinzu,
+    - jeder dieser Tasks gibt seine Referenz nach dem letzten Versuch frei (task_postrun in
+      tasks.py, nicht bei Wiederholungen). Die letzte Freigabe löscht die Dateien sofort.
+aggregate_extraction_results verwirft das Artefakt zusätzlich, denn nach dem Chord-Callback
+liest niemand mehr.
+
+Verwaiste Artefakte räumt janitor() auf: Artefakte ohne Referenz, die älter als
+ARTIFACT_MAX_AGE_MINUTES sind, werden entfernt, danach die ältesten unreferenzierten, bis
+ARTIFACT_DISK_BUDGET_MB eingehalten ist. Referenzierte Artefakte bleiben unabhängig vom Alter
+erhalten (Wartezeit in niedrig priorisierten Queues, lange Vision-Läufe); bleibt eine Referenz
+hängen (Chain abgebrochen, Worker beendet), läuft sie nach REFS_TTL_SECONDS ab. Uploads ohne Referenz
+(ingestion.REFS_KEY) werden nach UPLOAD_ORPHAN_HOURS entfernt, liegen gebliebene Ergebnis-Blobs
+nach BLOB_MAX_AGE_HOURS (blob_store.py).
+"""
+import glob
+import logging
+import os
+import tempfile
+import time
+
+import blob_store
+from config import get_config
+from providers import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_PREFIX = 'images_'
+REFS_KEY = 'healthsum:artifact_refs:{name}'
+# Sicherheitsnetz für Redis; der Janitor entfernt verwaiste Dateien deutlich früher
+REFS_TTL_SECONDS = 24 * 60 * 60
+
+
+def artifact_dir():
+    directory = get_config("ARTIFACT_DIR", "") or os.path.join(tempfile.gettempdir(), 'healthsum_artifacts')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def max_age_seconds():
+    # Ab diesem Alter gilt ein Artefakt ohne Referenz als verwaist; die mtime ist der Zeitpunkt der Konvertierung
+    return float(get_config("ARTIFACT_MAX_AGE_MINUTES", "120")) * 60
+
+
+def disk_budget_bytes():
+    return int(get_config("ARTIFACT_DISK_BUDGET_MB", "10240")) * 1024 * 1024
+
+
+def upload_orphan_seconds():
+    return float(get_config("UPLOAD_ORPHAN_HOURS", "48")) * 60 * 60
+
+
+def artifact_name(path):
+    """Namensstamm eines Artefakts; Pickle und Seiten-Batches teilen ihn"""
+    return os.path.basename(path).split('.', 1)[0]
+
+
+def artifact_files(path):
+    return glob.glob(os.path.join(glob.escape(os.path.dirname(path)), glob.escape(artifact_name(path)) + '.*'))
+
+
+# --- Referenzen ---
+
+def create(suffix='.pkl'):
+    """Legt eine leere Artefaktdatei mit einer Referenz an; liefert den Pfad"""
+    fd, path = tempfile.mkstemp(prefix=ARTIFACT_PREFIX, suffix=suffix, dir=artifact_dir())
+    os.close(fd)
+    try:
+        get_redis_client().set(REFS_KEY.format(name=artifact_name(path)), 1, ex=REFS_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Artefakt-Referenz für {path} nicht gezählt: {e}")
+    return path
+
+
+def acquire(path, count=1):
+    """Zählt count weitere Tasks, die das Artefakt lesen werden; liefert die gezählten Referenzen"""
+    if not path or count <= 0:
+        return 0
+    try:
+        key = REFS_KEY.format(name=artifact_name(path))
+        pipe = get_redis_client().pipeline()
+        pipe.incrby(key, count)
+        pipe.expire(key, REFS_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Artefakt-Referenzen für {path} nicht gezählt: {e}")
+        return 0
+    return count
+
+
+def release(path, count=1):
+    """
+    Gibt count Referenzen frei und löscht das Artefakt mit der letzten.
+    Ohne Redis wird nichts gelöscht (Callback bzw. Janitor räumen auf).
+
+    :return: Freigegebene Bytes
+    """
+    try:
+        key = REFS_KEY.format(name=artifact_name(path))
+        client = get_redis_client()
+        remaining = client.decr(key, count)
+        if remaining > 0:
+            return 0
+        client.delete(key)
+    except Exception as e:
+        logger.warning(f"Artefakt-Referenz für {path} nicht freigegeben: {e}")
+        return 0
+    return remove(path)
+
+
+def discard(path):
+    """Entfernt das Artefakt unabhängig von offenen Referenzen"""
+    try:
+        get_redis_client().delete(REFS_KEY.format(name=artifact_name(path)))
+    except Exception as e:
+        logger.warning(f"Artefakt-Referenz für {path} nicht gelöscht: {e}")
+    return remove(path)
+
+
+def remove(path):
+    freed = 0
+    for file_path in artifact_files(path):
+        try:
+            size = os.path.getsize(file_path)
+            os.remove(file_path)
+            freed += size
+        except OSError as e:
+            logger.warning(f"Artefaktdatei {file_path} nicht gelöscht: {e}")
+    if freed:
+        logger.info(f"Artefakt {artifact_name(path)} entfernt ({freed / 1024 / 1024:.1f} MB)")
+    return freed
+
+
+def artifact_of(args, kwargs):
+    """Artefakt aus den Argumenten eines Tasks (images_info bzw. Batch mit Schlüssel 'artifact')"""
+    for value in [*(args or ()), *(kwargs or {}).values()]:
+        if isinstance(value, dict) and value.get('artifact'):
+            return value['artifact']
+    return None
+
+
+# --- Janitor ---
+
+def scan_artifacts():
+    """{Namensstamm: [Bytes, jüngste Änderung, Pfad einer Datei]} aller Artefakte in ARTIFACT_DIR"""
+    artifacts = {}
+    with os.scandir(artifact_dir()) as entries:
+        for entry in entries:
+            if not entry.name.startswith(ARTIFACT_PREFIX) or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # Zwischenzeitlich freigegeben
+            artifact = artifacts.setdefault(artifact_name(entry.name), [0, 0.0, entry.path])
+            artifact[0] += stat.st_size
+            artifact[1] = max(artifact[1], stat.st_mtime)
+    return artifacts
+
+
+def scan_uploads(upload_folder):
+    """[(relativer Pfad, Bytes, Änderung)] aller abgelegten Uploads"""
+    from ingestion import HASH_DIR_PATTERN
+    uploads = []
+    if not os.path.isdir(upload_folder):
+        return uploads
+    with os.scandir(upload_folder) as directories:
+        for directory in directories:
+            if not HASH_DIR_PATTERN.match(directory.name) or not directory.is_dir():
+                continue
+            with os.scandir(directory.path) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    uploads.append((os.path.join(directory.name, entry.name), stat.st_size, stat.st_mtime))
+    return uploads
+
+
+def disk_usage(upload_folder=None):
+    """Gehaltene Bytes pro Art ('images', 'uploads', 'blobs') für die Metrik healthsum_artifact_bytes"""
+    from ingestion import UPLOAD_FOLDER
+    return {
+        'images': sum(size for size, _, _ in scan_artifacts().values()),
+        'uploads': sum(size for _, size, _ in scan_uploads(upload_folder or UPLOAD_FOLDER)),
+        'blobs': blob_store.disk_usage(),
+    }
+
+
+def _live_refs(keys):
+    """Referenzzähler zu den Schlüsseln, None wenn Redis nicht lesbar ist"""
+    if not keys:
+        return []
+    try:
+        return get_redis_client().mget(keys)
+    except Exception as e:
+        logger.warning(f"Referenzen nicht lesbar, Janitor entfernt nichts: {e}")
+        return None
+
+
+def _evict_uploads(upload_folder, now):
+    from ingestion import REFS_KEY as UPLOAD_REFS_KEY, upload_path
+    candidates = [(path, size) for path, size, mtime in scan_uploads(upload_folder)
+                  if now - mtime > upload_orphan_seconds()]
+    refs = _live_refs([UPLOAD_REFS_KEY.format(path=path) for path, _ in candidates])
+    if refs is None:
+        return 0
+    freed = 0
+    for (path, size), ref in zip(candidates, refs):
+        if ref is not None and int(ref) > 0:
+            continue
+        file_path = upload_path(path, upload_folder)
+        try:
+            os.remove(file_path)
+            freed += size
+            logger.info(f"Verwaister Upload {path} entfernt")
+            os.rmdir(os.path.dirname(file_path))
+        except OSError:
+            pass  # Bereits entfernt bzw. weitere Dateien mit gleichem Inhalt
+    return freed
+
+
+def janitor(upload_folder=None):
+    """
+    Entfernt verwaiste Artefakte nach Alter und setzt das Plattenbudget durch.
+
+    :return: Entfernte Bytes pro Grund ('age', 'budget', 'uploads', 'blobs') und verbleibende Bytes
+    """
+    from ingestion import UPLOAD_FOLDER
+    now = time.time()
+    freed = {'age': 0, 'budget': 0, 'uploads': 0, 'blobs': 0}
+    artifacts = scan_artifacts()
+
+    aged = [(name, size, mtime, path) for name, (size, mtime, path) in artifacts.items()
+            if now - mtime > max_age_seconds()]
+    # Ohne lesbares Redis sind die Referenzen unbekannt, dann bleibt alles liegen
+    aged_refs = _live_refs([REFS_KEY.format(name=name) for name, _, _, _ in aged]) or []
+    for (name, size, mtime, path), ref in zip(aged, aged_refs):
+        if ref is not None and int(ref) > 0:
+            continue  # Wird noch gelesen (Queue-Wartezeit, lange Extraktion)
+        logger.warning(f"Verwaistes Artefakt {name} ({size / 1024 / 1024:.1f} MB, "
+                       f"{(now - mtime) / 60:.0f} min alt) wird entfernt")
+        freed['age'] += discard(path)
+        del artifacts[name]
+
+    held = sum(size for size, _, _ in artifacts.values())
+    if held > disk_budget_bytes():
+        # Älteste zuerst; noch referenzierte Artefakte werden gelesen und bleiben erhalten
+        oldest = sorted(artifacts.items(), key=lambda item: item[1][1])
+        refs = _live_refs([REFS_KEY.format(name=name) for name, _ in oldest]) or []
+        for (name, (size, _, path)), ref in zip(oldest, refs):
+            if held <= disk_budget_bytes():
+                break
+            if ref is not None and int(ref) > 0:
+                continue
+            freed['budget'] += discard(path)
+            held -= size
+        if held > disk_budget_bytes():
+            logger.warning(f"Artefakte belegen {held / 1024 / 1024:.0f} MB, Budget "
+                           f"{disk_budget_bytes() / 1024 / 1024:.0f} MB - alle noch referenziert")
+
+    freed['uploads'] = _evict_uploads(upload_folder or UPLOAD_FOLDER, now)
+    freed['blobs'] = blob_store.purge()
+    return {'freed': freed, 'held': held}
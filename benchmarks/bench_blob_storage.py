@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Vergleicht Speicherbedarf und Lesekosten großer Textspalten vorher/nachher.
+
+    vorher   EncryptedType (verschlüsselter Klartext, base64)
+    nachher  EncryptedBlobType (chunkweise komprimiert, dann AES-GCM; siehe compression.py)
+
+Als Daten dient synthetisches Extraktions-XML im Format von Extractor.create_structured_output
+(vier Extraktoren, mehrere Dokumente, wiederkehrende Laborwerte). Gemessen werden Größe der
+SQLite-Datei, Bytes pro Zeile und die Zeit zum Laden und Entschlüsseln aller Zeilen.
+
+Aufruf (aus dem Projektverzeichnis):
+    python benchmarks/bench_blob_storage.py [--rows 200] [--pages 40] [--runs 3]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('CONFIG_SOURCE', 'env')
+os.environ.setdefault('SECRET_KEY', 'bench-secret-key')
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy_utils import EncryptedType
+
+from compression import EncryptedBlobType, write_codec
+from encryption import ColumnEngine, column_key
+
+LAB_VALUES = ["Hämoglobin", "Leukozyten", "Thrombozyten", "CRP", "Kreatinin", "GFR", "TSH", "HbA1c", "LDL", "HDL"]
+FINDINGS = ["ohne pathologischen Befund", "leicht erhöht", "im Normbereich", "Kontrolle in 3 Monaten empfohlen"]
+
+
+def synthetic_record(pages, seed):
+    rng = random.Random(seed)
+    parts = []
+    for method in ("pdf_text", "ocr", "azure_vision", "gpt4_vision"):
+        parts.append(f'<extraction method="{method}"><document title="Befund_{seed}.pdf">')
+        for page in range(1, pages + 1):
+            lines = [f"Laborbefund vom {rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(2005, 2024)}"]
+            for _ in range(12):
+                lines.append(f"{rng.choice(LAB_VALUES)}: {rng.uniform(0.5, 200):.1f} - {rng.choice(FINDINGS)}")
+            parts.append(f'<page number="{page}">' + "\n".join(lines) + '</page>')
+        parts.append('</document></extraction>')
+    return "".join(parts)
+
+
+def build_db(column_type, texts):
+    Base = declarative_base()
+
+    class Record(Base):
+        __tablename__ = 'record'
+        id = sa.Column(sa.Integer, primary_key=True)
+        text = sa.Column(column_type)
+
+    path = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+    engine = sa.create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(Record(text=text) for text in texts)
+        session.commit()
+    with engine.connect() as connection:
+        stored = connection.execute(sa.text("SELECT sum(length(text)) FROM record")).scalar()
+        connection.exec_driver_sql("VACUUM")
+    return engine, Record, path, stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark komprimierter Blob-Spalten")
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=40, help="Seiten pro Datensatz")
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    texts = [synthetic_record(args.pages, seed) for seed in range(args.rows)]
+    plain = sum(len(text.encode('utf-8')) for text in texts)
+    codec, dict_id = write_codec()
+    print(f"{args.rows} Datensätze, Klartext {plain / 1024 / 1024:.1f} MB "
+          f"(Codec {codec.decode()}, Dictionary {dict_id or '-'})\n")
+    print(f"{'Variante':<10} {'DB-Datei':>10} {'Bytes/Zeile':>12} {'Laden':>10} {'pro Zeile':>10}")
+
+    for label, column_type in (('vorher', EncryptedType(sa.Text, column_key, ColumnEngine)),
+                               ('nachher', EncryptedBlobType())):
+        engine, Record, path, stored = build_db(column_type, texts)
+
+        def load():
+            with Session(engine) as session:
+                assert len(session.query(Record).all()) == args.rows
+
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            load()
+            timings.append(time.perf_counter() - start)
+        seconds = statistics.median(timings)
+        size = os.path.getsize(path)
+        print(f"{label:<10} {size / 1024 / 1024:8.1f}MB {stored // args.rows:>12} "
+              f"{seconds * 1000:8.1f}ms {seconds / args.rows * 1000:8.2f}ms")
+        engine.dispose()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
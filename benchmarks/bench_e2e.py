@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+End-to-End-Benchmark der Pipeline process_pdfs → combine_extractions → process_record → create_report.
+
+Der komplette Celery-Workflow läuft mit echten Workern (Topologie aus celery_config.WORKER_POOLS)
+gegen ein lokales Redis, alle externen APIs werden von lokalen Stand-ins beantwortet
+(mock_providers.py: OpenAI, Gemini, Azure Vision, WHO ICD) - es entstehen keine API-Kosten.
+Eingaben sind synthetische digitale und gescannte PDFs (synthetic_pdfs.py).
+
+Ablauf:
+    1. Stand-ins starten (Latenz, Rate-Limit, Fehlerquote einstellbar)
+    2. Arbeitsverzeichnis mit eigener SQLite-DB, uploads/ und Konfiguration (CONFIG_SOURCE=file)
+    3. Worker starten und auf Bereitschaft warten
+    4. --records Datensätze mit je --files PDFs à --pages Seiten einreichen (wie /upload)
+    5. Warten, bis alle Datensätze completed/failed sind
+
+Ausgabe: Seiten/s, Datensätze/Stunde, p50/p95 pro Stufe (aus TaskLog), Aufrufe/429/500 pro
+Stand-in und Peak-RSS der Worker. Mit --output werden die Ergebnisse als JSON gespeichert,
+um Läufe vor und nach einer Änderung zu vergleichen.
+
+Voraussetzungen: laufendes Redis (die Datenbank aus --redis-url wird vor und nach dem Lauf
+geleert, daher nie die Broker-DB 0 verwenden), poppler und tesseract für gescannte PDFs.
+
+Aufruf (aus dem Projektverzeichnis):
+    python benchmarks/bench_e2e.py [--records 4 --files 2 --pages 10 --kind mixed]
+                                   [--latency-ms 800 --rate-limit 20 --error-rate 0.02]
+                                   [--create-reports] [--io-pool threads] [--output ergebnis.json]
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_providers import MockBehavior, endpoint_config, serve
+from synthetic_pdfs import generate
+
+TEXT_TEMPLATE = {
+    'template_name': 'Benchmark Verlauf',
+    'output_format': 'TEXT',
+    'example_structure': '',
+    'system_prompt': 'Du fasst medizinische Befunde zusammen.',
+    'prompt': 'Fasse den Verlauf des Jahres zusammen.',
+}
+JSON_TEMPLATE = {
+    'template_name': 'Benchmark Befunde',
+    'output_format': 'JSON',
+    'example_structure': json.dumps({"eintraege": [{"datum": "2020-01-01", "befund": "Beispiel"}]}),
+    'system_prompt': 'Du extrahierst Befunde als JSON.',
+    'prompt': 'Liste alle Befunde des Jahres mit Datum auf.',
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+
+
+def prepare_environment(args, base_url, workdir):
+    """Schreibt die Konfiguration und liefert die Umgebung für Worker und diesen Prozess"""
+    config = {
+        'SECRET_KEY': 'bench-secret-key',
+        'OPENAI_API_KEY': 'sk-bench', 'OPENAI_MODEL': 'gpt-4o',
+        'AZURE_KEY_CREDENTIALS': 'bench', 'GEMINI_API_KEY': 'bench', 'GEMINI_MODEL': 'gemini-2.0-flash',
+        'ICD_API_CLIENT_ID': 'bench', 'ICD_API_CLIENT_SECRET': 'bench',
+        'MAIL_SERVER': 'localhost',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        **endpoint_config(base_url),
+    }
+    for item in args.set or []:
+        key, _, value = item.partition('=')
+        config[key] = value
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+    env = {
+        'CONFIG_SOURCE': 'file',
+        'CONFIG_FILE': config_path,
+        'CONFIG_REFRESH_SECONDS': '0',
+        'CELERY_BROKER_URL': args.redis_url,
+        'PYTHONPATH': os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get('PYTHONPATH')])),
+    }
+    if args.cpu_concurrency:
+        env['CELERY_CPU_CONCURRENCY'] = str(args.cpu_concurrency)
+    if args.io_concurrency:
+        env['CELERY_IO_CONCURRENCY'] = str(args.io_concurrency)
+    return env
+
+
+def reset_redis(redis_url):
+    import redis
+    if int(urlparse(redis_url).path.lstrip('/') or 0) == 0:
+        raise SystemExit("✗ --redis-url muss eine eigene Redis-DB (nicht 0) verwenden, sie wird geleert")
+    client = redis.Redis.from_url(redis_url)
+    client.ping()
+    client.flushdb()
+
+
+def start_workers(args, env, workdir):
+    from celery_config import WORKER_POOLS
+    from start_workers import worker_command, worker_env
+
+    processes = {}
+    for index, name in enumerate(sorted(WORKER_POOLS)):
+        settings = dict(WORKER_POOLS[name])
+        if name == 'io' and args.io_pool:
+            settings['pool'] = args.io_pool
+        worker_environment = {**worker_env(name, index), **env}
+        log = open(os.path.join(workdir, f"worker_{name}.log"), 'w')
+        processes[name] = subprocess.Popen(worker_command(name, settings, args.loglevel), cwd=workdir,
+                                           env=worker_environment, stdout=log, stderr=subprocess.STDOUT)
+    return processes
+
+
+def wait_for_workers(celery, processes, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for name, process in processes.items():
+            if process.poll() is not None:
+                raise SystemExit(f"✗ Worker {name} beendet (Exit-Code {process.returncode}), siehe worker_{name}.log")
+        replies = celery.control.inspect(timeout=1).ping() or {}
+        if len(replies) >= len(processes):
+            return
+        time.sleep(1)
+    raise SystemExit("✗ Worker nicht rechtzeitig bereit")
+
+
+def stop_workers(processes):
+    for process in processes.values():
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for process in processes.values():
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def submit_records(args, workdir):
+    """Legt Datensätze mit synthetischen PDFs an und startet process_pdfs wie /upload"""
+    from werkzeug.datastructures import FileStorage
+
+    from app import app, db
+    from ingestion import UPLOAD_FOLDER, ingest_upload
+    from models import HealthRecord, ReportTemplate, User
+    from scheduling import upload_priority
+    from tasks import process_pdfs
+
+    with app.app_context():
+        db.create_all()
+        user = User(vorname='Bench', nachname='Mark', username='bench', email='bench@example.org', level='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        if args.create_reports:
+            db.session.add_all([ReportTemplate(**TEXT_TEMPLATE), ReportTemplate(**JSON_TEMPLATE)])
+        db.session.commit()
+
+        record_ids = []
+        pages = 0
+        started = time.time()
+        for index in range(args.records):
+            pdf_dir = os.path.join(workdir, 'pdfs', f"record_{index + 1}")
+            generated = generate(pdf_dir, args.files, args.pages, args.kind, seed=index * 1000, years=args.years)
+            uploads = []
+            for path, _ in generated:
+                with open(path, 'rb') as f:
+                    uploads.append(ingest_upload(FileStorage(stream=f, filename=os.path.basename(path)), UPLOAD_FOLDER))
+            pages += sum(upload.page_count for upload in uploads)
+
+            record = HealthRecord(patient_name=f"Bench Patient {index + 1}", create_reports=args.create_reports,
+                                  user_id=user.id, processing_status='processing')
+            db.session.add(record)
+            db.session.commit()
+            record_ids.append(record.id)
+            filenames = [upload.path for upload in uploads]
+            process_pdfs.apply_async(
+                args=[filenames, record.patient_name, record.id, args.create_reports, user.id, None, None],
+                priority=upload_priority(user.id, filenames, sum(upload.page_count for upload in uploads))
+            )
+        return record_ids, pages, started
+
+
+def wait_for_records(record_ids, timeout):
+    from app import app, db
+    from models import HealthRecord
+
+    deadline = time.time() + timeout
+    statuses = {}
+    with app.app_context():
+        while time.time() < deadline:
+            db.session.remove()
+            statuses = dict(db.session.query(HealthRecord.id, HealthRecord.processing_status)
+                            .filter(HealthRecord.id.in_(record_ids)).all())
+            if all(statuses.get(record_id) in ('completed', 'failed') for record_id in record_ids):
+                return time.time(), statuses
+            time.sleep(0.5)
+    return None, statuses
+
+
+def stage_latencies(record_ids):
+    from app import app
+    from models import TaskLog
+
+    stages = {}
+    with app.app_context():
+        for task_name, status, duration in TaskLog.query.with_entities(
+                TaskLog.task_name, TaskLog.status, TaskLog.duration_seconds
+        ).filter(TaskLog.health_record_id.in_(record_ids), TaskLog.status.in_(['success', 'failed'])):
+            stage = stages.setdefault(task_name, {'durations': [], 'failed': 0})
+            if status == 'failed':
+                stage['failed'] += 1
+            if duration is not None:
+                stage['durations'].append(duration)
+    return {name: {
+        'count': len(stage['durations']),
+        'failed': stage['failed'],
+        'p50': statistics.median(stage['durations']) if stage['durations'] else None,
+        'p95': percentile(stage['durations'], 0.95),
+        'max': max(stage['durations']) if stage['durations'] else None,
+    } for name, stage in sorted(stages.items())}
+
+
+def report(result):
+    print(f"\n{result['records']} Datensätze, {result['pages']} Seiten in {result['seconds']:.1f} s "
+          f"({result['failed_records']} fehlgeschlagen)")
+    print(f"  Durchsatz  {result['pages_per_second']:.2f} Seiten/s   {result['records_per_hour']:.1f} Datensätze/Stunde")
+    print(f"  Peak-RSS   {result['peak_rss_mb']:.0f} MB (größter Worker-Prozess)\n")
+    print(f"{'Stufe':<36} {'Anzahl':>7} {'Fehler':>7} {'p50':>8} {'p95':>8} {'max':>8}")
+    for name, stage in result['stages'].items():
+        values = [f"{stage[key]:7.2f}s" if stage[key] is not None else f"{'-':>8}" for key in ('p50', 'p95', 'max')]
+        print(f"{name:<36} {stage['count']:>7} {stage['failed']:>7} {' '.join(values)}")
+    print(f"\n{'Stand-in':<14} {'Aufrufe':>8} {'429':>6} {'500':>6}")
+    for provider, stats in result['providers'].items():
+        print(f"{provider:<14} {stats['requests']:>8} {stats['rate_limited']:>6} {stats['errors']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-End-Benchmark mit lokalen Provider-Stand-ins")
+    parser.add_argument('--records', type=int, default=4, help="Anzahl Datensätze")
+    parser.add_argument('--files', type=int, default=2, help="PDFs pro Datensatz")
+    parser.add_argument('--pages', type=int, default=10, help="Seiten pro PDF")
+    parser.add_argument('--kind', choices=['digital', 'scanned', 'mixed'], default='mixed')
+    parser.add_argument('--years', type=int, default=3, help="Jahre pro Akte (bestimmt die Zahl der Jahresberichte)")
+    parser.add_argument('--create-reports', action='store_true', help="Berichte mit zwei Benchmark-Templates erzeugen")
+    parser.add_argument('--latency-ms', type=float, default=800)
+    parser.add_argument('--jitter-ms', type=float, default=200)
+    parser.add_argument('--rate-limit', type=int, default=0, help="Anfragen pro Sekunde und Provider (0 = unbegrenzt)")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--redis-url', default='redis://localhost:6380/15')
+    parser.add_argument('--io-pool', help="Pool des I/O-Workers überschreiben (z.B. threads ohne eventlet)")
+    parser.add_argument('--cpu-concurrency', type=int)
+    parser.add_argument('--io-concurrency', type=int)
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE', help="Zusätzlicher Konfigurationswert")
+    parser.add_argument('--timeout', type=int, default=1800, help="Maximale Laufzeit in Sekunden")
+    parser.add_argument('--loglevel', default='warning')
+    parser.add_argument('--output', help="Ergebnisse zusätzlich als JSON speichern")
+    parser.add_argument('--keep', action='store_true', help="Arbeitsverzeichnis nicht löschen")
+    args = parser.parse_args()
+
+    behavior = MockBehavior(args.latency_ms, args.jitter_ms, args.rate_limit, args.error_rate, seed=0)
+    server, base_url = serve(behavior)
+    workdir = tempfile.mkdtemp(prefix='healthsum_bench_')
+    env = prepare_environment(args, base_url, workdir)
+    os.environ.update(env)
+    os.chdir(workdir)  # uploads/ und instance/ liegen für alle Prozesse im Arbeitsverzeichnis
+    reset_redis(args.redis_url)
+    print(f"Stand-ins: {base_url}   Arbeitsverzeichnis: {workdir}")
+
+    import logging
+    from app import celery
+    logging.getLogger().setLevel(logging.WARNING)
+
+    processes = start_workers(args, env, workdir)
+    try:
+        wait_for_workers(celery, processes)
+        print(f"Worker bereit ({', '.join(processes)}), reiche {args.records} Datensätze ein ...")
+        record_ids, pages, started = submit_records(args, workdir)
+        finished, statuses = wait_for_records(record_ids, args.timeout)
+        if finished is None:
+            print(f"✗ Zeitlimit von {args.timeout} s erreicht, Status: {statuses}")
+            finished = time.time()
+        stages = stage_latencies(record_ids)
+    finally:
+        stop_workers(processes)
+        server.shutdown()
+        reset_redis(args.redis_url)
+
+    seconds = finished - started
+    result = {
+        'records': len(record_ids),
+        'pages': pages,
+        'seconds': seconds,
+        'failed_records': sum(1 for status in statuses.values() if status != 'completed'),
+        'pages_per_second': pages / seconds,
+        'records_per_hour': len(record_ids) / seconds * 3600,
+        # ru_maxrss der beendeten Kindprozesse (inkl. Prefork-Kinder), unter Linux in KB
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'stages': stages,
+        'providers': behavior.summary(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'keep')},
+    }
+    report(result)
+    if args.output:
+        with open(os.path.join(PROJECT_DIR, args.output) if not os.path.isabs(args.output) else args.output, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+    if args.keep:
+        print(f"\nArbeitsverzeichnis mit Logs und DB: {workdir}")
+    else:
+        os.chdir(PROJECT_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Vergleicht die Kosten der Spaltenverschlüsselung vorher/nachher.
+
+    vorher   EncryptedType mit sqlalchemy_utils.AesEngine ('pkcs5') und Schlüssel aus
+             current_app.config (App-Kontext, SHA-256 und Cipher-Aufbau pro Wert)
+    nachher  EncryptedType mit encryption.ColumnEngine (gecachter HKDF-Schlüssel, AES-GCM)
+
+Gemessen werden pro Zeile (process_result_value, wie beim Laden über das ORM), als
+Bulk-Entschlüsselung (encryption.decrypt_many) sowie das Laden aller Zeilen einer
+SQLite-In-Memory-Tabelle über eine Session.
+
+Aufruf (aus dem Projektverzeichnis):
+    python benchmarks/bench_encryption.py [--rows 2000] [--size 4000] [--runs 3]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('CONFIG_SOURCE', 'env')
+os.environ.setdefault('SECRET_KEY', 'bench-secret-key')
+
+import sqlalchemy as sa
+from flask import Flask, current_app
+from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy_utils import EncryptedType
+from sqlalchemy_utils.types.encrypted.encrypted_type import AesEngine
+
+import encryption
+from encryption import ColumnEngine, column_key, decrypt_many
+
+SAMPLE = "Laborbefund vom 12.03.2021: Hämoglobin 13,2 g/dl, Leukozyten 6,1/nl. "
+
+
+def make_types():
+    before = EncryptedType(sa.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5')
+    after = EncryptedType(sa.Text, column_key, ColumnEngine)
+    return before, after
+
+
+def timed(func, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_per_row(rows, text, runs):
+    before, after = make_types()
+    dialect = sa.create_engine('sqlite://').dialect
+    stored_before = [before.process_bind_param(text, dialect) for _ in range(rows)]
+    stored_after = [after.process_bind_param(text, dialect) for _ in range(rows)]
+
+    results = {
+        'vorher  pro Zeile': timed(lambda: [before.process_result_value(v, dialect) for v in stored_before], runs),
+        'nachher pro Zeile': timed(lambda: [after.process_result_value(v, dialect) for v in stored_after], runs),
+        'nachher Bulk': timed(lambda: decrypt_many(stored_after), runs),
+        'nachher Altbestand': timed(lambda: decrypt_many(stored_before), runs),
+    }
+    encrypt_results = {
+        'vorher  verschlüsseln': timed(lambda: [before.process_bind_param(text, dialect) for _ in range(rows)], runs),
+        'nachher verschlüsseln': timed(lambda: [after.process_bind_param(text, dialect) for _ in range(rows)], runs),
+    }
+    return results, encrypt_results
+
+
+def bench_orm(rows, text, runs):
+    results = {}
+    for label, column_type in zip(('vorher  ORM-Laden', 'nachher ORM-Laden'), make_types()):
+        Base = declarative_base()
+
+        class Record(Base):
+            __tablename__ = 'record'
+            id = sa.Column(sa.Integer, primary_key=True)
+            text = sa.Column(column_type)
+
+        engine = sa.create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add_all(Record(text=text) for _ in range(rows))
+            session.commit()
+
+        def load():
+            with Session(engine) as session:
+                session.query(Record).all()
+
+        results[label] = timed(load, runs)
+    return results
+
+
+def report(results, rows):
+    for label, seconds in results.items():
+        print(f"{label:<24} {seconds * 1000:9.1f} ms gesamt   {seconds / rows * 1e6:8.1f} µs/Zeile")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark der Spaltenverschlüsselung")
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=4000, help="Zeichen pro Wert")
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    text = (SAMPLE * (args.size // len(SAMPLE) + 1))[:args.size]
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+    with app.app_context():
+        print(f"{args.rows} Zeilen à {args.size} Zeichen, Median aus {args.runs} Läufen "
+              f"(schreibende Engine: {encryption.write_engine()})\n")
+        decrypt_results, encrypt_results = bench_per_row(args.rows, text, args.runs)
+        report(decrypt_results, args.rows)
+        print()
+        report(encrypt_results, args.rows)
+        print()
+        report(bench_orm(args.rows, text, args.runs), args.rows)
+
+
+if __name__ == '__main__':
+    main()
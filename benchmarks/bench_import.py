@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Misst den Kaltstart der Module (Import-Zeit in einem frischen Interpreter) und die
+Initialisierung der Provider beim ersten Zugriff.
+
+Jeder Messlauf startet einen neuen Python-Prozess, so wie ein neuer Celery-Child-Prozess
+oder ein neuer Web-Worker. Ausgegeben werden Median und Maximum pro Modul.
+
+Aufruf (aus dem Projektverzeichnis):
+    python benchmarks/bench_import.py [--runs 5] [--modules reports utils tasks]
+    python benchmarks/bench_import.py --providers
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_MODULES = ['config', 'providers', 'extractors', 'utils', 'reports', 'tasks', 'app']
+
+IMPORT_SNIPPET = """
+import time, sys
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(int('config' in sys.modules and sys.modules['config'].Config._loaded))
+"""
+
+PROVIDER_SNIPPET = """
+import time
+import providers
+for name, factory in [
+    ('openai', providers.get_openai_client),
+    ('azure_vision', providers.get_vision_client),
+    ('genai', providers.get_genai),
+    ('gemini_model', providers.get_gemini_model),
+]:
+    start = time.perf_counter()
+    try:
+        factory()
+        status = 'ok'
+    except Exception as e:
+        status = type(e).__name__
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    try:
+        factory()
+    except Exception:
+        pass
+    second = time.perf_counter() - start
+    print(f"{name:<14} erster Zugriff {first * 1000:8.1f} ms   weiterer Zugriff {second * 1000:6.3f} ms   ({status})")
+"""
+
+
+def run_snippet(snippet):
+    """Führt ein Snippet in einem frischen Interpreter im Projektverzeichnis aus"""
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    result = subprocess.run(
+        [sys.executable, '-c', snippet],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else 'Unbekannter Fehler')
+    return result.stdout.strip().splitlines()
+
+
+def bench_imports(modules, runs):
+    print(f"Import-Zeiten ({runs} Läufe, jeweils frischer Prozess)")
+    print(f"{'Modul':<12} {'Median':>10} {'Max':>10}  Konfiguration geladen")
+    for module in modules:
+        timings = []
+        config_loaded = False
+        try:
+            for _ in range(runs):
+                output = run_snippet(IMPORT_SNIPPET.format(module=module))
+                timings.append(float(output[-2]))
+                config_loaded = output[-1] == '1'
+        except RuntimeError as e:
+            print(f"{module:<12} FEHLER: {e}")
+            continue
+        print(f"{module:<12} {statistics.median(timings) * 1000:8.1f}ms {max(timings) * 1000:8.1f}ms  {'ja' if config_loaded else 'nein'}")
+
+
+def bench_providers():
+    print("Provider-Initialisierung (frischer Prozess)")
+    start = time.perf_counter()
+    for line in run_snippet(PROVIDER_SNIPPET):
+        print(line)
+    print(f"Gesamt inkl. Prozessstart: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kaltstart-Benchmark für Web-App und Worker")
+    parser.add_argument('--runs', type=int, default=5, help="Anzahl Messläufe pro Modul")
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help="Zu messende Module")
+    parser.add_argument('--providers', action='store_true', help="Zusätzlich die Provider-Initialisierung messen")
+    args = parser.parse_args()
+
+    bench_imports(args.modules, args.runs)
+    if args.providers:
+        print()
+        bench_providers()
+
+
+if __name__ == '__main__':
+    main()
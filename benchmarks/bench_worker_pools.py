@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Vergleicht die Worker-Topologien bei gemischter Last (CPU- und I/O-Stufen).
+
+    single  Ein Eventlet-Pool für alles (bisheriges Setup, CELERYD_CONCURRENCY=500).
+            CPU-Arbeit (poppler, tesseract, PyPDF2) blockiert dabei den Event-Loop,
+            alle wartenden API-Aufrufe stehen still.
+    split   Prefork-Pool (ein Prozess pro Kern) für CPU-Stufen und daneben ein
+            Eventlet-Pool für die API-Stufen (siehe celery_config.WORKER_POOLS).
+
+Simuliert wird ohne Broker: CPU-Tasks rechnen eine feste Menge (kalibriert auf --cpu-ms),
+I/O-Tasks warten per time.sleep (unter eventlet kooperativ). Alle Tasks werden gleichzeitig
+eingereicht; gemessen werden Gesamtdauer, Durchsatz und Latenz pro Task-Art.
+Jede Topologie läuft in frischen Prozessen, damit das Monkey Patching isoliert bleibt.
+Ist eventlet nicht installiert, wird ersatzweise ein Thread-Pool verwendet.
+
+Aufruf (aus dem Projektverzeichnis):
+    python benchmarks/bench_worker_pools.py [--cpu-tasks 40 --cpu-ms 200 --io-tasks 200 --io-ms 300]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def cpu_task(iterations):
+    """Simuliert eine CPU-Stufe (z.B. OCR einer Seite) mit fester Rechenmenge"""
+    value = 0
+    for _ in range(iterations):
+        value = (value * 31 + 7) % 1000003
+    return value
+
+
+def calibrate(cpu_ms):
+    """Anzahl Iterationen, die ungestört cpu_ms Rechenzeit entsprechen"""
+    iterations = 100000
+    start = time.perf_counter()
+    cpu_task(iterations)
+    return max(1, int(iterations * cpu_ms / 1000 / (time.perf_counter() - start)))
+
+
+def io_task(io_ms):
+    """Simuliert einen API-Aufruf"""
+    time.sleep(io_ms / 1000)
+
+
+def run_green(jobs, concurrency, start_at):
+    """Führt Jobs in einem grünen Pool aus (eventlet, ersatzweise Threads)"""
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+        pool = eventlet.GreenPool(concurrency)
+        backend = 'eventlet'
+    except ImportError:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(concurrency)
+        backend = 'threads'
+
+    latencies = {'cpu': [], 'io': []}
+
+    def run(kind, amount):
+        (cpu_task if kind == 'cpu' else io_task)(amount)
+        latencies[kind].append(time.time() - start_at)
+
+    while time.time() < start_at:
+        time.sleep(0.001)
+    if backend == 'eventlet':
+        for kind, amount in jobs:
+            pool.spawn_n(run, kind, amount)
+        pool.waitall()
+    else:
+        with pool:
+            for kind, amount in jobs:
+                pool.submit(run, kind, amount)
+    return backend, latencies
+
+
+def _prefork_job(args):
+    iterations, start_at = args
+    cpu_task(iterations)
+    return time.time() - start_at
+
+
+def run_prefork(jobs, processes, start_at):
+    """Führt CPU-Jobs in einem Prozess-Pool aus (wie Celery prefork)"""
+    import multiprocessing
+    with multiprocessing.Pool(processes) as pool:
+        pool.map(cpu_task, [0] * processes)  # Prozesse vorab starten
+        while time.time() < start_at:
+            time.sleep(0.001)
+        latencies = pool.map(_prefork_job, [(iterations, start_at) for _, iterations in jobs], chunksize=1)
+    return 'prefork', {'cpu': latencies, 'io': []}
+
+
+def worker_main(args):
+    """Einstiegspunkt eines Kindprozesses: eine Topologie-Komponente ausführen"""
+    jobs = []
+    for index in range(max(args.cpu_tasks, args.io_tasks)):
+        # Gemischte Einreichung wie bei mehreren gleichzeitig verarbeiteten PDFs
+        if index < args.cpu_tasks and args.role in ('green-mixed', 'prefork'):
+            jobs.append(('cpu', args.cpu_iterations))
+        if index < args.io_tasks and args.role in ('green-mixed', 'green-io'):
+            jobs.append(('io', args.io_ms))
+
+    if args.role == 'prefork':
+        backend, latencies = run_prefork(jobs, args.processes, args.start_at)
+    else:
+        backend, latencies = run_green(jobs, args.concurrency, args.start_at)
+    print(json.dumps({'backend': backend, 'latencies': latencies}))
+
+
+def spawn(role, args, start_at):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--role', role, '--start-at', str(start_at),
+        '--cpu-tasks', str(args.cpu_tasks), '--cpu-iterations', str(args.cpu_iterations),
+        '--io-tasks', str(args.io_tasks), '--io-ms', str(args.io_ms),
+        '--concurrency', str(args.concurrency), '--processes', str(args.processes),
+    ]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+
+def run_topology(roles, args):
+    start_at = time.time() + 1.5  # Gemeinsamer Startzeitpunkt nach dem Prozessstart
+    processes = [spawn(role, args, start_at) for role in roles]
+    results = [json.loads(process.communicate()[0].strip().splitlines()[-1]) for process in processes]
+    latencies = {'cpu': [], 'io': []}
+    for result in results:
+        for kind in latencies:
+            latencies[kind].extend(result['latencies'][kind])
+    backends = '+'.join(result['backend'] for result in results)
+    return backends, latencies
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(name, backends, latencies):
+    all_latencies = latencies['cpu'] + latencies['io']
+    makespan = max(all_latencies)
+    print(f"{name:<7} ({backends})")
+    print(f"  Gesamtdauer {makespan:7.2f} s   Durchsatz {len(all_latencies) / makespan:7.1f} Tasks/s")
+    for kind in ('cpu', 'io'):
+        values = latencies[kind]
+        if values:
+            print(f"  {kind:<4} Median {statistics.median(values):6.2f} s   p95 {percentile(values, 0.95):6.2f} s   max {max(values):6.2f} s")
+    return makespan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark: ein Eventlet-Pool vs. getrennte CPU-/I/O-Pools")
+    parser.add_argument('--cpu-tasks', type=int, default=40, help="Anzahl CPU-Tasks (z.B. OCR-Seiten)")
+    parser.add_argument('--cpu-ms', type=int, default=200, help="Rechenzeit pro CPU-Task")
+    parser.add_argument('--io-tasks', type=int, default=200, help="Anzahl I/O-Tasks (API-Aufrufe)")
+    parser.add_argument('--io-ms', type=int, default=300, help="Wartezeit pro I/O-Task")
+    parser.add_argument('--concurrency', type=int, default=500, help="Concurrency des grünen Pools")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 2, help="Prozesse im Prefork-Pool")
+    parser.add_argument('--role', help=argparse.SUPPRESS)
+    parser.add_argument('--start-at', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--cpu-iterations', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role:
+        worker_main(args)
+        return
+
+    args.cpu_iterations = calibrate(args.cpu_ms)
+    print(f"Last: {args.cpu_tasks} CPU-Tasks à {args.cpu_ms} ms, {args.io_tasks} I/O-Tasks à {args.io_ms} ms, "
+          f"{args.processes} CPU-Prozesse\n")
+    single = report('single', *run_topology(['green-mixed'], args))
+    split = report('split', *run_topology(['prefork', 'green-io'], args))
+    print(f"\nGesamtdauer split/single: {split / single:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Lokale Stand-ins für OpenAI, Gemini, Azure Vision und die WHO-ICD-API.
+
+Ein HTTP-Server beantwortet die Endpunkte, die die Pipeline tatsächlich aufruft:
+
+    POST /v1/chat/completions                        OpenAI (Text, Vision, JSON-Modus)
+    POST /v1beta/models/<modell>:generateContent     Gemini (REST-Transport)
+    POST /computervision/imageanalysis:analyze       Azure Vision (READ)
+    POST /connect/token, GET /icd/release/...        WHO ICD-10/-11
+
+Latenz (Mittelwert und Streuung), Rate-Limit pro Provider (Anfragen pro Sekunde, darüber
+HTTP 429 mit Retry-After) und Fehlerquote (HTTP 500) sind einstellbar. Die Antworten sind
+so aufgebaut, dass die Pipeline sie wie echte Antworten verarbeitet (Patientendaten als
+JSON, Jahresberichte mit dem Schlüssel 'eintraege', Seitentexte mit ICD-Codes).
+
+Eigenständig starten, z.B. für manuelle Tests gegen einen lokal laufenden Worker:
+    python benchmarks/mock_providers.py [--port 8765] [--latency-ms 800] [--rate-limit 20] [--error-rate 0.02]
+Die Endpunkte werden über OPENAI_BASE_URL, GEMINI_API_ENDPOINT, AZURE_VISION_ENDPOINT,
+ICD_TOKEN_ENDPOINT und ICD_API_BASE in der Konfiguration eingetragen (siehe bench_e2e.py).
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+PAGE_LINES = [
+    "Laborbefund: Hämoglobin 13.8 g/dl, Leukozyten 6.2 /nl, CRP 4 mg/l",
+    "Diagnosen: E11.9 Diabetes mellitus Typ 2, I10.00 Essentielle Hypertonie",
+    "Therapie: Metformin 1000 mg 1-0-1, Ramipril 5 mg 1-0-0",
+    "Procedere: Kontrolle in 3 Monaten, OPS 1-632.0 geplant",
+]
+
+
+class MockBehavior:
+    """Latenz, Rate-Limit und Fehlerquote aller Stand-ins plus Zähler für die Auswertung"""
+
+    def __init__(self, latency_ms=800, jitter_ms=200, rate_limit=0, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def admit(self, provider):
+        """Entscheidet über eine Anfrage: None (beantworten), 429 oder 500"""
+        with self._lock:
+            self.stats[(provider, 'requests')] += 1
+            if self.rate_limit:
+                second = int(time.time())
+                window_second, count = self._windows.get(provider, (second, 0))
+                count = count + 1 if window_second == second else 1
+                self._windows[provider] = (second, count)
+                if count > self.rate_limit:
+                    self.stats[(provider, 'rate_limited')] += 1
+                    return 429
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats[(provider, 'errors')] += 1
+                return 500
+            delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000 if self.jitter_ms else self.latency_ms / 1000
+        time.sleep(delay)
+        return None
+
+    def summary(self):
+        providers = sorted({provider for provider, _ in self.stats})
+        return {provider: {kind: self.stats[(provider, kind)] for kind in ('requests', 'rate_limited', 'errors')}
+                for provider in providers}
+
+
+def page_text():
+    return "\n".join(PAGE_LINES)
+
+
+def year_in(text):
+    match = re.search(r"\b(19|20)\d{2}\b", text or "")
+    return int(match.group(0)) if match else 2020
+
+
+def completion_text(prompt_text, wants_json, has_image):
+    """Antwort passend zum Aufrufer: Vision-Seite, Patientendaten, Jahresbericht (JSON/Text)"""
+    if has_image:
+        return json.dumps({"seite": page_text()}, ensure_ascii=False)
+    if 'start_year' in prompt_text:
+        return json.dumps({"start_year": 2019, "end_year": 2021, "patient_name": "Erika Mustermann"})
+    year = year_in(prompt_text)
+    if wants_json:
+        return json.dumps({"eintraege": [
+            {"datum": f"{year}-03-14", "befund": "Diabetes mellitus Typ 2, gut eingestellt"},
+            {"datum": f"{year}-09-02", "befund": "Hypertonie, Ramipril fortgeführt"},
+        ]}, ensure_ascii=False)
+    return f"Zusammenfassung {year}: Diabetes mellitus Typ 2 und Hypertonie, stabile Verläufe."
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    behavior = None  # wird in serve() gesetzt
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _admit(self, provider):
+        status = self.behavior.admit(provider)
+        if status == 429:
+            self._send(429, {"error": {"code": 429, "message": "Rate limit exceeded", "status": "RESOURCE_EXHAUSTED"}},
+                       {'Retry-After': '1'})
+            return False
+        if status == 500:
+            self._send(500, {"error": {"code": 500, "message": "Simulated server error", "status": "INTERNAL"}})
+            return False
+        return True
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        if path.endswith('/chat/completions'):
+            self._openai(json.loads(body or b'{}'))
+        elif ':generateContent' in path:
+            self._gemini(json.loads(body or b'{}'))
+        elif 'imageanalysis:analyze' in path:
+            self._azure_vision()
+        elif path.endswith('/connect/token'):
+            if self._admit('icd'):
+                self._send(200, {"access_token": "mock-token", "token_type": "Bearer", "expires_in": 3600})
+        else:
+            self._send(404, {"error": f"Unbekannter Endpunkt {path}"})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith('/icd/release/10/'):
+            if self._admit('icd'):
+                self._send(200, {"title": {"@language": "en", "@value": f"Beschreibung {path.rsplit('/', 1)[-1]}"}})
+        elif path.startswith('/icd/release/11/'):
+            if self._admit('icd'):
+                self._send(200, {"label": "Beschreibung ICD-11"})
+        else:
+            self._send(404, {"error": f"Unbekannter Endpunkt {path}"})
+
+    def _openai(self, request):
+        if not self._admit('openai'):
+            return
+        prompt_parts = []
+        has_image = False
+        for message in request.get('messages', []):
+            content = message.get('content')
+            if isinstance(content, list):
+                for part in content:
+                    if part.get('type') == 'image_url':
+                        has_image = True
+                    elif part.get('type') == 'text':
+                        prompt_parts.append(part.get('text', ''))
+            elif content:
+                prompt_parts.append(content)
+        prompt_text = "\n".join(prompt_parts)
+        wants_json = (request.get('response_format') or {}).get('type') == 'json_object'
+        text = completion_text(prompt_text, wants_json, has_image)
+        prompt_tokens, completion_tokens = count_tokens(prompt_text) + (765 if has_image else 0), count_tokens(text)
+        self._send(200, {
+            "id": f"chatcmpl-mock-{random.getrandbits(32):08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'mock'),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _gemini(self, request):
+        if not self._admit('gemini'):
+            return
+        prompt_parts = []
+        has_image = False
+        for content in request.get('contents', []):
+            for part in content.get('parts', []):
+                if 'inlineData' in part or 'inline_data' in part or 'fileData' in part:
+                    has_image = True
+                elif 'text' in part:
+                    prompt_parts.append(part['text'])
+        prompt_text = "\n".join(prompt_parts)
+        config = request.get('generationConfig') or request.get('generation_config') or {}
+        wants_json = (config.get('responseMimeType') or config.get('response_mime_type')) == 'application/json'
+        text = completion_text(prompt_text, wants_json, has_image)
+        prompt_tokens, completion_tokens = count_tokens(prompt_text) + (258 if has_image else 0), count_tokens(text)
+        self._send(200, {
+            "candidates": [{"index": 0, "finishReason": "STOP",
+                            "content": {"role": "model", "parts": [{"text": text}]}}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens,
+                              "totalTokenCount": prompt_tokens + completion_tokens},
+        })
+
+    def _azure_vision(self):
+        if not self._admit('azure_vision'):
+            return
+        polygon = [{"x": 0, "y": 0}, {"x": 100, "y": 0}, {"x": 100, "y": 10}, {"x": 0, "y": 10}]
+        lines = [{
+            "text": line,
+            "boundingPolygon": polygon,
+            "words": [{"text": word, "boundingPolygon": polygon, "confidence": 0.99} for word in line.split()],
+        } for line in PAGE_LINES]
+        self._send(200, {
+            "modelVersion": "2023-10-01",
+            "metadata": {"width": 1240, "height": 1754},
+            "readResult": {"blocks": [{"lines": lines}]},
+        })
+
+
+def serve(behavior, host='127.0.0.1', port=0):
+    """Startet den Server in einem Hintergrund-Thread und liefert (Server, Basis-URL)"""
+    handler = type('BoundMockHandler', (MockHandler,), {'behavior': behavior})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def endpoint_config(base_url):
+    """Konfigurationswerte, die alle Provider auf den Stand-in umleiten"""
+    return {
+        'OPENAI_BASE_URL': f"{base_url}/v1",
+        'GEMINI_API_ENDPOINT': base_url,
+        'AZURE_VISION_ENDPOINT': f"{base_url}/",
+        'ICD_TOKEN_ENDPOINT': f"{base_url}/connect/token",
+        'ICD_API_BASE': base_url,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokale Stand-ins für OpenAI, Gemini, Azure Vision und WHO ICD")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=800, help="Mittlere Antwortzeit")
+    parser.add_argument('--jitter-ms', type=float, default=200, help="Standardabweichung der Antwortzeit")
+    parser.add_argument('--rate-limit', type=int, default=0, help="Anfragen pro Sekunde und Provider (0 = unbegrenzt)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Anteil der Anfragen mit HTTP 500")
+    args = parser.parse_args()
+
+    behavior = MockBehavior(args.latency_ms, args.jitter_ms, args.rate_limit, args.error_rate)
+    server, base_url = serve(behavior, args.host, args.port)
+    print(f"Stand-ins laufen auf {base_url}")
+    for key, value in endpoint_config(base_url).items():
+        print(f"  {key}={value}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(behavior.summary()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
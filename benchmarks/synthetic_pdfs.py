@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Synthetische Befund-PDFs für Benchmarks.
+
+    digital   PDF mit Textebene (Helvetica), von PyPDF2 direkt lesbar
+    scanned   Reine Bild-PDF (gerenderte Seite als JPEG), erzwingt OCR bzw. Vision
+
+Jede Seite enthält einen datierten Laborbefund mit Diagnosen (ICD-10), Therapie und OPS-Code,
+verteilt über --years Jahre, damit Patientendaten, Codes und Jahresberichte wie bei echten
+Akten entstehen. Ohne Zusatzpakete: die Text-PDF wird direkt geschrieben, die Bild-PDF mit Pillow.
+
+Aufruf:
+    python benchmarks/synthetic_pdfs.py --out /tmp/pdfs [--files 4] [--pages 20] [--kind digital|scanned|mixed]
+"""
+import argparse
+import io
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in Punkt
+SCAN_DPI = 150
+
+LAB_VALUES = ["Hämoglobin", "Leukozyten", "Thrombozyten", "CRP", "Kreatinin", "GFR", "TSH", "HbA1c", "LDL", "HDL"]
+DIAGNOSES = [("E11.9", "Diabetes mellitus Typ 2"), ("I10.00", "Essentielle Hypertonie"),
+             ("J20.9", "Akute Bronchitis"), ("M54.5", "Kreuzschmerz"), ("E78.0", "Hypercholesterinämie")]
+PROCEDURES = ["1-632.0", "3-222", "8-930", "1-710"]
+
+
+def page_lines(rng, page, pages, first_year, years):
+    year = first_year + page * years // pages  # Befunde chronologisch über die Jahre verteilt
+    lines = [f"Befundbericht vom {rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{year}", "Patientin: Erika Mustermann, geb. 12.08.1961", ""]
+    for _ in range(12):
+        lines.append(f"{rng.choice(LAB_VALUES)}: {rng.uniform(0.5, 200):.1f}")
+    code, text = rng.choice(DIAGNOSES)
+    lines += ["", f"Diagnose: {code} {text}", f"Prozedur: OPS {rng.choice(PROCEDURES)}",
+              "Procedere: Kontrolle in 3 Monaten empfohlen", f"Seite {page + 1}"]
+    return lines
+
+
+def document_pages(pages, seed, first_year, years):
+    rng = random.Random(seed)
+    return [page_lines(rng, page, pages, first_year, years) for page in range(pages)]
+
+
+def _pdf_string(text):
+    raw = text.encode('cp1252', errors='replace')
+    return b'(' + raw.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def write_digital_pdf(path, pages_lines):
+    """Schreibt eine PDF mit Textebene (ein Content-Stream pro Seite)"""
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_ids = []
+    for lines in pages_lines:
+        stream = [b"BT /F1 11 Tf 14 TL 56 786 Td"]
+        for line in lines:
+            stream.append(_pdf_string(line) + b" Tj T*")
+        stream.append(b"ET")
+        content = b"\n".join(stream)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+                       % (PAGE_WIDTH, PAGE_HEIGHT, content_id))
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % pid for pid in page_ids) + b"] /Count %d >>" % len(page_ids)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    with open(path, 'wb') as f:
+        f.write(out.getvalue())
+
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1
+        return ImageFont.load_default()
+
+
+def write_scanned_pdf(path, pages_lines, seed=0):
+    """Schreibt eine reine Bild-PDF (leicht verrauschte Graustufen-Scans)"""
+    rng = random.Random(seed)
+    scale = SCAN_DPI / 72
+    size = (int(PAGE_WIDTH * scale), int(PAGE_HEIGHT * scale))
+    font = _font(int(11 * scale))
+    images = []
+    for lines in pages_lines:
+        image = Image.new('L', size, 250)
+        draw = ImageDraw.Draw(image)
+        y = int(56 * scale)
+        for line in lines:
+            draw.text((int(56 * scale) + rng.randint(-2, 2), y), line, fill=rng.randint(10, 40), font=font)
+            y += int(14 * scale)
+        images.append(image.rotate(rng.uniform(-0.7, 0.7), fillcolor=250))
+    images[0].save(path, 'PDF', resolution=SCAN_DPI, save_all=True, append_images=images[1:])
+
+
+def generate(out_dir, files, pages, kind='mixed', seed=0, first_year=2019, years=3):
+    """Erzeugt files PDFs mit je pages Seiten und liefert [(Pfad, Art)]"""
+    os.makedirs(out_dir, exist_ok=True)
+    result = []
+    for index in range(files):
+        file_kind = kind if kind != 'mixed' else ('digital' if index % 2 == 0 else 'scanned')
+        pages_lines = document_pages(pages, seed + index, first_year, years)
+        path = os.path.join(out_dir, f"befund_{index + 1:03d}_{file_kind}.pdf")
+        if file_kind == 'digital':
+            write_digital_pdf(path, pages_lines)
+        else:
+            write_scanned_pdf(path, pages_lines, seed + index)
+        result.append((path, file_kind))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetische Befund-PDFs erzeugen")
+    parser.add_argument('--out', required=True, help="Zielverzeichnis")
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--pages', type=int, default=20, help="Seiten pro PDF")
+    parser.add_argument('--kind', choices=['digital', 'scanned', 'mixed'], default='mixed')
+    parser.add_argument('--years', type=int, default=3, help="Über so viele Jahre verteilte Befunde")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for path, kind in generate(args.out, args.files, args.pages, args.kind, args.seed, years=args.years):
+        print(f"{kind:<8} {os.path.getsize(path) // 1024:>6} KB  {path}")
+
+
+if __name__ == '__main__':
+    main()
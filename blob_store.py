@@ -0,0 +1,132 @@
+# blob_store.py
+"""
+Claim-Check für große Task-Ergebnisse.
+
+Extraktoren liefern ganze Extraktions-XMLs. Statt sie als Celery-Ergebnis durch Redis zu schicken
+(Ergebnis des Extraktors, Argument des Chord-Callbacks, Ergebnis des Callbacks, Argument von
+combine_extractions), legt stash() Werte ab BLOB_STORE_MIN_BYTES als Datei in BLOB_STORE_DIR ab
+und gibt nur eine Referenz {'blob_ref': ..., 'size': ...} weiter. fetch() löst Referenzen
+wieder auf, andere Werte werden unverändert durchgereicht.
+
+Die Dateien sind wie die Blob-Spalten komprimiert und mit AES-GCM verschlüsselt
+(compression.encode_text, Schlüssel aus SECRET_KEY). BLOB_STORE_DIR muss für alle Worker
+erreichbar sein (Standard: lokales Temp-Verzeichnis, ein Host wie bei start_workers.py).
+
+Gelöscht wird erst von combine_extractions nach dem Commit, denn die Tasks davor können wegen
+acks_late erneut zugestellt werden und müssen ihre Eingaben dann noch lesen können; was liegen
+bleibt, entfernt purge() nach BLOB_MAX_AGE_HOURS (Beat-Task clean_artifacts).
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from compression import decode_value, encode_text
+from config import get_config
+
+logger = logging.getLogger(__name__)
+
+BLOB_SUFFIX = '.blob'
+
+
+def blob_dir():
+    directory = get_config("BLOB_STORE_DIR", "") or os.path.join(tempfile.gettempdir(), 'healthsum_blobs')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def min_bytes():
+    # Kleine Werte (Fehlerobjekte, kurze Dokumente) bleiben im Ergebnis
+    return int(get_config("BLOB_STORE_MIN_BYTES", "16384"))
+
+
+def max_age_seconds():
+    return float(get_config("BLOB_MAX_AGE_HOURS", "24")) * 60 * 60
+
+
+def is_ref(value):
+    return isinstance(value, dict) and 'blob_ref' in value
+
+
+def blob_path(blob_id):
+    # Nur Hex-IDs aus stash(), damit eine Referenz nicht aus dem Verzeichnis zeigen kann
+    if not isinstance(blob_id, str) or not blob_id.isalnum():
+        raise ValueError(f"Ungültige Blob-Referenz: {blob_id!r}")
+    return os.path.join(blob_dir(), blob_id + BLOB_SUFFIX)
+
+
+def stash(value):
+    """Legt große Werte ab und liefert eine Referenz; kleine Werte und Referenzen unverändert"""
+    if value is None or is_ref(value):
+        return value
+    payload = json.dumps(value, ensure_ascii=False)
+    if len(payload) < min_bytes():
+        return value
+    blob_id = uuid.uuid4().hex
+    path = blob_path(blob_id)
+    data = encode_text(payload)
+    temp_path = f"{path}.part"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return {'blob_ref': blob_id, 'size': len(payload)}
+
+
+def fetch(value):
+    """Löst eine Referenz auf; FileNotFoundError, wenn der Blob schon entfernt wurde"""
+    if not is_ref(value):
+        return value
+    with open(blob_path(value['blob_ref']), 'rb') as f:
+        return json.loads(decode_value(f.read()))
+
+
+def delete(values):
+    """Entfernt die Blobs aller Referenzen in values; liefert die Anzahl"""
+    deleted = 0
+    for value in values or []:
+        if not is_ref(value):
+            continue
+        try:
+            os.remove(blob_path(value['blob_ref']))
+            deleted += 1
+        except (OSError, ValueError):
+            pass  # Bereits entfernt
+    return deleted
+
+
+def scan():
+    """[(Pfad, Bytes, Änderung)] aller Blobs"""
+    blobs = []
+    with os.scandir(blob_dir()) as entries:
+        for entry in entries:
+            if not entry.name.endswith(BLOB_SUFFIX) and not entry.name.endswith('.part'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            blobs.append((entry.path, stat.st_size, stat.st_mtime))
+    return blobs
+
+
+def disk_usage():
+    return sum(size for _, size, _ in scan())
+
+
+def purge():
+    """Entfernt Blobs älter als BLOB_MAX_AGE_HOURS; liefert die freigegebenen Bytes"""
+    freed = 0
+    cutoff = time.time() - max_age_seconds()
+    for path, size, mtime in scan():
+        if mtime >= cutoff:
+            continue
+        try:
+            os.remove(path)
+            freed += size
+        except OSError:
+            pass
+    if freed:
+        logger.info(f"Verwaiste Blobs entfernt ({freed / 1024 / 1024:.1f} MB)")
+    return freed
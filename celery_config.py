@@ -1,13 +1,15 @@
 #celery_config.py
 
+import os
+
 from celery import Celery
 from celery.schedules import crontab
 
-# Broker URL für Redis
-BROKER_URL = 'redis://localhost:6380/0'
+# Broker URL für Redis (überschreibbar, z.B. für benchmarks/bench_e2e.py)
+BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6380/0')
 
 # Result Backend URL (Redis)
-RESULT_BACKEND = 'redis://localhost:6380/0'
+RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', BROKER_URL)
 
 # Zeitzone für Celery (optional, aber empfohlen)
 TIMEZONE = 'Europe/Berlin'
@@ -37,13 +39,17 @@ CELERY_WORKER_PREFETCH_MULTIPLIER = 2  # Reduziert von Standard 4
 CELERY_TASK_ACKS_LATE = True  # Tasks werden erst nach Completion acknowledged
 CELERY_TASK_REJECT_ON_WORKER_LOST = True  # Rejected tasks bei Worker-Verlust
 CELERY_TASK_IGNORE_RESULT = False  # Behalte alle Ergebnisse für Debugging
+# Ergebnisse verfallen im Redis-Backend; große Extraktionen liegen ohnehin nur als Referenz dort (blob_store.py)
+CELERY_RESULT_EXPIRES = int(os.getenv('CELERY_RESULT_EXPIRES', 12 * 60 * 60))
 
 # Queue-Einstellungen mit Prioritäten
 CELERY_DEFAULT_QUEUE = 'default'
 CELERY_QUEUES = {
     'default': {'priority': 5},
     'pdf_processing': {'priority': 10},
-    'extraction': {'priority': 8, 'max_tasks_per_child': 30},
+    'extraction': {'priority': 8, 'max_tasks_per_child': 30},  # Alt-Queue, wird vom I/O-Pool noch geleert
+    'extraction_cpu': {'priority': 8},
+    'extraction_io': {'priority': 8},
     'refinement': {'priority': 6},
     'summary': {'priority': 4},
     'regenerate_report': {'priority': 3},
@@ -52,18 +58,45 @@ CELERY_QUEUES = {
     'icd_descriptions': {'priority': 1}
 }
 
+# Broker-Prioritäten (Redis): 0 = höchste, 9 = niedrigste Priorität.
+# Ohne priority_steps ignoriert Redis jede Priorität und arbeitet strikt FIFO.
+PRIORITY_STEPS = list(range(10))
+DEFAULT_TASK_PRIORITY = 5
+BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': PRIORITY_STEPS,
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+
+
+def queue_priority(queue):
+    """Übersetzt die Queue-Priorität aus CELERY_QUEUES (10 = wichtig) in eine Redis-Priorität"""
+    queue_settings = CELERY_QUEUES.get(queue, {})
+    if 'priority' not in queue_settings:
+        return DEFAULT_TASK_PRIORITY
+    return max(PRIORITY_STEPS[0], min(PRIORITY_STEPS[-1], 10 - queue_settings['priority']))
+
+
 # Routing-Einstellungen
 CELERY_ROUTES = {
     'tasks.process_pdfs': {'queue': 'pdf_processing'},
-    'tasks.convert_pdf_to_images': {'queue': 'extraction'},
-    'tasks.distribute_extraction_tasks': {'queue': 'extraction'},
-    'tasks.aggregate_extraction_results': {'queue': 'extraction'},
-    'tasks.extract_pdf_text': {'queue': 'extraction'},
-    'tasks.extract_ocr_optimized': {'queue': 'extraction'},
-    'tasks.extract_azure_vision_optimized': {'queue': 'extraction'},
-    #'tasks.extract_gemini_vision_optimized': {'queue': 'extraction'},
-    'tasks.extract_gpt4_vision_optimized': {'queue': 'extraction'},
-    'tasks.combine_extractions': {'queue': 'extraction'},
+    # CPU-lastige Stufen (poppler, tesseract, PyPDF2, tiktoken) laufen im Prefork-Pool
+    'tasks.convert_pdf_to_images': {'queue': 'extraction_cpu'},
+    'tasks.extract_pdf_text': {'queue': 'extraction_cpu'},
+    'tasks.extract_ocr_optimized': {'queue': 'extraction_cpu'},
+    'tasks.combine_extractions': {'queue': 'extraction_cpu'},
+    'tasks.assess_text_layer': {'queue': 'extraction_cpu'},
+    # Reine API-/I/O-Stufen laufen im Eventlet-Pool
+    'tasks.distribute_extraction_tasks': {'queue': 'extraction_io'},
+    'tasks.aggregate_extraction_results': {'queue': 'extraction_io'},
+    'tasks.cleanup_temp_file': {'queue': 'extraction_io'},
+    'tasks.clean_artifacts': {'queue': 'extraction_io'},
+    'tasks.escalate_extraction': {'queue': 'extraction_io'},
+    'tasks.extract_azure_vision_optimized': {'queue': 'extraction_io'},
+    'tasks.extract_gemini_vision_optimized': {'queue': 'extraction_io'},
+    'tasks.extract_gpt4_vision_optimized': {'queue': 'extraction_io'},
+    'tasks.extract_azure_vision_batch': {'queue': 'extraction_io'},
+    'tasks.extract_gpt4_vision_batch': {'queue': 'extraction_io'},
     'tasks.process_record': {'queue': 'refinement'},
     'tasks.create_report': {'queue': 'summary'},
     'tasks.regenerate_report_task': {'queue': 'regenerate_report'},
@@ -74,16 +107,55 @@ CELERY_ROUTES = {
     'tasks.update_medical_codes_descriptions': {'queue': 'icd_descriptions'}
 }
 
+# Basispriorität je Task aus seiner Queue; scheduling.task_priority passt sie pro Upload an
+for route in CELERY_ROUTES.values():
+    route.setdefault('priority', queue_priority(route['queue']))
+
+# Worker-Topologie: ein Pool pro Lastprofil (siehe start_workers.py)
+# - cpu: Prefork, ein Prozess pro Kern, blockiert keinen Event-Loop
+# - io:  Eventlet mit hoher Concurrency für API-Aufrufe und alle übrigen Queues
+WORKER_POOLS = {
+    'cpu': {
+        'pool': 'prefork',
+        'concurrency': int(os.getenv('CELERY_CPU_CONCURRENCY', os.cpu_count() or 2)),
+        'queues': ['extraction_cpu'],
+        'max_tasks_per_child': CELERYD_MAX_TASKS_PER_CHILD,
+        'prefetch_multiplier': 1,  # Lange CPU-Tasks nicht vorab reservieren
+    },
+    'io': {
+        'pool': 'eventlet',
+        'concurrency': int(os.getenv('CELERY_IO_CONCURRENCY', CELERYD_CONCURRENCY)),
+        # Reihenfolge = Abfragereihenfolge bei gleicher Priorität (queue_order_strategy)
+        'queues': [
+            'pdf_processing', 'extraction_io', 'extraction', 'medical_codes', 'refinement', 'default',
+            'summary', 'regenerate_report', 'notification', 'icd_descriptions'
+        ],
+        'max_tasks_per_child': CELERYD_MAX_TASKS_PER_CHILD,
+        # Vorab reservierte Nachrichten umgehen die Broker-Priorität, daher nur eine pro Slot
+        'prefetch_multiplier': 1,
+    },
+}
+
 # Beat-Schedule-Einstellungen
 CELERYBEAT_SCHEDULE = {
-    'send-notifications-every-minute': {
+    'send-notifications-fallback': {
+        # Versand wird bei Abschluss angestoßen (tasks.schedule_notifications); stündlich nur für Liegengebliebenes
         'task': 'tasks.send_notifications_task',
-        'schedule': crontab(minute='*/1'),  # Jede Minute
+        'schedule': crontab(minute=5),
     },
     'check-and-create-summaries': {
         'task': 'tasks.check_and_create_summaries',
         'schedule': crontab(minute='*/15'),  # Alle 15 Minuten
     },
+    'clean-artifacts': {
+        # Verwaiste Seitenbilder und Uploads, Plattenbudget (siehe artifacts.py)
+        'task': 'tasks.clean_artifacts',
+        'schedule': crontab(minute='*/10'),
+    },
+    'purge-extraction-checkpoints': {
+        'task': 'tasks.purge_extraction_checkpoints',
+        'schedule': crontab(hour=3, minute=30),  # Täglich nachts
+    },
 }
 
 
@@ -104,10 +176,13 @@ def create_celery_app(app=None):
         worker_concurrency=CELERYD_CONCURRENCY,
         task_queues=CELERY_QUEUES,
         task_routes=CELERY_ROUTES,
+        broker_transport_options=BROKER_TRANSPORT_OPTIONS,
+        task_default_priority=DEFAULT_TASK_PRIORITY,
         beat_schedule=CELERYBEAT_SCHEDULE,
         task_acks_late=CELERY_TASK_ACKS_LATE,
         task_reject_on_worker_lost=CELERY_TASK_REJECT_ON_WORKER_LOST,
-        task_ignore_result=CELERY_TASK_IGNORE_RESULT
+        task_ignore_result=CELERY_TASK_IGNORE_RESULT,
+        result_expires=CELERY_RESULT_EXPIRES
     )
 
     if app:
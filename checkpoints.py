@@ -0,0 +1,146 @@
+# checkpoints.py
+"""
+Seitenweise Checkpoints der Extraktoren.
+
+Jede fertig extrahierte Seite wird unter (Dokument-Hash, Extraktor, Seite) verschlüsselt in
+der Datenbank abgelegt. Wird ein Task wiederholt (Retry, Worker-Absturz mit acks_late) oder
+dasselbe PDF erneut hochgeladen, werden nur die noch fehlenden Seiten extrahiert.
+
+Leere Seiten werden nicht gespeichert: sie entstehen auch bei Timeouts und sollen beim
+nächsten Versuch erneut angefragt werden.
+"""
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from config import get_config
+from metrics import observe_checkpoint_pages, observe_page
+from models import db, ExtractionCheckpoint
+from usage import carry_context
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def checkpoints_enabled():
+    return str(get_config("EXTRACTION_CHECKPOINTS", "true")).lower() in ("1", "true", "yes")
+
+
+def checkpoint_retention_days():
+    return int(get_config("EXTRACTION_CHECKPOINT_DAYS", "7"))
+
+
+def document_hash(data):
+    """SHA-256 eines PDFs aus Bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(file_path):
+    """SHA-256 eines PDFs, blockweise gelesen"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_checkpoints(doc_hash, extractor, page_numbers=None):
+    """
+    Lädt die gespeicherten Seiten eines Extraktors.
+
+    :param page_numbers: Optional nur diese Seiten laden
+    :return: Dictionary {Seite: Text}
+    """
+    if not doc_hash or not checkpoints_enabled():
+        return {}
+    try:
+        from app import app
+        with app.app_context():
+            query = ExtractionCheckpoint.query.filter_by(document_hash=doc_hash, extractor=extractor)
+            if page_numbers is not None:
+                query = query.filter(ExtractionCheckpoint.page.in_(list(page_numbers)))
+            return {checkpoint.page: checkpoint.content for checkpoint in query.all()}
+    except Exception as e:
+        logger.warning(f"Checkpoints für {extractor} ({doc_hash[:12]}) nicht lesbar: {e}")
+        return {}
+
+
+def save_checkpoint(doc_hash, extractor, page, content):
+    """Speichert eine fertig extrahierte Seite (leere Seiten werden übersprungen)"""
+    if not doc_hash or not content or not str(content).strip() or not checkpoints_enabled():
+        return
+    try:
+        from app import app
+        with app.app_context():
+            try:
+                db.session.add(ExtractionCheckpoint(
+                    document_hash=doc_hash, extractor=extractor, page=page, content=content
+                ))
+                db.session.commit()
+            except IntegrityError:
+                # Parallel von einem anderen Task gespeichert
+                db.session.rollback()
+    except Exception as e:
+        logger.warning(f"Checkpoint {extractor} Seite {page} ({doc_hash[:12]}) nicht gespeichert: {e}")
+
+
+def extract_pages(doc_hash, extractor, page_numbers, load_images, page_func, max_workers=1):
+    """
+    Extrahiert Seiten mit Checkpoints: bereits gespeicherte Seiten werden übernommen, die
+    übrigen mit page_func(image, page_number) extrahiert und sofort gespeichert.
+    Fehler einzelner Seiten ergeben leeren Text.
+
+    :param load_images: Funktion, die die Bilder passend zu page_numbers liefert; wird nur
+                        aufgerufen, wenn noch Seiten fehlen
+    :return: Liste der Seitentexte in der Reihenfolge von page_numbers
+    """
+    page_numbers = list(page_numbers)
+    done = load_checkpoints(doc_hash, extractor, page_numbers)
+    if done:
+        logger.info(f"Checkpoints: {len(done)}/{len(page_numbers)} Seiten {extractor} bereits extrahiert")
+        observe_checkpoint_pages(extractor, len(done))
+    if len(done) == len(page_numbers):
+        return [done[number] for number in page_numbers]
+
+    def run_page(image, number):
+        start = time.perf_counter()
+        try:
+            text = page_func(image, number)
+        except Exception as page_exc:
+            observe_page(extractor, time.perf_counter() - start, ok=False)
+            logger.error(f"{extractor} failed for page {number}: {page_exc}")
+            return ""  # Leere Seite bei Fehler
+        observe_page(extractor, time.perf_counter() - start, ok=isinstance(text, str) and bool(text.strip()))
+        save_checkpoint(doc_hash, extractor, number, text)
+        return text
+
+    texts = dict(done)
+    pending = [(image, number) for image, number in zip(load_images(), page_numbers) if number not in done]
+    if max_workers <= 1:
+        for image, number in pending:
+            texts[number] = run_page(image, number)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(carry_context(run_page), image, number): number for image, number in pending}
+            for future in as_completed(futures):
+                texts[futures[future]] = future.result()
+    return [texts.get(number, "") for number in page_numbers]
+
+
+def purge_checkpoints(max_age_days=None):
+    """Löscht Checkpoints, die älter als die Aufbewahrungsfrist sind"""
+    max_age_days = checkpoint_retention_days() if max_age_days is None else max_age_days
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    from app import app
+    with app.app_context():
+        deleted = ExtractionCheckpoint.query.filter(
+            ExtractionCheckpoint.created_at < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    logger.info(f"Checkpoints: {deleted} Einträge älter als {max_age_days} Tage gelöscht")
+    return deleted
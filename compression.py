@@ -0,0 +1,243 @@
+# compression.py
+"""
+Komprimierte und verschlüsselte Blobs für große Textspalten (Datensatztext, Berichte).
+
+Verschlüsselter Text lässt sich nicht mehr komprimieren. EncryptedBlobType komprimiert daher
+zuerst (zstd, optional mit einem auf unser Extraktions-XML trainierten Dictionary; ohne das
+Paket zstandard mit zlib) und verschlüsselt danach mit AES-GCM (Schlüssel aus encryption.py).
+
+Format der Binärspalte:
+    Kopf    MAGIC (4 Bytes) | Codec (1 Byte) | Dictionary-ID (4 Bytes) | Chunkgröße (4 Bytes)
+    Chunks  je Länge (4 Bytes) | Nonce + Chiffrat + Tag
+
+Jeder Chunk (CHUNK_SIZE Bytes Klartext) wird einzeln komprimiert und verschlüsselt. Kopf,
+Chunk-Index und ein Ende-Kennzeichen sind als Associated Data gebunden, damit Chunks weder
+vertauscht noch abgeschnitten werden können. iter_text() entschlüsselt Chunk für Chunk,
+ohne den Gesamttext aufzubauen.
+
+Werte ohne MAGIC stammen aus EncryptedType und bleiben lesbar; migrate_encryption.py
+schreibt sie im neuen Format. Dictionaries werden mit train_compression_dictionary.py
+erzeugt und über BLOB_DICTIONARY_ID aktiviert. Sie müssen so lange aufbewahrt werden,
+wie Werte mit ihrer ID in der Datenbank liegen.
+"""
+import codecs
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from sqlalchemy import LargeBinary, select, type_coerce
+from sqlalchemy.types import TypeDecorator
+
+from config import get_config
+from encryption import AesGcmCipher, column_key, decrypt_value, get_cipher
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HSB1"
+HEADER = struct.Struct('>cII')
+HEADER_SIZE = len(MAGIC) + HEADER.size
+LENGTH = struct.Struct('>I')
+CHUNK_SIZE = 1024 * 1024
+
+CODEC_NONE = b'n'
+CODEC_ZLIB = b'd'
+CODEC_ZSTD = b'z'
+CODEC_NAMES = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+_local = threading.local()
+_dictionaries = {}
+_lock = threading.Lock()
+
+
+def dictionary_dir():
+    return get_config("BLOB_DICTIONARY_DIR", os.path.join('instance', 'compression'))
+
+
+def dictionary_path(dict_id):
+    return os.path.join(dictionary_dir(), f"{dict_id}.zdict")
+
+
+def write_codec():
+    """(Codec, Dictionary-ID) für neu geschriebene Werte"""
+    name = str(get_config("BLOB_COMPRESSION", "zstd")).lower()
+    codec = CODEC_NAMES.get(name, CODEC_ZSTD)
+    if codec == CODEC_ZSTD and zstandard is None:
+        codec = CODEC_ZLIB
+    dict_id = int(get_config("BLOB_DICTIONARY_ID", "0")) if codec == CODEC_ZSTD else 0
+    if dict_id and load_dictionary(dict_id) is None:
+        dict_id = 0
+    return codec, dict_id
+
+
+def load_dictionary(dict_id):
+    """zstd-Dictionary aus BLOB_DICTIONARY_DIR, einmal pro Prozess geladen"""
+    if dict_id in _dictionaries:
+        return _dictionaries[dict_id]
+    with _lock:
+        if dict_id not in _dictionaries:
+            try:
+                with open(dictionary_path(dict_id), 'rb') as f:
+                    _dictionaries[dict_id] = zstandard.ZstdCompressionDict(f.read())
+            except (OSError, AttributeError) as e:
+                logger.error(f"Kompressions-Dictionary {dict_id} nicht verfügbar: {e}")
+                _dictionaries[dict_id] = None
+    return _dictionaries[dict_id]
+
+
+def _zstd(kind, dict_id):
+    """ZstdCompressor/-Decompressor pro Thread (die Objekte sind nicht thread-sicher)"""
+    cache = getattr(_local, 'zstd', None)
+    if cache is None:
+        cache = _local.zstd = {}
+    key = (kind, dict_id)
+    if key not in cache:
+        dictionary = load_dictionary(dict_id) if dict_id else None
+        if dict_id and dictionary is None:
+            raise ValueError(f"Kompressions-Dictionary {dict_id} fehlt in {dictionary_dir()}")
+        if kind == 'c':
+            level = int(get_config("BLOB_ZSTD_LEVEL", "9"))
+            cache[key] = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        else:
+            cache[key] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return cache[key]
+
+
+def compress(codec, dict_id, data):
+    if codec == CODEC_ZSTD:
+        return _zstd('c', dict_id).compress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 6)
+    return bytes(data)
+
+
+def decompress(codec, dict_id, data):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Wert ist mit zstd komprimiert, das Paket zstandard ist nicht installiert")
+        return _zstd('d', dict_id).decompress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+
+def _associated_data(header, index, last):
+    return header + LENGTH.pack(index) + (b'\x01' if last else b'\x00')
+
+
+def is_blob(raw):
+    return isinstance(raw, (bytes, bytearray, memoryview)) and bytes(raw[:len(MAGIC)]) == MAGIC
+
+
+def blob_header(raw):
+    """(Codec, Dictionary-ID, Chunkgröße) eines Blobs"""
+    return HEADER.unpack_from(raw, len(MAGIC))
+
+
+def blob_is_current(raw):
+    """True, wenn ein gespeicherter Wert schon mit aktuellem Codec und Dictionary vorliegt"""
+    return is_blob(raw) and blob_header(raw)[:2] == write_codec()
+
+
+def encode_text(text, secret=None):
+    """Komprimiert und verschlüsselt einen Text chunkweise"""
+    secret = column_key() if secret is None else secret
+    cipher = get_cipher(AesGcmCipher.name, secret)
+    codec, dict_id = write_codec()
+    header = MAGIC + HEADER.pack(codec, dict_id, CHUNK_SIZE)
+    data = memoryview(text.encode('utf-8'))
+    offsets = range(0, len(data), CHUNK_SIZE) or [0]
+    parts = [header]
+    for index, offset in enumerate(offsets):
+        last = index == len(offsets) - 1
+        sealed = cipher.seal(compress(codec, dict_id, data[offset:offset + CHUNK_SIZE]),
+                             _associated_data(header, index, last))
+        parts.append(LENGTH.pack(len(sealed)))
+        parts.append(sealed)
+    return b''.join(parts)
+
+
+def iter_chunks(raw, secret=None):
+    """Liefert den Klartext eines Blobs chunkweise als Bytes"""
+    secret = column_key() if secret is None else secret
+    cipher = get_cipher(AesGcmCipher.name, secret)
+    raw = memoryview(raw)
+    header = bytes(raw[:HEADER_SIZE])
+    codec, dict_id, _ = blob_header(header)
+    offset = HEADER_SIZE
+    index = 0
+    while offset < len(raw):
+        (length,) = LENGTH.unpack_from(raw, offset)
+        offset += LENGTH.size
+        sealed = raw[offset:offset + length]
+        offset += length
+        yield decompress(codec, dict_id, cipher.open(sealed, _associated_data(header, index, offset >= len(raw))))
+        index += 1
+
+
+def iter_text(raw, secret=None):
+    """Liefert den Text eines Blobs chunkweise (UTF-8 über Chunkgrenzen hinweg dekodiert)"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in iter_chunks(raw, secret):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    rest = decoder.decode(b'', final=True)
+    if rest:
+        yield rest
+
+
+def decode_value(raw, secret=None):
+    """Text eines gespeicherten Werts: Blob oder Altbestand aus EncryptedType"""
+    if is_blob(raw):
+        return ''.join(iter_text(raw, secret))
+    return decrypt_value(raw, secret)
+
+
+def stream_text(model, column_name, row_id):
+    """
+    Liest eine Blob-Spalte einer Zeile roh aus der Datenbank und liefert den Text chunkweise,
+    z.B. für Downloads großer Datensätze ohne vollständige Kopie im Speicher.
+    """
+    from models import db
+    table = model.__table__
+    primary_key = table.primary_key.columns.values()[0]
+    raw = db.session.execute(
+        select(type_coerce(table.c[column_name], LargeBinary)).where(primary_key == row_id)
+    ).scalar()
+    if raw is None:
+        return
+    if is_blob(raw):
+        yield from iter_text(raw)
+    else:
+        yield decrypt_value(raw)
+
+
+class EncryptedBlobType(TypeDecorator):
+    """Textspalte, die komprimiert und verschlüsselt als Binärwert gespeichert wird"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, key=column_key, **kwargs):
+        super().__init__(**kwargs)
+        self.key = key
+
+    def _secret(self):
+        return self.key() if callable(self.key) else self.key
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_text(value if isinstance(value, str) else str(value), self._secret())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode_value(value, self._secret())
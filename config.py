@@ -1,142 +1,357 @@
 """
 Zentrale Konfiguration mit Azure Key Vault Integration
 
-Lädt alle Konfigurationswerte aus Azure Key Vault basierend auf der 
+Lädt alle Konfigurationswerte aus Azure Key Vault basierend auf der
 Umgebung (test oder prod), die in der .env Datei festgelegt ist.
+Die Werte werden erst beim ersten Zugriff geladen, nicht beim Import.
+
+Steuerung über Umgebungsvariablen (bzw. .env):
+    CONFIG_SOURCE           keyvault (Standard), env oder file
+    CONFIG_FILE             JSON-Datei für CONFIG_SOURCE=file (lokaler Stand-in, offline testbar)
+    CONFIG_SNAPSHOT_KEY     Fernet-Schlüssel für den verschlüsselten lokalen Snapshot;
+                            ohne Schlüssel wird kein Snapshot geschrieben oder gelesen.
+                            Erzeugen: python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+    CONFIG_SNAPSHOT_PATH    Pfad des Snapshots (Standard: instance/config_snapshot.enc)
+    CONFIG_REFRESH_SECONDS  TTL der Konfiguration; danach wird im Hintergrund neu geladen (Standard: 900, 0 = aus)
+
+Mit Snapshot startet ein Prozess sofort mit der letzten gültigen Konfiguration; Key Vault
+wird im Hintergrund abgefragt. Änderungen werden an registrierte Callbacks gemeldet.
 """
 import os
 import json
 import logging
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+import threading
+import time
 from dotenv import load_dotenv
 
-# Lade .env nur für ENVIRONMENT
+# Lade .env nur für ENVIRONMENT und die Steuerungsvariablen
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+REQUIRED_KEYS = [
+    'SECRET_KEY',
+    'MAIL_SERVER',
+    'OPENAI_API_KEY',
+    'AZURE_KEY_CREDENTIALS'
+]
+
+ENV_KEYS = [
+    'SECRET_KEY', 'MAIL_SERVER', 'MAIL_PORT', 'MAIL_USERNAME',
+    'MAIL_PASSWORD', 'MAIL_USE_TLS', 'MAIL_USE_SSL',
+    'OPENAI_API_KEY', 'OPENAI_MODEL',
+    'AZURE_KEY_CREDENTIALS', 'GEMINI_API_KEY', 'GEMINI_MODEL'
+]
+
 class Config:
     """Singleton für zentrale Konfiguration mit Azure Key Vault"""
-    
+
     _instance = None
     _config = {}
     _loaded = False
-    
+    _load_lock = threading.Lock()
+    _source = None
+    _loaded_at = 0.0
+    _env_fallback = False
+    _subscribers = []
+    _refresher_pid = None
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Config, cls).__new__(cls)
         return cls._instance
-    
-    def __init__(self):
+
+    def _ensure_loaded(self):
+        """Lädt die Konfiguration beim ersten Zugriff (einmal pro Prozess)"""
         if not self._loaded:
-            self._load_config()
-            self._loaded = True
-    
+            with self._load_lock:
+                if not self._loaded:
+                    self._initial_load()
+                    Config._loaded = True
+        self._ensure_refresher()
+
+    # ------------------------------------------------------------------
+    # Quellen
+    # ------------------------------------------------------------------
+
+    @property
+    def source(self):
+        return os.getenv('CONFIG_SOURCE', 'keyvault').lower()
+
+    @property
+    def refresh_seconds(self):
+        return int(os.getenv('CONFIG_REFRESH_SECONDS', '900'))
+
+    def _initial_load(self):
+        """Erster Ladevorgang: Snapshot (falls vorhanden), sonst direkt aus der Quelle"""
+        source = self.source
+        if source == 'env':
+            self._set_config(self._fetch_from_env(), 'env', notify=False)
+            Config._env_fallback = True
+            return
+        if source == 'file':
+            self._set_config(self._fetch_from_file(), 'file', notify=False)
+            return
+
+        snapshot = self._read_snapshot()
+        if snapshot is not None:
+            # Sofort starten, Key Vault wird im Hintergrund abgefragt
+            self._set_config(snapshot['config'], 'snapshot', notify=False)
+            Config._loaded_at = snapshot.get('fetched_at', 0.0)
+            logger.info(f"⚡ Configuration loaded from local snapshot ({len(self._config)} values)")
+            return
+
+        self._load_config()
+
     def _load_config(self):
         """Lädt Konfiguration aus Azure Key Vault"""
         try:
-            # Umgebung bestimmen (test oder prod)
-            environment = os.getenv('ENVIRONMENT', 'test').lower()
-            logger.info(f"🔧 Loading configuration for environment: {environment}")
-            
-            # Key Vault Setup
-            vault_url = "https://healthsum-vault.vault.azure.net/"
-            secret_name = f"healthsum-{environment}"
-            
-            # DefaultAzureCredential versucht automatisch:
-            # 1. Umgebungsvariablen (AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID)
-            # 2. Managed Identity (auf Azure VM)
-            # 3. Azure CLI (lokal)
-            # 4. Visual Studio Code
-            credential = DefaultAzureCredential()
-            client = SecretClient(vault_url=vault_url, credential=credential)
-            
-            # Lade Secret
-            logger.info(f"🔐 Fetching secret '{secret_name}' from Key Vault...")
-            secret = client.get_secret(secret_name)
-            
-            # Parse JSON
-            self._config = json.loads(secret.value)
-            logger.info(f"✅ Successfully loaded {len(self._config)} configuration values from Key Vault")
-            
-            # Validiere kritische Werte
-            required_keys = [
-                'SECRET_KEY', 
-                'MAIL_SERVER', 
-                'OPENAI_API_KEY', 
-                'AZURE_KEY_CREDENTIALS'
-            ]
-            missing_keys = [key for key in required_keys if key not in self._config]
-            if missing_keys:
-                raise ValueError(f"Missing required configuration keys: {missing_keys}")
-            
-            # Log geladene Keys (ohne Werte aus Sicherheitsgründen)
-            logger.info(f"📋 Loaded configuration keys: {', '.join(self._config.keys())}")
-            
+            self._set_config(self._fetch_from_keyvault(), 'keyvault', notify=False)
+            self._write_snapshot()
         except Exception as e:
             logger.error(f"❌ Failed to load configuration from Key Vault: {e}")
             logger.warning("⚠️  Falling back to environment variables")
             # Fallback auf Umgebungsvariablen
             self._load_from_env()
-    
+
+    def _fetch_from_keyvault(self):
+        """Holt die Konfiguration aus Azure Key Vault (blockierend)"""
+        from azure.identity import DefaultAzureCredential
+        from azure.keyvault.secrets import SecretClient
+
+        # Umgebung bestimmen (test oder prod)
+        environment = os.getenv('ENVIRONMENT', 'test').lower()
+        logger.info(f"🔧 Loading configuration for environment: {environment}")
+
+        # Key Vault Setup
+        vault_url = "https://healthsum-vault.vault.azure.net/"
+        secret_name = f"healthsum-{environment}"
+
+        # DefaultAzureCredential versucht automatisch:
+        # 1. Umgebungsvariablen (AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID)
+        # 2. Managed Identity (auf Azure VM)
+        # 3. Azure CLI (lokal)
+        # 4. Visual Studio Code
+        credential = DefaultAzureCredential()
+        client = SecretClient(vault_url=vault_url, credential=credential)
+
+        # Lade Secret
+        logger.info(f"🔐 Fetching secret '{secret_name}' from Key Vault...")
+        secret = client.get_secret(secret_name)
+
+        # Parse JSON
+        values = json.loads(secret.value)
+        logger.info(f"✅ Successfully loaded {len(values)} configuration values from Key Vault")
+
+        # Validiere kritische Werte
+        missing_keys = [key for key in REQUIRED_KEYS if key not in values]
+        if missing_keys:
+            raise ValueError(f"Missing required configuration keys: {missing_keys}")
+
+        # Log geladene Keys (ohne Werte aus Sicherheitsgründen)
+        logger.info(f"📋 Loaded configuration keys: {', '.join(values.keys())}")
+        return values
+
+    def _fetch_from_file(self):
+        """Lokaler Stand-in: Konfiguration aus einer JSON-Datei (CONFIG_FILE)"""
+        path = os.getenv('CONFIG_FILE', 'config.local.json')
+        with open(path, 'r') as f:
+            values = json.load(f)
+        logger.info(f"📋 Loaded {len(values)} values from config file {path}")
+        return values
+
+    def _fetch_from_env(self):
+        """Lädt die bekannten Keys aus Umgebungsvariablen"""
+        values = {key: os.getenv(key) for key in ENV_KEYS if os.getenv(key)}
+        logger.info(f"📋 Loaded {len(values)} values from environment variables")
+        return values
+
     def _load_from_env(self):
         """Fallback: Lädt Konfiguration aus Umgebungsvariablen"""
-        # Alle relevanten Keys
-        keys = [
-            'SECRET_KEY', 'MAIL_SERVER', 'MAIL_PORT', 'MAIL_USERNAME',
-            'MAIL_PASSWORD', 'MAIL_USE_TLS', 'MAIL_USE_SSL',
-            'OPENAI_API_KEY', 'OPENAI_MODEL',
-            'AZURE_KEY_CREDENTIALS', 'GEMINI_API_KEY', 'GEMINI_MODEL'
-        ]
-        
-        for key in keys:
-            value = os.getenv(key)
-            if value:
-                self._config[key] = value
-        
-        logger.info(f"📋 Loaded {len(self._config)} values from environment variables")
-    
+        self._set_config(self._fetch_from_env(), 'env', notify=False)
+        Config._env_fallback = True
+
+    def _set_config(self, values, source, notify=True):
+        """Übernimmt neue Werte und meldet geänderte Keys an die Subscriber"""
+        old_values = self._config
+        Config._config = dict(values)
+        Config._source = source
+        Config._loaded_at = time.time()
+        Config._env_fallback = False
+        if notify:
+            changed = {
+                key: Config._config.get(key)
+                for key in set(old_values) | set(Config._config)
+                if old_values.get(key) != Config._config.get(key)
+            }
+            if changed:
+                self._notify(changed)
+
+    # ------------------------------------------------------------------
+    # Verschlüsselter Snapshot
+    # ------------------------------------------------------------------
+
+    def _snapshot_cipher(self):
+        key = os.getenv('CONFIG_SNAPSHOT_KEY')
+        if not key:
+            return None
+        from cryptography.fernet import Fernet
+        return Fernet(key.encode() if isinstance(key, str) else key)
+
+    def _snapshot_path(self):
+        return os.getenv('CONFIG_SNAPSHOT_PATH', os.path.join('instance', 'config_snapshot.enc'))
+
+    def _read_snapshot(self):
+        """Liest den letzten gültigen Snapshot; None wenn nicht vorhanden oder ungültig"""
+        path = self._snapshot_path()
+        try:
+            cipher = self._snapshot_cipher()
+            if cipher is None or not os.path.exists(path):
+                return None
+            with open(path, 'rb') as f:
+                snapshot = json.loads(cipher.decrypt(f.read()))
+            if snapshot.get('environment') != os.getenv('ENVIRONMENT', 'test').lower():
+                logger.warning("⚠️  Config snapshot belongs to another environment - ignoring it")
+                return None
+            return snapshot
+        except Exception as e:
+            logger.warning(f"⚠️  Could not read config snapshot {path}: {e}")
+            return None
+
+    def _write_snapshot(self):
+        """Schreibt die aktuelle Konfiguration verschlüsselt und atomar auf die Platte"""
+        path = self._snapshot_path()
+        try:
+            cipher = self._snapshot_cipher()
+            if cipher is None:
+                return
+            payload = json.dumps({
+                'environment': os.getenv('ENVIRONMENT', 'test').lower(),
+                'fetched_at': self._loaded_at,
+                'config': self._config,
+            }).encode('utf-8')
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cipher.encrypt(payload))
+            os.replace(tmp_path, path)
+            logger.info(f"💾 Config snapshot written to {path}")
+        except Exception as e:
+            logger.warning(f"⚠️  Could not write config snapshot {path}: {e}")
+
+    # ------------------------------------------------------------------
+    # Hintergrund-Aktualisierung und Änderungs-Benachrichtigung
+    # ------------------------------------------------------------------
+
+    def _ensure_refresher(self):
+        """Startet pro Prozess (auch nach fork) einen Hintergrund-Thread für die Aktualisierung"""
+        if self.refresh_seconds <= 0 or self.source == 'env' or Config._refresher_pid == os.getpid():
+            return
+        with self._load_lock:
+            if Config._refresher_pid == os.getpid():
+                return
+            Config._refresher_pid = os.getpid()
+            thread = threading.Thread(target=self._refresh_loop, name='config-refresh', daemon=True)
+            thread.start()
+
+    def _refresh_loop(self):
+        # Ein aus dem Snapshot geladener Stand wird sofort aktualisiert, danach im TTL-Takt
+        if self._source != 'snapshot':
+            time.sleep(self.refresh_seconds)
+        while True:
+            self.refresh()
+            time.sleep(self.refresh_seconds)
+
+    def refresh(self):
+        """
+        Lädt die Konfiguration neu aus der Quelle. Bei Fehlern bleibt der bisherige Stand erhalten.
+
+        Returns:
+            True bei Erfolg, sonst False
+        """
+        try:
+            if self.source == 'file':
+                values, source = self._fetch_from_file(), 'file'
+            elif self.source == 'env':
+                values, source = self._fetch_from_env(), 'env'
+            else:
+                values, source = self._fetch_from_keyvault(), 'keyvault'
+        except Exception as e:
+            logger.warning(f"⚠️  Config refresh failed, keeping current values ({self._source}): {e}")
+            return False
+        with self._load_lock:
+            self._set_config(values, source)
+            Config._loaded = True
+        if source == 'keyvault':
+            self._write_snapshot()
+        return True
+
+    def subscribe(self, callback):
+        """
+        Registriert einen Callback für Konfigurationsänderungen.
+
+        Args:
+            callback: Funktion, die ein Dictionary {key: neuer Wert} der geänderten Keys erhält
+        """
+        Config._subscribers.append(callback)
+
+    def _notify(self, changed):
+        logger.info(f"🔄 Configuration changed: {', '.join(sorted(changed))}")
+        for callback in list(self._subscribers):
+            try:
+                callback(changed)
+            except Exception as e:
+                logger.error(f"❌ Config change callback {callback} failed: {e}")
+
     def get(self, key, default=None):
         """
         Holt einen Konfigurationswert
-        
+
         Args:
             key: Der Schlüssel der Konfiguration
             default: Standardwert falls Key nicht existiert
-            
+
         Returns:
             Der Konfigurationswert oder default
         """
-        return self._config.get(key, default)
-    
+        self._ensure_loaded()
+        value = self._config.get(key)
+        if value is None and self._env_fallback:
+            # Env-Quelle: auch optionale Keys direkt aus der Umgebung lesen
+            value = os.getenv(key)
+        return default if value is None else value
+
     def get_all(self):
         """Gibt alle Konfigurationswerte zurück (Kopie)"""
+        self._ensure_loaded()
         return self._config.copy()
-    
+
     def __getitem__(self, key):
         """Ermöglicht dict-ähnlichen Zugriff: config['KEY']"""
+        self._ensure_loaded()
         if key not in self._config:
             raise KeyError(f"Configuration key '{key}' not found")
         return self._config[key]
-    
+
     def __contains__(self, key):
         """Ermöglicht 'in' Operator: 'KEY' in config"""
+        self._ensure_loaded()
         return key in self._config
 
 
-# Singleton-Instanz
+# Singleton-Instanz (lädt erst beim ersten Zugriff)
 config = Config()
 
 # Hilfsfunktionen für einfachen Zugriff
 def get_config(key, default=None):
     """
     Holt einen Konfigurationswert aus Azure Key Vault
-    
+
     Args:
         key: Der Schlüssel der Konfiguration
         default: Standardwert falls Key nicht existiert
-        
+
     Returns:
         Der Konfigurationswert oder default
     """
@@ -146,3 +361,6 @@ def get_all_config():
     """Gibt alle Konfigurationswerte zurück"""
     return config.get_all()
 
+def subscribe_config_changes(callback):
+    """Registriert einen Callback, der bei geänderten Konfigurationswerten aufgerufen wird"""
+    config.subscribe(callback)
@@ -0,0 +1,208 @@
+# encryption.py
+"""
+Verschlüsselung der sensiblen Datenbankspalten.
+
+Alle EncryptedType-Spalten in models.py nutzen ColumnEngine. Gegenüber dem bisherigen
+AesEngine (AES-CBC, PKCS5, pro Wert neu abgeleiteter Schlüssel) gilt:
+    - Der Schlüssel wird pro Prozess einmal aus SECRET_KEY abgeleitet (HKDF-SHA256) und
+      gecacht; der Schlüssel-Callable braucht keinen App-Kontext mehr.
+    - Neue Werte werden mit AES-GCM (authentifiziert, zufällige Nonce) geschrieben und tragen
+      das Präfix "g1:". Werte ohne Präfix sind Altbestand (AES-CBC) und bleiben lesbar.
+    - Die schreibende Engine ist über COLUMN_ENCRYPTION_ENGINE wählbar ("aesgcm" oder
+      "aes-cbc" für den alten Stand, z.B. während eines Rollbacks).
+
+Mit migrate_encryption.py werden vorhandene Zeilen online auf AES-GCM umgeschlüsselt.
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from sqlalchemy_utils.types.encrypted.encrypted_type import EncryptionDecryptionBaseEngine, InvalidCiphertextError
+
+from config import get_config, subscribe_config_changes
+
+logger = logging.getLogger(__name__)
+
+GCM_PREFIX = "g1:"
+GCM_NONCE_BYTES = 12
+HKDF_INFO = b"healthsum column encryption v1"
+DEFAULT_ENGINE = 'aesgcm'
+
+_lock = threading.Lock()
+_ciphers = {}
+
+
+def column_key():
+    """Schlüssel-Callable für EncryptedType (ohne Flask-App-Kontext)"""
+    return get_config("SECRET_KEY")
+
+
+def _secret_bytes(secret):
+    return secret.encode() if isinstance(secret, str) else secret
+
+
+class AesGcmCipher:
+    """AES-256-GCM mit per HKDF abgeleitetem Schlüssel; Ausgabe: Präfix + base64(Nonce + Chiffrat + Tag)"""
+
+    name = 'aesgcm'
+
+    def __init__(self, secret):
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=HKDF_INFO).derive(_secret_bytes(secret))
+        self.aead = AESGCM(key)
+
+    def seal(self, data, associated_data=None):
+        """Binärformat: Nonce + Chiffrat + Tag"""
+        nonce = os.urandom(GCM_NONCE_BYTES)
+        return nonce + self.aead.encrypt(nonce, data, associated_data)
+
+    def open(self, raw, associated_data=None):
+        try:
+            return self.aead.decrypt(raw[:GCM_NONCE_BYTES], raw[GCM_NONCE_BYTES:], associated_data)
+        except InvalidTag:
+            raise InvalidCiphertextError()
+
+    def encrypt(self, data):
+        return GCM_PREFIX + base64.b64encode(self.seal(data)).decode('ascii')
+
+    def decrypt(self, value):
+        return self.open(base64.b64decode(value[len(GCM_PREFIX):]))
+
+
+class LegacyAesCipher:
+    """Bisheriges Format von sqlalchemy_utils.AesEngine ('pkcs5'): AES-CBC, IV aus dem Schlüssel"""
+
+    name = 'aes-cbc'
+
+    def __init__(self, secret):
+        key = hashlib.sha256(_secret_bytes(secret)).digest()
+        self.cipher = Cipher(algorithms.AES(key), modes.CBC(key[:16]))
+
+    def encrypt(self, data):
+        padder = padding.PKCS7(128).padder()
+        encryptor = self.cipher.encryptor()
+        padded = padder.update(data) + padder.finalize()
+        return base64.b64encode(encryptor.update(padded) + encryptor.finalize()).decode('ascii')
+
+    def decrypt(self, value):
+        decryptor = self.cipher.decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+        padded = decryptor.update(base64.b64decode(value)) + decryptor.finalize()
+        try:
+            return unpadder.update(padded) + unpadder.finalize()
+        except ValueError:
+            raise ValueError('Invalid decryption key')
+
+
+CIPHERS = {cipher.name: cipher for cipher in (AesGcmCipher, LegacyAesCipher)}
+
+
+def get_cipher(name, secret):
+    """Cipher pro (Engine, Schlüssel) einmal pro Prozess erstellen"""
+    cache_key = (name, secret)
+    cipher = _ciphers.get(cache_key)
+    if cipher is None:
+        with _lock:
+            cipher = _ciphers.get(cache_key)
+            if cipher is None:
+                cipher = CIPHERS[name](secret)
+                _ciphers[cache_key] = cipher
+    return cipher
+
+
+_write_engine = None
+
+
+def write_engine():
+    """Engine für neu geschriebene Werte (COLUMN_ENCRYPTION_ENGINE)"""
+    global _write_engine
+    if _write_engine is None:
+        name = str(get_config("COLUMN_ENCRYPTION_ENGINE", DEFAULT_ENGINE)).lower()
+        if name not in CIPHERS:
+            logger.warning(f"Unbekannte COLUMN_ENCRYPTION_ENGINE '{name}' - verwende {DEFAULT_ENGINE}")
+            name = DEFAULT_ENGINE
+        _write_engine = name
+    return _write_engine
+
+
+def is_current(value):
+    """True, wenn ein gespeicherter Wert bereits im Format der schreibenden Engine vorliegt"""
+    if isinstance(value, bytes):
+        value = value.decode('ascii', errors='replace')
+    return value.startswith(GCM_PREFIX) == (write_engine() == AesGcmCipher.name)
+
+
+def _to_text(value):
+    # Wie sqlalchemy_utils: Nicht-Strings werden per repr() gespeichert
+    return value if isinstance(value, str) else repr(value)
+
+
+def encrypt_value(value, secret=None):
+    secret = column_key() if secret is None else secret
+    return get_cipher(write_engine(), secret).encrypt(_to_text(value).encode())
+
+
+def decrypt_value(value, secret=None):
+    """Entschlüsselt einen gespeicherten Wert beider Formate"""
+    secret = column_key() if secret is None else secret
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    name = AesGcmCipher.name if value.startswith(GCM_PREFIX) else LegacyAesCipher.name
+    decrypted = get_cipher(name, secret).decrypt(value)
+    try:
+        return decrypted.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError('Invalid decryption key')
+
+
+def encrypt_many(values, secret=None):
+    """Verschlüsselt eine Liste von Werten (None bleibt None) mit einmal aufgelöstem Cipher"""
+    secret = column_key() if secret is None else secret
+    cipher = get_cipher(write_engine(), secret)
+    return [None if value is None else cipher.encrypt(_to_text(value).encode()) for value in values]
+
+
+def decrypt_many(values, secret=None):
+    """Entschlüsselt eine Liste gespeicherter Werte (gemischte Formate möglich)"""
+    secret = column_key() if secret is None else secret
+    return [None if value is None else decrypt_value(value, secret) for value in values]
+
+
+class ColumnEngine(EncryptionDecryptionBaseEngine):
+    """
+    Engine für sqlalchemy_utils.EncryptedType.
+
+    EncryptedType ruft vor jedem Wert _update_key() auf; anders als bei AesEngine wird dabei
+    kein Schlüssel abgeleitet und kein Cipher-Objekt erstellt.
+    """
+
+    def __init__(self):
+        self._secret = None
+
+    def _update_key(self, key):
+        # Keine Ableitung pro Wert: der Cipher wird über get_cipher() pro Schlüssel gecacht
+        self._secret = key
+
+    def encrypt(self, value):
+        return encrypt_value(value, self._secret)
+
+    def decrypt(self, value):
+        return decrypt_value(value, self._secret)
+
+
+def _on_config_change(changed):
+    global _write_engine
+    if 'COLUMN_ENCRYPTION_ENGINE' in changed:
+        _write_engine = None
+    if 'SECRET_KEY' in changed:
+        with _lock:
+            _ciphers.clear()
+
+
+subscribe_config_changes(_on_config_change)
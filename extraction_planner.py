@@ -0,0 +1,118 @@
+# extraction_planner.py
+"""
+Adaptive Auswahl der Extraktoren pro Seite.
+
+Im Modus EXTRACTION_MODE=adaptive (Standard) wird zuerst die Textebene des PDFs (PdfReader)
+pro Seite bewertet:
+    - gute Seiten (digital erzeugt) werden nur mit dem PDF-Text übernommen,
+    - schwache oder leere Seiten gehen an OCR (tesseract),
+    - an die Vision-APIs (Azure, GPT-4) gehen nur Seiten, bei denen auch OCR schwach ist
+      oder PDF-Text und OCR deutlich voneinander abweichen.
+
+Bei digital erzeugten PDFs entfallen damit praktisch alle API-Aufrufe. EXTRACTION_MODE=full
+schickt wie bisher jede Seite an alle Extraktoren.
+"""
+import re
+
+from config import get_config
+
+MODE_FULL = 'full'
+MODE_ADAPTIVE = 'adaptive'
+
+# Ab dieser Zeichenzahl gilt eine Seite als vollständig abgedeckt
+FULL_COVERAGE_CHARS = 400
+# Zeichen, die in normalem (deutschem) Text vorkommen
+SANE_CHARS = re.compile(r"[\wÄÖÜäöüß\s.,;:!?()\[\]/%&+\-–'\"„“§°*=<>@#€$]")
+WORD_PATTERN = re.compile(r"[A-Za-zÄÖÜäöüß]{2,}")
+# Typische Artefakte kaputter Textebenen (fehlende ToUnicode-Maps, Ersatzzeichen)
+GARBAGE_PATTERN = re.compile(r"\(cid:\d+\)|�|[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def extraction_mode():
+    mode = str(get_config("EXTRACTION_MODE", MODE_ADAPTIVE)).lower()
+    return mode if mode in (MODE_FULL, MODE_ADAPTIVE) else MODE_ADAPTIVE
+
+
+def good_score():
+    """Mindestbewertung, ab der eine Seite ohne weitere Extraktoren übernommen wird"""
+    return float(get_config("EXTRACTION_GOOD_SCORE", "0.75"))
+
+
+def min_agreement():
+    """Mindest-Übereinstimmung von PDF-Text und OCR, sonst wird an Vision eskaliert"""
+    return float(get_config("EXTRACTION_MIN_AGREEMENT", "0.5"))
+
+
+def escalation_extractors():
+    """Vision-Extraktoren für eskalierte Seiten (Komma-getrennt)"""
+    value = get_config("EXTRACTION_ESCALATION", "azure_vision,gpt4_vision")
+    return [name.strip() for name in str(value).split(',') if name.strip()]
+
+
+def text_quality(text):
+    """
+    Plausibilität eines Textes unabhängig von seiner Länge (0..1): Anteil normaler Zeichen,
+    Anteil echter Wörter und Artefakte kaputter Textebenen.
+    """
+    if not text or not text.strip():
+        return 0.0
+    stripped = text.strip()
+    length = len(stripped)
+    sanity = len(SANE_CHARS.findall(stripped)) / length
+    word_chars = sum(len(word) for word in WORD_PATTERN.findall(stripped))
+    word_ratio = min(1.0, word_chars / max(1, len(re.sub(r"\s", "", stripped))) / 0.6)
+    garbage_penalty = min(1.0, len(GARBAGE_PATTERN.findall(stripped)) * 20 / length)
+    return round(max(0.0, min(1.0, (0.4 * sanity + 0.6 * word_ratio) * (1 - garbage_penalty))), 3)
+
+
+def score_page_text(text):
+    """
+    Bewertet die Textebene einer Seite zwischen 0 (leer/unbrauchbar) und 1 (sauberer Volltext).
+    Kurze Texte werden abgewertet, da gescannte Seiten oft nur Stempel o.ä. als Text enthalten.
+    """
+    if not text or not text.strip():
+        return 0.0
+    coverage = min(1.0, len(text.strip()) / FULL_COVERAGE_CHARS)
+    return round(coverage * text_quality(text), 3)
+
+
+def text_agreement(first, second):
+    """Übereinstimmung zweier Texte als Jaccard-Ähnlichkeit der Wortmengen (0..1)"""
+    first_words = {word.lower() for word in WORD_PATTERN.findall(first or "")}
+    second_words = {word.lower() for word in WORD_PATTERN.findall(second or "")}
+    if not first_words and not second_words:
+        return 1.0
+    if not first_words or not second_words:
+        return 0.0
+    return len(first_words & second_words) / len(first_words | second_words)
+
+
+def pages_needing_ocr(text_scores):
+    """Seiten, deren Textebene nicht gut genug ist"""
+    threshold = good_score()
+    return [page for page, score in enumerate(text_scores) if score < threshold]
+
+
+def pages_needing_vision(page_texts, ocr_texts):
+    """
+    Entscheidet nach OCR, welche Seiten an die Vision-APIs eskaliert werden.
+
+    :param page_texts: PDF-Text pro Seite (Liste über alle Seiten)
+    :param ocr_texts: Dictionary {Seite: OCR-Text} der OCR-Seiten
+    :return: Sortierte Liste der zu eskalierenden Seiten
+    """
+    threshold = good_score()
+    agreement = min_agreement()
+    escalate = []
+    for page, ocr_text in ocr_texts.items():
+        pdf_text = page_texts[page] if page < len(page_texts) else ""
+        if not (ocr_text or "").strip() and not (pdf_text or "").strip():
+            continue  # Leerseite
+        # OCR liest nur Unleserliches (z.B. Handschrift)
+        if text_quality(ocr_text) < threshold:
+            escalate.append(page)
+            continue
+        # Textebene vorhanden, aber OCR liest etwas anderes: die Extraktoren widersprechen sich
+        if (pdf_text or "").strip() and text_agreement(pdf_text, ocr_text) < agreement:
+            escalate.append(page)
+    return sorted(escalate)
@@ -2,21 +2,17 @@
 from dotenv import load_dotenv
 from abc import ABC, abstractmethod
 from PyPDF2 import PdfReader
-import pytesseract
 import pdf2image
 import base64
 import io
 import json
-from azure.ai.vision.imageanalysis import ImageAnalysisClient
-from azure.ai.vision.imageanalysis.models import VisualFeatures
-from azure.core.credentials import AzureKeyCredential
-from openai import OpenAI
-import google.generativeai as genai
 import os
+import time
 import xml.etree.ElementTree as ET
 import re
 from flask_sqlalchemy import SQLAlchemy
-from config import get_config
+from metrics import observe_page
+from providers import get_openai_client, get_openai_model, get_vision_client, get_gemini_model, EXTRACTION_OPENAI_MAX_RETRIES
 
 # Lade .env nur für ENVIRONMENT
 load_dotenv()
@@ -25,23 +21,7 @@ load_dotenv()
 import logging
 logger = logging.getLogger(__name__)
 
-# Initialisierung der Clients mit Azure Key Vault Config
-vision_azure_client = ImageAnalysisClient(
-    credential=AzureKeyCredential(get_config("AZURE_KEY_CREDENTIALS")),
-    endpoint="https://benda-vision.cognitiveservices.azure.com/",
-)
-
-openai_client = OpenAI(api_key=get_config("OPENAI_API_KEY"))
-openai_model = get_config("OPENAI_MODEL")
-
-logger.info("EXTRACTORS DEBUG: Configuring Gemini...")
-genai.configure(api_key=get_config("GEMINI_API_KEY"))
-logger.info("EXTRACTORS DEBUG: Creating Gemini model...")
-# Verwende das Modell aus dem Key Vault (z.B. gemini-2.0-flash-exp)
-gemini_model_name = get_config("GEMINI_MODEL")  # Kein Fallback - muss im Key Vault sein
-logger.info(f"EXTRACTORS DEBUG: Using Gemini model: {gemini_model_name}")
-gemini_model = genai.GenerativeModel(gemini_model_name)
-logger.info(f"EXTRACTORS DEBUG: Gemini model created, type: {type(gemini_model)}")
+# Die API-Clients (OpenAI, Azure Vision, Gemini) kommen lazy aus der Provider-Registry (providers.py)
 
 db = SQLAlchemy()
 
@@ -51,28 +31,44 @@ class Extractor(ABC):
     def extract(self, file_path):
         pass
 
-    def create_structured_output(self, method, file_name, page_texts):
+    def create_structured_output(self, method, file_name, page_texts, page_numbers=None):
+        """
+        Baut das Extraktions-XML.
+
+        :param page_numbers: Seitennummern zu page_texts (z.B. beim Zusammensetzen von
+                             Seiten-Batches); Standard ist 0..n-1
+        """
+        if page_numbers is None:
+            page_numbers = range(len(page_texts))
         root = ET.Element("extraction", method=method)
         doc = ET.SubElement(root, "document", title=file_name)
-        for i, text in enumerate(page_texts):
-            page = ET.SubElement(doc, "page", number=str(i))
+        for number, text in zip(page_numbers, page_texts):
+            page = ET.SubElement(doc, "page", number=str(number))
             page.text = text
         return ET.tostring(root, encoding="unicode")
     
 
 class PDFTextExtractor(Extractor):
     def extract(self, file_path):
+        page_texts = self.extract_page_texts(file_path)
+        return self.create_structured_output("pdf_text", os.path.basename(file_path), page_texts)
+
+    def extract_page_texts(self, file_path):
+        """Textebene des PDFs als Liste pro Seite"""
         page_texts = []
         with open(file_path, 'rb') as file:
             pdf_reader = PdfReader(file)
             for page in pdf_reader.pages:
+                start = time.perf_counter()
                 page_texts.append(page.extract_text())
-        return self.create_structured_output("pdf_text", os.path.basename(file_path), page_texts)
+                observe_page("pdf_text", time.perf_counter() - start, ok=bool((page_texts[-1] or "").strip()))
+        return page_texts
 
 
 class OCRExtractor(Extractor):
     def extract(self, file_path):
         page_texts = []
+        import pytesseract
         images = pdf2image.convert_from_path(file_path)
         for image in images:
             page_text = pytesseract.image_to_string(image, lang='deu')
@@ -89,7 +85,8 @@ class AzureVisionExtractor(Extractor):
         seiten = pdf2image.convert_from_bytes(pdf_bytes)
         for seite in seiten:
             image_stream = self.seite_zu_image_stream(seite)
-            result = vision_azure_client.analyze(
+            from azure.ai.vision.imageanalysis.models import VisualFeatures
+            result = get_vision_client().analyze(
                 image_data=image_stream,
                 visual_features=[VisualFeatures.READ]
             )
@@ -117,8 +114,8 @@ class GPT4VisionExtractor(Extractor):
         seiten = pdf2image.convert_from_bytes(pdf_bytes)
         for seite in seiten:
             base64_image = self.seite_zu_base64(seite)
-            response = openai_client.chat.completions.create(
-                model=openai_model,
+            response = get_openai_client(max_retries=EXTRACTION_OPENAI_MAX_RETRIES).chat.completions.create(
+                model=get_openai_model(),
                 messages=[
                     {
                         "role": "user",
@@ -166,7 +163,6 @@ class GeminiVisionExtractor(Extractor):
         import logging
         self.logger = logging.getLogger(__name__)
         self.logger.info("GEMINI EXTRACTOR DEBUG: Initializing GeminiVisionExtractor")
-        self.logger.info(f"GEMINI EXTRACTOR DEBUG: gemini_model type: {type(gemini_model)}")
         
     def extract(self, file_path):
         self.logger.info(f"GEMINI EXTRACTOR DEBUG: extract called with file_path: {file_path}")
@@ -186,7 +182,7 @@ class GeminiVisionExtractor(Extractor):
             
             try:
                 self.logger.info(f"GEMINI EXTRACTOR DEBUG: Calling gemini_model.generate_content for image {i}")
-                response = gemini_model.generate_content([
+                response = get_gemini_model(safety_settings=None).generate_content([
                     {
                         "mime_type": "image/jpeg",
                         "data": img_bytes.read()
@@ -204,59 +200,52 @@ class GeminiVisionExtractor(Extractor):
 
 
 class CodeExtractor(Extractor):
+    CODE_TYPES = ('ICD10', 'ICD11', 'OPS')
+
     def __init__(self):
-        self.pattern = r"\b([A-Z]\d{1,2}(\.\d+)?|[A-Z]{2}\d{2}(\.\d+)?|\d-\d{3}(\.\d+)?|\d-\d{3}[a-z]?)\b"
-    
-    def extract(self, text):
+        self.pattern = re.compile(r"\b([A-Z]\d{1,2}(\.\d+)?|[A-Z]{2}\d{2}(\.\d+)?|\d-\d{3}(\.\d+)?|\d-\d{3}[a-z]?)\b")
+        self.type_patterns = (
+            ('ICD10', re.compile(r"[A-Z]\d{2}")),      # ICD-10 Format
+            ('ICD11', re.compile(r"[A-Z]{2}\d{2}")),   # ICD-11 Format
+            ('OPS', re.compile(r"\d-\d{3}")),         # OPS Format
+        )
+
+    def extract_codes(self, text):
+        """
+        Extrahiert die Codes als kompakte Liste von Dictionaries.
+
+        Das Ergebnis ist direkt JSON-serialisierbar (Celery-Result) und kann ohne
+        XML-Umweg an save_medical_codes übergeben werden.
+
+        :param text: Der zu durchsuchende Text
+        :return: Liste von Dictionaries mit 'code' und 'type' Keys (ohne Duplikate)
+        """
         if not isinstance(text, str):
             raise ValueError("Input must be a string")
-            
-        # Codes extrahieren
-        codes = re.findall(self.pattern, text)
-        
-        # Nur die Hauptgruppe der Matches extrahieren
-        extracted_codes = [match[0] for match in codes]
-        
-        # Entferne Duplikate durch Umwandlung in ein Set und zurück in eine Liste
-        extracted_codes = list(set(extracted_codes))
-        
-        # Gruppiere die Codes nach ihrem Typ
-        icd10_codes = []
-        icd11_codes = []
-        ops_codes = []
-        
+
+        # Nur die Hauptgruppe der Matches, Duplikate über dict.fromkeys entfernen (stabile Reihenfolge)
+        extracted_codes = dict.fromkeys(match.group(1) for match in self.pattern.finditer(text))
+
+        codes = []
         for code in extracted_codes:
-            if re.match(r"[A-Z]\d{2}", code):  # ICD-10 Format
-                icd10_codes.append(code)
-            elif re.match(r"[A-Z]{2}\d{2}", code):  # ICD-11 Format
-                icd11_codes.append(code)
-            elif re.match(r"\d-\d{3}", code):  # OPS Format
-                ops_codes.append(code)
-        
-        # Entferne Duplikate in den einzelnen Code-Listen (für zusätzliche Sicherheit)
-        icd10_codes = list(set(icd10_codes))
-        icd11_codes = list(set(icd11_codes))
-        ops_codes = list(set(ops_codes))
-        
+            for code_type, type_pattern in self.type_patterns:
+                if type_pattern.match(code):
+                    codes.append({'code': code, 'type': code_type})
+                    break
+        return codes
+
+    def extract(self, text):
+        """Legacy-Ausgabe als XML-String - bevorzugt extract_codes verwenden"""
+        codes = self.extract_codes(text)
+
         # Erstelle strukturierte XML-Ausgabe
         root = ET.Element("extraction", method="code_extraction")
-        
-        if icd10_codes:
-            icd10_elem = ET.SubElement(root, "icd10_codes")
-            for code in icd10_codes:
-                code_elem = ET.SubElement(icd10_elem, "code")
-                code_elem.text = code
-                
-        if icd11_codes:
-            icd11_elem = ET.SubElement(root, "icd11_codes")
-            for code in icd11_codes:
-                code_elem = ET.SubElement(icd11_elem, "code")
-                code_elem.text = code
-                
-        if ops_codes:
-            ops_elem = ET.SubElement(root, "ops_codes")
-            for code in ops_codes:
-                code_elem = ET.SubElement(ops_elem, "code")
-                code_elem.text = code
-        
-        return ET.tostring(root, encoding="unicode")
\ No newline at end of file
+        for code_type, tag in (('ICD10', 'icd10_codes'), ('ICD11', 'icd11_codes'), ('OPS', 'ops_codes')):
+            typed_codes = [item['code'] for item in codes if item['type'] == code_type]
+            if typed_codes:
+                type_elem = ET.SubElement(root, tag)
+                for code in typed_codes:
+                    code_elem = ET.SubElement(type_elem, "code")
+                    code_elem.text = code
+
+        return ET.tostring(root, encoding="unicode")
@@ -0,0 +1,196 @@
+# ingestion.py
+"""
+Streaming-Ablage hochgeladener PDFs.
+
+Uploads werden blockweise in eine temporäre Datei im Upload-Ordner kopiert; dabei werden
+SHA-256 und Größe mitgerechnet und zu große Dateien sofort abgebrochen, ohne das PDF
+komplett in den Speicher zu laden. Die fertige Datei wird atomar nach
+uploads/<sha256>/<dateiname> verschoben (inhaltsadressiert): gleichnamige Dateien
+verschiedener Uploads kollidieren nicht mehr, identische Uploads liegen nur einmal auf der Platte.
+
+An process_pdfs wird der Pfad relativ zum Upload-Ordner (<sha256>/<dateiname>) übergeben.
+Die Worker lesen das PDF direkt von der Platte und übernehmen den Hash aus dem
+Verzeichnisnamen, statt die Datei erneut einzulesen.
+
+Gleichzeitige Verarbeitungen desselben Inhalts teilen sich eine Datei. Redis zählt daher die
+Referenzen pro Datei; gelöscht wird erst beim Freigeben der letzten Referenz. Ist Redis nicht
+erreichbar, wird wie bisher direkt gelöscht.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from collections import namedtuple
+
+from werkzeug.utils import secure_filename
+
+from config import get_config
+from checkpoints import file_hash
+from providers import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_FOLDER = 'uploads'
+INCOMING_FOLDER = '.incoming'
+CHUNK_SIZE = 1024 * 1024
+PDF_MAGIC = b'%PDF-'
+HASH_DIR_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+REFS_KEY = 'healthsum:upload_refs:{path}'
+# Bleibt eine Verarbeitung hängen, verfällt die Referenz nach dieser Zeit
+REFS_TTL_SECONDS = 24 * 60 * 60
+
+IngestedFile = namedtuple('IngestedFile', ['path', 'name', 'sha256', 'size', 'page_count'])
+
+
+class UploadRejected(ValueError):
+    """Upload abgelehnt (ungültiges PDF oder Größenlimit überschritten)"""
+
+    def __init__(self, message, status_code=413):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def max_file_bytes():
+    return int(get_config("UPLOAD_MAX_FILE_MB", "100")) * 1024 * 1024
+
+
+def max_request_bytes():
+    """Obergrenze eines Requests (Flask MAX_CONTENT_LENGTH), greift vor dem Parsen"""
+    return int(get_config("UPLOAD_MAX_REQUEST_MB", "500")) * 1024 * 1024
+
+
+def max_pages():
+    return int(get_config("UPLOAD_MAX_PAGES", "1000"))
+
+
+def upload_path(relative_path, upload_folder=UPLOAD_FOLDER):
+    """Absoluter bzw. arbeitsverzeichnis-relativer Pfad einer abgelegten Datei"""
+    return os.path.join(upload_folder, relative_path)
+
+
+def display_name(relative_path):
+    """Dateiname ohne Hash-Verzeichnis (für Datensätze und Dokumenttitel)"""
+    return os.path.basename(relative_path)
+
+
+def content_hash(file_path):
+    """SHA-256 eines abgelegten PDFs: aus dem Verzeichnisnamen, bei Altdateien berechnet"""
+    directory = os.path.basename(os.path.dirname(file_path))
+    if HASH_DIR_PATTERN.match(directory):
+        return directory
+    return file_hash(file_path)
+
+
+def count_pages(file_path):
+    """Seitenzahl aus der Seitenstruktur des PDFs (ohne Seiten zu rendern)"""
+    from PyPDF2 import PdfReader
+    return len(PdfReader(file_path, strict=False).pages)
+
+
+def _stream_to_file(stream, target, limit):
+    """Kopiert den Upload blockweise, prüft Signatur und Größe und liefert (sha256, Größe)"""
+    digest = hashlib.sha256()
+    size = 0
+    first_chunk = True
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        if first_chunk:
+            if not chunk.lstrip().startswith(PDF_MAGIC):
+                raise UploadRejected("Datei ist kein PDF", status_code=400)
+            first_chunk = False
+        size += len(chunk)
+        if size > limit:
+            raise UploadRejected(f"Datei überschreitet {limit // (1024 * 1024)} MB")
+        digest.update(chunk)
+        target.write(chunk)
+    if size == 0:
+        raise UploadRejected("Datei ist leer", status_code=400)
+    return digest.hexdigest(), size
+
+
+def ingest_upload(file, upload_folder=UPLOAD_FOLDER):
+    """
+    Legt eine hochgeladene Datei inhaltsadressiert ab.
+
+    :param file: werkzeug FileStorage aus request.files
+    :return: IngestedFile mit dem relativen Pfad für process_pdfs
+    :raises UploadRejected: bei ungültigen oder zu großen Dateien
+    """
+    filename = secure_filename(file.filename or "")
+    if not filename.lower().endswith('.pdf'):
+        raise UploadRejected("Nur PDF-Dateien sind erlaubt", status_code=400)
+
+    incoming = os.path.join(upload_folder, INCOMING_FOLDER)
+    os.makedirs(incoming, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.part', dir=incoming)
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            sha256, size = _stream_to_file(file.stream, target, max_file_bytes())
+
+        try:
+            page_count = count_pages(temp_path)
+        except Exception as e:
+            raise UploadRejected(f"PDF nicht lesbar: {e}", status_code=400)
+        if page_count > max_pages():
+            raise UploadRejected(f"PDF hat {page_count} Seiten (maximal {max_pages()})")
+
+        relative_path = os.path.join(sha256, filename)
+        target_path = upload_path(relative_path, upload_folder)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        acquire_upload(relative_path)
+        if os.path.exists(target_path):
+            # Identischer Inhalt unter gleichem Namen liegt bereits vor
+            os.remove(temp_path)
+            logger.info(f"Upload {filename} ({sha256[:12]}) bereits vorhanden - wird wiederverwendet")
+        else:
+            os.replace(temp_path, target_path)
+            logger.info(f"Upload {filename} abgelegt: {size} Bytes, {page_count} Seiten ({sha256[:12]})")
+        return IngestedFile(relative_path, filename, sha256, size, page_count)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def acquire_upload(relative_path):
+    """Zählt eine Verarbeitung als Referenz auf die abgelegte Datei"""
+    try:
+        key = REFS_KEY.format(path=relative_path)
+        pipe = get_redis_client().pipeline()
+        pipe.incr(key)
+        pipe.expire(key, REFS_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Upload-Referenz für {relative_path} nicht gezählt: {e}")
+
+
+def release_upload(relative_path, upload_folder=UPLOAD_FOLDER):
+    """
+    Gibt eine Referenz frei und löscht die Datei, wenn sie niemand mehr verarbeitet.
+
+    :return: True, wenn die Datei gelöscht wurde
+    """
+    try:
+        key = REFS_KEY.format(path=relative_path)
+        client = get_redis_client()
+        remaining = client.decr(key)
+        if remaining > 0:
+            logger.info(f"Upload {relative_path} wird noch {remaining}x verarbeitet - nicht gelöscht")
+            return False
+        client.delete(key)
+    except Exception as e:
+        logger.warning(f"Upload-Referenz für {relative_path} nicht lesbar, Datei wird gelöscht: {e}")
+
+    file_path = upload_path(relative_path, upload_folder)
+    if not os.path.exists(file_path):
+        logger.warning(f"File not found for deletion: {file_path}")
+        return False
+    os.remove(file_path)
+    directory = os.path.dirname(file_path)
+    if HASH_DIR_PATTERN.match(os.path.basename(directory)):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass  # Weitere Dateien mit gleichem Inhalt
+    return True
@@ -0,0 +1,323 @@
+# metrics.py
+"""
+Prometheus-Metriken für Pipeline-Stufen, Queues und Provider.
+
+Erfasst werden:
+    - healthsum_task_duration_seconds / healthsum_tasks_in_flight / healthsum_task_retries_total
+      pro Celery-Task (über die Signal-Handler in tasks.py),
+    - healthsum_provider_request_seconds pro Provider, Aufrufart und Ergebnis (ok, rate_limited,
+      error), healthsum_provider_tokens_total, healthsum_provider_rate_limited_total und
+      healthsum_provider_retries_total (erfolgreiche Aufrufe werden zusätzlich in usage.py gebucht),
+    - healthsum_extractor_pages_total und healthsum_extractor_page_seconds pro Extraktor,
+    - healthsum_queue_depth pro Celery-Queue (beim Abruf per LLEN aus Redis gelesen),
+    - healthsum_artifact_bytes für Seitenbilder, Uploads und Ergebnis-Blobs auf der Platte (beim
+      Abruf gezählt, siehe artifacts.py) und healthsum_artifact_evicted_bytes_total für den Janitor.
+
+Die Web-App liefert alles unter /metrics aus, die Worker über einen eigenen HTTP-Exporter auf
+METRICS_WORKER_PORT (start_workers.py vergibt pro Pool einen Port). Damit die Werte der
+Prefork-Kindprozesse zusammengefasst werden, muss PROMETHEUS_MULTIPROC_DIR gesetzt sein
+(start_workers.py setzt es pro Pool; für gunicorn mit mehreren Workern selbst setzen).
+
+Ohne das Paket prometheus_client sind alle Metriken No-ops und /metrics liefert 404.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import usage
+from config import get_config
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+TASK_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+PROVIDER_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+PAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+
+# Provider, deren HTTP-Antworten direkt gezählt werden (auch vom SDK intern wiederholte 429)
+HTTP_INSTRUMENTED = {'openai'}
+
+
+class _NoopMetric:
+    """Platzhalter, wenn prometheus_client nicht installiert ist"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+def _metric(kind, name, documentation, labelnames, **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+TASK_DURATION = _metric('Histogram', 'healthsum_task_duration_seconds', "Laufzeit der Celery-Tasks",
+                        ['task', 'state'], buckets=TASK_BUCKETS)
+TASKS_IN_FLIGHT = _metric('Gauge', 'healthsum_tasks_in_flight', "Aktuell laufende Celery-Tasks",
+                          ['task'], multiprocess_mode='livesum')
+TASK_RETRIES = _metric('Counter', 'healthsum_task_retries_total', "Geplante Wiederholungen von Celery-Tasks", ['task'])
+
+PROVIDER_LATENCY = _metric('Histogram', 'healthsum_provider_request_seconds', "Dauer der Provider-Aufrufe",
+                           ['provider', 'operation', 'outcome'], buckets=PROVIDER_BUCKETS)
+PROVIDER_TOKENS = _metric('Counter', 'healthsum_provider_tokens_total', "Verbrauchte Tokens pro Provider",
+                          ['provider', 'kind'])
+PROVIDER_RATE_LIMITED = _metric('Counter', 'healthsum_provider_rate_limited_total',
+                                "Vom Provider abgelehnte Anfragen (HTTP 429 / Resource Exhausted)", ['provider'])
+PROVIDER_RETRIES = _metric('Counter', 'healthsum_provider_retries_total', "Wiederholte Provider-Aufrufe", ['provider'])
+
+EXTRACTOR_PAGES = _metric('Counter', 'healthsum_extractor_pages_total', "Verarbeitete Seiten pro Extraktor",
+                          ['extractor', 'outcome'])
+ARTIFACT_EVICTED_BYTES = _metric('Counter', 'healthsum_artifact_evicted_bytes_total',
+                                 "Vom Janitor entfernte Bytes (Alter, Plattenbudget, verwaiste Uploads und Blobs)", ['reason'])
+
+EXTRACTOR_PAGE_SECONDS = _metric('Histogram', 'healthsum_extractor_page_seconds', "Dauer pro Seite und Extraktor",
+                                 ['extractor'], buckets=PAGE_BUCKETS)
+
+_task_starts = {}
+_task_lock = threading.Lock()
+_collectors_registered = False
+
+
+def enabled():
+    return prometheus_client is not None
+
+
+# --- Celery-Tasks ---
+
+def task_started(task_id, task_name):
+    with _task_lock:
+        _task_starts[task_id] = time.perf_counter()
+    TASKS_IN_FLIGHT.labels(task_name).inc()
+
+
+def task_finished(task_id, task_name, state):
+    with _task_lock:
+        start = _task_starts.pop(task_id, None)
+    TASKS_IN_FLIGHT.labels(task_name).dec()
+    if start is not None:
+        TASK_DURATION.labels(task_name, (state or 'unknown').lower()).observe(time.perf_counter() - start)
+
+
+def task_retried(task_name):
+    TASK_RETRIES.labels(task_name).inc()
+
+
+# --- Provider ---
+
+def status_code(exc):
+    """HTTP-Status einer Provider-Exception (OpenAI, Azure, Google), sonst None"""
+    for candidate in (exc, getattr(exc, 'response', None)):
+        code = getattr(candidate, 'status_code', None)
+        if isinstance(code, int):
+            return code
+    code = getattr(exc, 'code', None)  # google.api_core.exceptions
+    return code if isinstance(code, int) else None
+
+
+def is_rate_limited(exc):
+    return status_code(exc) == 429 or type(exc).__name__ in ('RateLimitError', 'ResourceExhausted', 'TooManyRequests')
+
+
+class ProviderCall:
+    """Handle innerhalb von provider_request(): nimmt die Token-Nutzung der Antwort auf"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.model = None
+        self.tokens = None
+
+    def usage(self, response, model=None):
+        """Gemini-Antworten enthalten kein Modell, dort model (z.B. GenerativeModel.model_name) übergeben"""
+        self.model = usage.model_name(response, model)
+        self.tokens = observe_usage(self.provider, response)
+        return response
+
+
+@contextmanager
+def provider_request(provider, operation):
+    """
+    Misst einen Provider-Aufruf.
+
+        with provider_request('openai', 'report') as call:
+            response = call.usage(client.chat.completions.create(...))
+    """
+    start = time.perf_counter()
+    call = ProviderCall(provider)
+    try:
+        yield call
+    except Exception as exc:
+        rate_limited = is_rate_limited(exc)
+        if rate_limited and provider not in HTTP_INSTRUMENTED:
+            PROVIDER_RATE_LIMITED.labels(provider).inc()
+        PROVIDER_LATENCY.labels(provider, operation, 'rate_limited' if rate_limited else 'error').observe(
+            time.perf_counter() - start)
+        raise
+    elapsed = time.perf_counter() - start
+    PROVIDER_LATENCY.labels(provider, operation, 'ok').observe(elapsed)
+    usage.record_call(provider, operation, call.model, call.tokens, elapsed)
+
+
+def observe_usage(provider, response):
+    """Token-Nutzung aus einer OpenAI- oder Gemini-Antwort; liefert (Prompt, Cache, Completion)"""
+    tokens = usage.token_counts(response)
+    if tokens is None:
+        return None
+    prompt, cached, completion = tokens
+    if prompt:
+        PROVIDER_TOKENS.labels(provider, 'prompt').inc(prompt)
+    if cached:
+        PROVIDER_TOKENS.labels(provider, 'cached').inc(cached)
+    if completion:
+        PROVIDER_TOKENS.labels(provider, 'completion').inc(completion)
+    return tokens
+
+
+def provider_retried(provider):
+    PROVIDER_RETRIES.labels(provider).inc()
+
+
+def http_response_hook(provider):
+    """httpx-Event-Hook: zählt jede 429-Antwort, auch die vom SDK selbst wiederholten"""
+    def hook(response):
+        if response.status_code == 429:
+            PROVIDER_RATE_LIMITED.labels(provider).inc()
+    return hook
+
+
+# --- Extraktoren ---
+
+def observe_page(extractor, seconds, ok=True):
+    EXTRACTOR_PAGES.labels(extractor, 'ok' if ok else 'failed').inc()
+    EXTRACTOR_PAGE_SECONDS.labels(extractor).observe(seconds)
+
+
+def observe_checkpoint_pages(extractor, count):
+    if count:
+        EXTRACTOR_PAGES.labels(extractor, 'checkpoint').inc(count)
+
+
+def observe_evictions(freed):
+    for reason, amount in freed.items():
+        if amount:
+            ARTIFACT_EVICTED_BYTES.labels(reason).inc(amount)
+
+
+# --- Queues und Export ---
+
+def queue_keys(queue):
+    """Redis-Listen einer Queue (eine pro Prioritätsstufe, siehe BROKER_TRANSPORT_OPTIONS)"""
+    from celery_config import BROKER_TRANSPORT_OPTIONS, PRIORITY_STEPS
+    sep = BROKER_TRANSPORT_OPTIONS.get('sep', '\x06\x16')
+    return [queue if step == 0 else f"{queue}{sep}{step}" for step in PRIORITY_STEPS]
+
+
+if prometheus_client is not None:
+    class QueueDepthCollector:
+        """Liest die Länge der Celery-Queues bei jedem Abruf aus Redis"""
+
+        def describe(self):
+            # Verhindert einen Redis-Zugriff schon beim Registrieren
+            return [self._family()]
+
+        def _family(self):
+            return GaugeMetricFamily('healthsum_queue_depth', "Wartende Nachrichten pro Celery-Queue", labels=['queue'])
+
+        def collect(self):
+            from celery_config import CELERY_QUEUES
+            from providers import get_redis_client
+            family = self._family()
+            try:
+                pipe = get_redis_client().pipeline(transaction=False)
+                for queue in CELERY_QUEUES:
+                    for key in queue_keys(queue):
+                        pipe.llen(key)
+                lengths = iter(pipe.execute())
+                for queue in CELERY_QUEUES:
+                    family.add_metric([queue], sum(next(lengths) for _ in queue_keys(queue)))
+            except Exception as e:
+                logger.warning(f"Queue-Längen nicht lesbar: {e}")
+            yield family
+
+    class ArtifactBytesCollector:
+        """Zählt die gehaltenen Bytes der Artefakte und Uploads bei jedem Abruf"""
+
+        def describe(self):
+            return [self._family()]
+
+        def _family(self):
+            return GaugeMetricFamily('healthsum_artifact_bytes', "Belegte Bytes temporärer Artefakte, Uploads und Blobs",
+                                     labels=['kind'])
+
+        def collect(self):
+            import artifacts
+            family = self._family()
+            try:
+                for kind, held in artifacts.disk_usage().items():
+                    family.add_metric([kind], held)
+            except Exception as e:
+                logger.warning(f"Artefakt-Größen nicht lesbar: {e}")
+            yield family
+
+
+def _registry(include_queues):
+    """Registry mit den Werten aller Prozesse (Multiprocess-Modus) bzw. dieses Prozesses"""
+    global _collectors_registered
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        if include_queues:
+            registry.register(QueueDepthCollector())
+            registry.register(ArtifactBytesCollector())
+        return registry
+    if include_queues:
+        with _task_lock:
+            if not _collectors_registered:
+                prometheus_client.REGISTRY.register(QueueDepthCollector())
+                prometheus_client.REGISTRY.register(ArtifactBytesCollector())
+                _collectors_registered = True
+    return prometheus_client.REGISTRY
+
+
+def render_latest():
+    """(Body, Content-Type) für den /metrics-Endpunkt der Web-App"""
+    return prometheus_client.generate_latest(_registry(include_queues=True)), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def start_worker_exporter():
+    """Startet den HTTP-Exporter eines Workers, wenn METRICS_WORKER_PORT gesetzt ist"""
+    # start_workers.py setzt den Port pro Pool in der Umgebung
+    port = int(os.environ.get('METRICS_WORKER_PORT') or get_config("METRICS_WORKER_PORT", "0") or 0)
+    if prometheus_client is None or not port:
+        return False
+    try:
+        prometheus_client.start_http_server(port, registry=_registry(include_queues=False))
+    except OSError as e:
+        logger.warning(f"Metrik-Exporter auf Port {port} nicht gestartet: {e}")
+        return False
+    logger.info(f"📈 Metrik-Exporter läuft auf Port {port}")
+    return True
+
+
+def mark_process_dead(pid):
+    """Entfernt die Live-Gauges eines beendeten Prefork-Kindprozesses"""
+    if prometheus_client is not None and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
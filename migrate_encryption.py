@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Online-Umschlüsselung der verschlüsselten Spalten auf die aktuelle Engine (AES-GCM).
+
+Spalten vom Typ EncryptedBlobType (Datensatztext, Berichte) werden dabei zusätzlich
+komprimiert bzw. mit aktuellem Codec und Dictionary neu geschrieben (siehe compression.py).
+
+Die App liest beide Formate (siehe encryption.py) und kann während der Migration weiterlaufen.
+Jede Tabelle wird in Batches nach Primärschlüssel abgearbeitet; pro Batch werden die
+Rohwerte gelesen, nur noch nicht migrierte Werte umgeschlüsselt und der Batch sofort
+committet. Geschrieben werden nur die umgeschlüsselten Spalten, und nur solange sie noch den
+gelesenen Rohwert enthalten (Compare-and-Swap): hat die App eine Spalte zwischenzeitlich
+geändert, bleibt die Zeile unverändert und wird beim nächsten Lauf erneut geprüft.
+Ein abgebrochener Lauf kann daher einfach erneut gestartet werden.
+
+Aufruf:
+    python migrate_encryption.py [--batch-size 500] [--pause 0.05] [--tables health_record report] [--dry-run]
+"""
+import argparse
+import time
+
+from sqlalchemy import LargeBinary, inspect, select, type_coerce
+from sqlalchemy_utils import EncryptedType
+
+from app import app, db
+from compression import EncryptedBlobType, blob_is_current, decode_value, encode_text
+from encryption import column_key, decrypt_value, encrypt_value, is_current
+
+ENCRYPTED_TYPES = (EncryptedType, EncryptedBlobType)
+
+
+def encrypted_tables():
+    """Tabellen mit ihren EncryptedType-Spalten; noch nicht angelegte Tabellen (neuere Modelle) entfallen"""
+    inspector = inspect(db.engine)
+    tables = {}
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        columns = [column.name for column in table.columns if isinstance(column.type, ENCRYPTED_TYPES)]
+        if columns:
+            tables[table.name] = (table, columns)
+    return tables
+
+
+def raw(column):
+    """Spalte ohne Ver-/Entschlüsselung durch EncryptedType"""
+    return type_coerce(column, LargeBinary)
+
+
+def reencode(column_type, value, secret):
+    """Neuer Rohwert einer Spalte oder None, wenn der Wert bereits aktuell ist"""
+    if isinstance(column_type, EncryptedBlobType):
+        if blob_is_current(value):
+            return None
+        return encode_text(decode_value(value, secret), secret)
+    if is_current(value):
+        return None
+    return encrypt_value(decrypt_value(value, secret), secret).encode('ascii')
+
+
+def migrate_table(table, columns, batch_size, pause, dry_run):
+    """Schlüsselt eine Tabelle batchweise um und liefert (Zeilen, umgeschlüsselte Werte)"""
+    secret = column_key()
+    primary_key = table.primary_key.columns.values()[0]
+    last_id = None
+    rows_seen = 0
+    values_migrated = 0
+    rows_skipped = 0
+
+    while True:
+        query = select(primary_key, *[raw(table.c[name]).label(name) for name in columns]).order_by(primary_key).limit(batch_size)
+        if last_id is not None:
+            query = query.where(primary_key > last_id)
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        rows_seen += len(rows)
+
+        updated = 0
+        for row in rows:
+            changed = {}
+            for name in columns:
+                value = getattr(row, name)
+                if value is None:
+                    continue
+                new_value = reencode(table.c[name].type, value, secret)
+                if new_value is not None:
+                    changed[name] = new_value
+            if not changed:
+                continue
+            if dry_run:
+                values_migrated += len(changed)
+                continue
+            # Nur die umgeschlüsselten Spalten, und nur wenn sie seit dem Lesen unverändert sind
+            statement = table.update().where(primary_key == row[0])
+            for name in changed:
+                statement = statement.where(raw(table.c[name]) == type_coerce(getattr(row, name), LargeBinary))
+            statement = statement.values({name: type_coerce(value, LargeBinary) for name, value in changed.items()})
+            if db.session.execute(statement).rowcount:
+                values_migrated += len(changed)
+                updated += 1
+            else:
+                rows_skipped += 1
+
+        if updated:
+            db.session.commit()
+        print(f"  {table.name}: {rows_seen} Zeilen geprüft, {values_migrated} Werte umgeschlüsselt"
+              + (f", {rows_skipped} Zeilen zwischenzeitlich geändert (nächster Lauf)" if rows_skipped else ""))
+        if pause:
+            time.sleep(pause)
+
+    return rows_seen, values_migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verschlüsselte Spalten online auf die aktuelle Engine umschlüsseln")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.05, help="Pause zwischen Batches in Sekunden")
+    parser.add_argument('--tables', nargs='*', help="Nur diese Tabellen (Standard: alle)")
+    parser.add_argument('--dry-run', action='store_true', help="Nur zählen, nichts schreiben")
+    args = parser.parse_args()
+
+    print("=== Umschlüsselung der verschlüsselten Spalten ===\n")
+    with app.app_context():
+        tables = encrypted_tables()
+        selected = args.tables or list(tables)
+        total = 0
+        for name in selected:
+            if name not in tables:
+                print(f"✗ Unbekannte oder unverschlüsselte Tabelle: {name}")
+                continue
+            table, columns = tables[name]
+            print(f"→ {name} ({', '.join(columns)})")
+            try:
+                _, migrated = migrate_table(table, columns, args.batch_size, args.pause, args.dry_run)
+            except Exception as e:
+                db.session.rollback()
+                print(f"✗ Fehler bei {name}: {e}")
+                return False
+            total += migrated
+        print(f"\n✓ {total} Werte {'würden umgeschlüsselt' if args.dry_run else 'umgeschlüsselt'}")
+    return True
+
+
+if __name__ == '__main__':
+    if not main():
+        print("\n✗ Migration fehlgeschlagen - erneuter Aufruf setzt beim nicht migrierten Rest fort")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Legt die Tabelle record_status an und rechnet laufende bzw. kürzlich verarbeitete Datensätze ein.
+
+Für jeden Datensatz mit TaskLogs aus den letzten --hours Stunden wird die Projektion aus diesen
+TaskLogs neu aufgebaut (wie das bisherige Zwei-Stunden-Fenster von /get_processing_status; der
+Lauf ist wiederholbar). Ältere Datensätze erhalten ihre Zeile beim nächsten gestarteten Task
+(siehe record_status.py), bis dahin meldet der Endpoint 'idle'.
+
+Aufruf:
+    python migrate_record_status.py [--hours 2]
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from app import app, db
+from models import TaskLog
+from record_status import rebuild
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Status-Projektion anlegen und aus TaskLog befüllen")
+    parser.add_argument('--hours', type=float, default=2, help="Zeitfenster für das Nachrechnen in Stunden")
+    args = parser.parse_args()
+
+    print("=== Status-Projektion ===\n")
+    with app.app_context():
+        try:
+            db.create_all()
+            print("✓ Tabelle record_status vorhanden")
+
+            since = datetime.utcnow() - timedelta(hours=args.hours)
+            record_ids = [row.health_record_id for row in db.session.query(TaskLog.health_record_id)
+                          .filter(TaskLog.started_at >= since).distinct()]
+            print(f"→ Rechne {len(record_ids)} Datensätze mit TaskLogs seit {since.strftime('%d.%m.%Y %H:%M')} ein")
+            for record_id in record_ids:
+                status = rebuild(record_id, since)
+                db.session.commit()
+                print(f"  Datensatz {record_id}: {status.running_count} laufend, "
+                      f"{status.success_count} erfolgreich, {status.failed_count} fehlgeschlagen")
+            print(f"\n✓ {len(record_ids)} Projektionen aufgebaut")
+            return True
+        except Exception as e:
+            db.session.rollback()
+            print(f"✗ Fehler bei der Migration: {e}")
+            return False
+
+
+if __name__ == '__main__':
+    if not main():
+        print("\n✗ Migration fehlgeschlagen!")
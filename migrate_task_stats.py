@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Legt die Tabellen für die KPI-Rollups an und rechnet bestehende TaskLogs ein.
+
+Erfolge, Fehler, Retries und Dauer der letzten --days Tage werden aus TaskLog neu
+aufgebaut (vorher für das Zeitfenster zurückgesetzt, der Lauf ist daher wiederholbar).
+Queue-Wartezeiten stehen nicht in TaskLog; sie werden nicht angetastet und erst ab
+jetzt über den Header enqueued_at erfasst (siehe task_stats.py).
+
+Aufruf:
+    python migrate_task_stats.py [--days 90] [--batch-size 1000]
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app import app, db
+from models import TaskLog, TaskStatRollup, TaskStatBucket
+from task_stats import METRIC_DURATION, _increment_bucket, _increment_rollup
+
+
+def reset_window(since):
+    """Setzt die aus TaskLog ableitbaren Zähler ab since zurück"""
+    TaskStatRollup.query.filter(TaskStatRollup.day >= since).update({
+        'success_count': 0, 'failure_count': 0, 'retry_count': 0, 'duration_count': 0, 'duration_sum': 0.0,
+    }, synchronize_session=False)
+    TaskStatBucket.query.filter(TaskStatBucket.day >= since, TaskStatBucket.metric == METRIC_DURATION).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def backfill(since, batch_size):
+    """Zählt abgeschlossene TaskLogs batchweise in die Rollups und liefert ihre Anzahl"""
+    since_datetime = datetime.combine(since, datetime.min.time())
+    last_id = 0
+    total = 0
+    while True:
+        # Nur unverschlüsselte Spalten laden
+        rows = db.session.query(
+            TaskLog.id, TaskLog.task_name, TaskLog.status, TaskLog.duration_seconds,
+            TaskLog.completed_at, TaskLog.retry_count
+        ).filter(
+            TaskLog.id > last_id,
+            TaskLog.status.in_(['success', 'failed']),
+            TaskLog.completed_at >= since_datetime,
+        ).order_by(TaskLog.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        for row in rows:
+            increments = {'success_count' if row.status == 'success' else 'failure_count': 1}
+            if row.retry_count:
+                increments['retry_count'] = row.retry_count
+            if row.duration_seconds is not None:
+                increments.update(duration_count=1, duration_sum=float(row.duration_seconds))
+            _increment_rollup(row.completed_at.date(), row.task_name, **increments)
+            if row.duration_seconds is not None:
+                _increment_bucket(row.completed_at.date(), row.task_name, METRIC_DURATION, row.duration_seconds)
+        db.session.commit()
+        total += len(rows)
+        print(f"  {total} TaskLogs eingerechnet")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KPI-Rollups anlegen und aus TaskLog befüllen")
+    parser.add_argument('--days', type=int, default=90, help="Zeitfenster für das Nachrechnen in Tagen")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    print("=== KPI-Rollups ===\n")
+    with app.app_context():
+        try:
+            db.create_all()
+            db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_task_monitor_created_at ON task_monitor (created_at)"))
+            db.session.commit()
+            print("✓ Tabellen task_stat_rollup, task_stat_bucket und Index auf task_monitor.created_at vorhanden")
+
+            since = datetime.utcnow().date() - timedelta(days=args.days - 1)
+            print(f"→ Rechne TaskLogs seit {since.strftime('%d.%m.%Y')} ein")
+            reset_window(since)
+            total = backfill(since, args.batch_size)
+            print(f"\n✓ {total} TaskLogs eingerechnet")
+            return True
+        except Exception as e:
+            db.session.rollback()
+            print(f"✗ Fehler bei der Migration: {e}")
+            return False
+
+
+if __name__ == '__main__':
+    if not main():
+        print("\n✗ Migration fehlgeschlagen!")
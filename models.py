@@ -3,45 +3,55 @@ from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from sqlalchemy_utils.types.encrypted.encrypted_type import AesEngine
 from sqlalchemy_utils import EncryptedType
-from flask import current_app
+from encryption import column_key, ColumnEngine
+from compression import EncryptedBlobType
 from sqlalchemy import Sequence
 
 db = SQLAlchemy()
 
+def dialect_insert(table):
+    """INSERT des aktiven Dialekts (PostgreSQL bzw. SQLite) mit on_conflict_do_update/do_nothing für Upserts"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
 class HealthRecord(db.Model):
     __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    text = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
-    filenames = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
+    text = db.Column(EncryptedBlobType())  # komprimiert + verschlüsselt (siehe compression.py)
+    filenames = db.Column(EncryptedType(db.Text, column_key, ColumnEngine))
     token_count = db.Column(db.Integer)
-    patient_name = db.Column(EncryptedType(db.String(100), lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
-    birth_date = db.Column(EncryptedType(db.DateTime, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    patient_name = db.Column(EncryptedType(db.String(100), column_key, ColumnEngine))
+    birth_date = db.Column(EncryptedType(db.DateTime, column_key, ColumnEngine), nullable=True)
     medical_history_begin = db.Column(db.DateTime)
     medical_history_end = db.Column(db.DateTime)
     create_reports = db.Column(db.Boolean, default=False)
     expiration_date = db.Column(db.DateTime, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    custom_instructions = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    custom_instructions = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
     
     # Dauerhafter Verarbeitungsstatus
     processing_status = db.Column(db.Enum('pending', 'processing', 'completed', 'failed', name='processing_statuses'), default='pending')
     processing_completed_at = db.Column(db.DateTime, nullable=True)
-    processing_error_message = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    processing_error_message = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
     
     user = db.relationship('User', back_populates='health_records')
     reports = db.relationship('Report', back_populates='health_record', cascade='all, delete-orphan')
     task_monitors = db.relationship('TaskMonitor', back_populates='health_record', cascade='all, delete-orphan')
     medical_codes = db.relationship('MedicalCode', back_populates='health_record', cascade='all, delete-orphan')
     task_logs = db.relationship('TaskLog', back_populates='health_record', cascade='all, delete-orphan')
+    status_projection = db.relationship('RecordStatus', back_populates='health_record', uselist=False, cascade='all, delete-orphan')
+    report_year_parts = db.relationship('ReportYearPart', back_populates='health_record', cascade='all, delete-orphan')
 
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), nullable=False)
     report_template_id = db.Column(db.Integer, db.ForeignKey('report_template.id'), nullable=False)
-    content = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
+    content = db.Column(EncryptedBlobType())
     report_type = db.Column(db.String(50))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -52,7 +62,7 @@ class Report(db.Model):
     generation_status = db.Column(db.Enum('pending', 'generating', 'completed', 'failed', name='report_statuses'), default='pending')
     generation_started_at = db.Column(db.DateTime, nullable=True)
     generation_completed_at = db.Column(db.DateTime, nullable=True)
-    generation_error_message = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    generation_error_message = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
     
     health_record = db.relationship('HealthRecord', back_populates='reports')
     report_template = db.relationship('ReportTemplate', back_populates='reports')
@@ -61,9 +71,9 @@ class ReportTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     template_name = db.Column(db.String(100), nullable=False)
     output_format = db.Column(db.Enum('JSON', 'TEXT', name='output_formats'), nullable=False)
-    example_structure = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
-    system_prompt = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
-    prompt = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
+    example_structure = db.Column(EncryptedType(db.Text, column_key, ColumnEngine))
+    system_prompt = db.Column(EncryptedType(db.Text, column_key, ColumnEngine))
+    prompt = db.Column(EncryptedType(db.Text, column_key, ColumnEngine))
     summarizer = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_updated = db.Column(db.DateTime, nullable=True)
@@ -71,6 +81,31 @@ class ReportTemplate(db.Model):
     system_pdf_filename = db.Column(db.String(255), nullable=True)  # Dateiname der System-PDF
     
     reports = db.relationship('Report', back_populates='report_template', cascade='all, delete-orphan')
+    report_year_parts = db.relationship('ReportYearPart', back_populates='report_template', cascade='all, delete-orphan')
+
+class ReportYearPart(db.Model):
+    """Gecachtes Jahresergebnis eines Berichts für die inkrementelle Neugenerierung"""
+    __table_args__ = (db.UniqueConstraint('health_record_id', 'report_template_id', 'year', name='uq_report_year_part'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), nullable=False, index=True)
+    report_template_id = db.Column(db.Integer, db.ForeignKey('report_template.id'), nullable=False)
+    template_version = db.Column(db.String(64), nullable=False)  # Fingerprint von Template und Generierungsparametern
+    year = db.Column(db.Integer, nullable=False)
+    content = db.Column(EncryptedBlobType())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    health_record = db.relationship('HealthRecord', back_populates='report_year_parts')
+    report_template = db.relationship('ReportTemplate', back_populates='report_year_parts')
+
+class ExtractionCheckpoint(db.Model):
+    """Fertig extrahierte Seite eines Dokuments, damit Retries und erneute Uploads dort weitermachen"""
+    __table_args__ = (db.UniqueConstraint('document_hash', 'extractor', 'page', name='uq_extraction_checkpoint'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    document_hash = db.Column(db.String(64), nullable=False, index=True)  # SHA-256 der PDF-Datei
+    extractor = db.Column(db.String(50), nullable=False)  # z.B. 'ocr', 'azure_vision', 'gpt4_vision'
+    page = db.Column(db.Integer, nullable=False)
+    content = db.Column(EncryptedType(db.Text, column_key, ColumnEngine))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -109,7 +144,7 @@ class User(db.Model, UserMixin):
 
 class TaskMonitor(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), nullable=False)
     health_record_token_count = db.Column(db.Integer, nullable=True)
     start_date = db.Column(db.DateTime, nullable=True)
@@ -121,9 +156,9 @@ class TaskMonitor(db.Model):
 class MedicalCode(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), nullable=False)
-    code = db.Column(EncryptedType(db.String(20), lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'))
+    code = db.Column(EncryptedType(db.String(20), column_key, ColumnEngine))
     code_type = db.Column(db.Enum('ICD10', 'ICD11', 'OPS', name='code_types'), nullable=False)
-    description = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    description = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     health_record = db.relationship('HealthRecord', back_populates='medical_codes')
@@ -134,7 +169,7 @@ class TaskLog(db.Model):
     task_name = db.Column(db.String(100), nullable=False)  # z.B. 'process_pdfs', 'extract_ocr_optimized'
     task_id = db.Column(db.String(255), nullable=True)  # Celery Task ID
     status = db.Column(db.Enum('started', 'success', 'failed', 'retry', name='task_statuses'), nullable=False)
-    error_message = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    error_message = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
     error_type = db.Column(db.String(100), nullable=True)  # Exception class name
     retry_count = db.Column(db.Integer, default=0)
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -142,7 +177,7 @@ class TaskLog(db.Model):
     duration_seconds = db.Column(db.Float, nullable=True)
     
     # Zusätzliche Metadaten als JSON
-    task_metadata = db.Column(EncryptedType(db.Text, lambda: current_app.config['SECRET_KEY'], AesEngine, 'pkcs5'), nullable=True)
+    task_metadata = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
     
     health_record = db.relationship('HealthRecord', back_populates='task_logs')
     
@@ -161,6 +196,68 @@ class TaskLog(db.Model):
             'duration_seconds': self.duration_seconds
         }
 
+class RecordStatus(db.Model):
+    """Verarbeitungsstatus pro Datensatz, in derselben Transaktion wie die TaskLogs gepflegt (siehe record_status.py)"""
+    health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)  # Zählt bei jeder Änderung hoch
+    run_started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    current_task = db.Column(db.String(100), nullable=True)  # Zuletzt gestarteter Task
+    running_count = db.Column(db.Integer, nullable=False, default=0)
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    # Kernschritte des Laufs (Kriterium für 'completed')
+    pdfs_processed = db.Column(db.Boolean, nullable=False, default=False)
+    extractions_combined = db.Column(db.Boolean, nullable=False, default=False)
+    reports_created = db.Column(db.Boolean, nullable=False, default=False)
+    last_error_task = db.Column(db.String(100), nullable=True)
+    last_error_type = db.Column(db.String(100), nullable=True)
+    last_error_message = db.Column(EncryptedType(db.Text, column_key, ColumnEngine), nullable=True)
+    last_error_at = db.Column(db.DateTime, nullable=True)
+
+    health_record = db.relationship('HealthRecord', back_populates='status_projection')
+
+class TaskStatRollup(db.Model):
+    """Tagesaggregat pro Task für die KPI-Seite, inkrementell gepflegt (siehe task_stats.py)"""
+    __table_args__ = (db.UniqueConstraint('day', 'task_name', name='uq_task_stat_rollup'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    day = db.Column(db.Date, nullable=False, index=True)
+    task_name = db.Column(db.String(100), nullable=False)
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+    retry_count = db.Column(db.Integer, nullable=False, default=0)
+    duration_count = db.Column(db.Integer, nullable=False, default=0)
+    duration_sum = db.Column(db.Float, nullable=False, default=0.0)
+    queue_wait_count = db.Column(db.Integer, nullable=False, default=0)
+    queue_wait_sum = db.Column(db.Float, nullable=False, default=0.0)
+
+class TaskStatBucket(db.Model):
+    """Histogramm-Bucket (Dauer oder Queue-Wartezeit) pro Tag und Task für die Perzentile"""
+    __table_args__ = (db.UniqueConstraint('day', 'task_name', 'metric', 'bucket', name='uq_task_stat_bucket'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    day = db.Column(db.Date, nullable=False, index=True)
+    task_name = db.Column(db.String(100), nullable=False)
+    metric = db.Column(db.String(20), nullable=False)  # 'duration' oder 'queue_wait'
+    bucket = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class UsageLedger(db.Model):
+    """Token-Verbrauch und Latenz der Provider-Aufrufe, gebündelt geschrieben (siehe usage.py)"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # Ohne Fremdschlüssel: verbrauchte Tokens bleiben nach dem Löschen eines Datensatzes abrechenbar
+    health_record_id = db.Column(db.Integer, nullable=True, index=True)
+    stage = db.Column(db.String(50), nullable=False)  # z.B. 'report', 'combine', 'patient_info', 'vision_page'
+    report_template_id = db.Column(db.Integer, nullable=True)
+    year = db.Column(db.Integer, nullable=True)
+    provider = db.Column(db.String(30), nullable=False)
+    model = db.Column(db.String(100), nullable=True)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cached_tokens = db.Column(db.Integer, nullable=False, default=0)  # Teil der prompt_tokens aus dem Prompt-Cache
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    latency_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 
 # SQLAlchemy Event Listener für automatische Generierung der eindeutigen Bezeichnung
 from sqlalchemy import event, text
@@ -0,0 +1,167 @@
+# notifications.py
+"""
+Benachrichtigungen nach abgeschlossener Verarbeitung.
+
+Der Versand wird beim Abschluss eines Datensatzes angestoßen (tasks.schedule_notifications):
+ein Dispatcher-Lauf startet NOTIFY_BATCH_SECONDS später, alle Abschlüsse in diesem Fenster teilen
+sich den Lauf. Der Dispatcher
+    - liest die offenen TaskMonitor-Zeilen in Batches (NOTIFY_BATCH_SIZE) mit einem Join auf
+      HealthRecord und User und lädt dabei nur unverschlüsselte Spalten,
+    - sendet über eine pro Prozess gehaltene SMTP-Verbindung (wiederverwendet, solange sie
+      kürzer als NOTIFY_SMTP_IDLE_SECONDS ungenutzt war; bei Abbruch wird einmal neu verbunden),
+    - markiert die versendeten Zeilen mit einem UPDATE pro Batch.
+Fehlgeschlagene Nachrichten bleiben offen und werden vom stündlichen Beat-Lauf erneut versucht.
+"""
+import logging
+import smtplib
+import threading
+import time
+
+from flask import current_app
+from flask_mail import Message
+
+from config import get_config
+from models import db, TaskMonitor, HealthRecord, User
+
+logger = logging.getLogger(__name__)
+
+SCHEDULED_KEY = 'healthsum:notifications:scheduled'
+LOCK_KEY = 'healthsum:notifications:lock'
+LOCK_SECONDS = 300
+# Löscht den Lock nur, wenn er noch dem aufrufenden Lauf gehört (nach LOCK_SECONDS kann ein anderer ihn halten)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+NOTIFICATION_TEMPLATE = 'e-mails/notification_template.html'
+
+_connection = None
+_connection_used = 0.0
+_connection_lock = threading.Lock()
+
+
+def batch_seconds():
+    return float(get_config("NOTIFY_BATCH_SECONDS", "2"))
+
+
+def batch_size():
+    return int(get_config("NOTIFY_BATCH_SIZE", "50"))
+
+
+def smtp_idle_seconds():
+    # Viele Server trennen nach 5 Minuten ohne Befehl (RFC 5321)
+    return float(get_config("NOTIFY_SMTP_IDLE_SECONDS", "240"))
+
+
+def release_lock(redis_client, owner):
+    """Gibt den Versand-Lock frei, sofern owner ihn noch hält; liefert True bei Freigabe"""
+    return bool(redis_client.eval(RELEASE_LOCK_SCRIPT, 1, LOCK_KEY, owner))
+
+
+# --- SMTP-Verbindung ---
+
+def _open_connection():
+    from app import mail
+    connection = mail.connect()
+    connection.__enter__()
+    return connection
+
+
+def _quit(connection):
+    if connection is not None and connection.host is not None:
+        try:
+            connection.host.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+def close_connection():
+    global _connection
+    with _connection_lock:
+        connection, _connection = _connection, None
+    _quit(connection)
+
+
+def _send(message):
+    """Sendet über die gehaltene Verbindung; eine abgebrochene Verbindung wird einmal neu geöffnet"""
+    global _connection, _connection_used
+    with _connection_lock:
+        if _connection is not None and time.monotonic() - _connection_used > smtp_idle_seconds():
+            _quit(_connection)
+            _connection = None
+        for attempt in range(2):
+            if _connection is None:
+                _connection = _open_connection()
+            try:
+                _connection.send(message)
+                _connection_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                _connection = None
+                if attempt:
+                    raise
+                logger.info(f"SMTP-Verbindung getrennt ({e}), verbinde neu")
+
+
+# --- Versand ---
+
+def format_duration(start_date, end_date):
+    if not start_date or not end_date:
+        return None
+    hours, remainder = divmod(int((end_date - start_date).total_seconds()), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def pending_notifications(limit, exclude_ids=()):
+    """Offene Benachrichtigungen ohne verschlüsselte Spalten (kein Laden von Text oder Namen)"""
+    query = db.session.query(
+        TaskMonitor.id, TaskMonitor.start_date, TaskMonitor.end_date,
+        HealthRecord.id, User.vorname, User.nachname, User.email
+    ).join(HealthRecord, TaskMonitor.health_record_id == HealthRecord.id
+    ).join(User, HealthRecord.user_id == User.id
+    ).filter(TaskMonitor.end_date.isnot(None), TaskMonitor.notification_sent == False)
+    if exclude_ids:
+        query = query.filter(TaskMonitor.id.notin_(exclude_ids))
+    return query.order_by(TaskMonitor.id).limit(limit).all()
+
+
+def build_message(record_id, vorname, nachname, email, duration):
+    # Direkt über jinja_env statt render_template: die Kontext-Prozessoren der Web-App
+    # (u.a. are_tasks_running, ein Celery-Inspect-Broadcast) würden pro Mail ausgeführt
+    html_body = current_app.jinja_env.get_template(NOTIFICATION_TEMPLATE).render(
+        user={'vorname': vorname, 'nachname': nachname},
+        health_record={'id': record_id},
+        duration=duration
+    )
+    message = Message(subject=f"Verarbeitung abgeschlossen für Datensatz ID {record_id}",
+                      sender=current_app.config['MAIL_USERNAME'], recipients=[email])
+    message.html = html_body
+    return message
+
+
+def dispatch_pending():
+    """Versendet alle offenen Benachrichtigungen; liefert (gesendet, fehlgeschlagen)"""
+    sent_total, failed_ids = 0, []
+    while True:
+        rows = pending_notifications(batch_size(), failed_ids)
+        if not rows:
+            break
+        sent_ids = []
+        for monitor_id, start_date, end_date, record_id, vorname, nachname, email in rows:
+            try:
+                _send(build_message(record_id, vorname, nachname, email, format_duration(start_date, end_date)))
+                sent_ids.append(monitor_id)
+            except Exception as e:
+                logger.error(f"Benachrichtigung für Datensatz {record_id} an {email} fehlgeschlagen: {e}")
+                failed_ids.append(monitor_id)
+        if sent_ids:
+            TaskMonitor.query.filter(TaskMonitor.id.in_(sent_ids)).update(
+                {TaskMonitor.notification_sent: True}, synchronize_session=False)
+            db.session.commit()
+            sent_total += len(sent_ids)
+        if len(rows) < batch_size():
+            break
+    return sent_total, len(failed_ids)
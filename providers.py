@@ -0,0 +1,220 @@
+# providers.py
+"""
+Zentrale, lazy initialisierte Provider-Registry.
+
+Alle API-Clients (OpenAI, Azure Vision, Gemini) und die tiktoken-Kodierung werden erst
+beim ersten Zugriff erstellt und danach pro Prozess geteilt. Die SDKs selbst werden
+ebenfalls erst dann importiert, damit Web-App und Celery-Worker schnell starten.
+
+Gemini-Modelle werden pro (Modellname, Generation Config, Safety Settings, Schema-Hash)
+nur einmal erstellt, Response-Schemas pro Hash der example_structure nur einmal gebaut.
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from config import get_config, subscribe_config_changes
+
+logger = logging.getLogger(__name__)
+
+AZURE_VISION_ENDPOINT = "https://benda-vision.cognitiveservices.azure.com/"
+# Extraktions-Aufrufe haben eigene Timeouts und sollen nicht so oft wiederholt werden wie Berichte
+EXTRACTION_OPENAI_MAX_RETRIES = 2
+
+_cache_lock = threading.RLock()
+_instances = {}
+_gemini_models = {}
+_compiled_schemas = {}
+
+
+def _get_or_create(name, factory):
+    """Erstellt eine Instanz beim ersten Zugriff (thread-sicher) und cached sie pro Prozess"""
+    instance = _instances.get(name)
+    if instance is None:
+        with _cache_lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+                logger.info(f"Provider initialisiert: {name}")
+    return instance
+
+
+def _create_openai_client():
+    import httpx
+    from openai import OpenAI
+    from metrics import http_response_hook
+    return OpenAI(
+        api_key=get_config("OPENAI_API_KEY"),
+        base_url=get_config("OPENAI_BASE_URL") or None,  # z.B. lokaler Stand-in für Benchmarks
+        timeout=500,
+        max_retries=10,
+        http_client=httpx.Client(
+            timeout=httpx.Timeout(
+                connect=60.0,    # Timeout für den Verbindungsaufbau
+                read=120.0,      # Timeout für das Lesen der Antwort
+                write=60.0,      # Timeout für das Schreiben der Anfrage
+                pool=60.0        # Timeout für Connection-Pool
+            ),
+            event_hooks={'response': [http_response_hook('openai')]}
+        )
+    )
+
+
+def get_openai_client(max_retries=None):
+    """
+    Gemeinsamer OpenAI-Client des Prozesses.
+
+    :param max_retries: Optional abweichende Retry-Anzahl (teilt den HTTP-Connection-Pool)
+    """
+    client = _get_or_create('openai', _create_openai_client)
+    if max_retries is None:
+        return client
+    return _get_or_create(f'openai_retries_{max_retries}', lambda: client.with_options(max_retries=max_retries))
+
+
+def get_openai_model():
+    """Name des OpenAI-Modells aus der Konfiguration"""
+    return get_config("OPENAI_MODEL")
+
+
+def _create_vision_client():
+    from azure.ai.vision.imageanalysis import ImageAnalysisClient
+    from azure.core.credentials import AzureKeyCredential
+    return ImageAnalysisClient(
+        credential=AzureKeyCredential(get_config("AZURE_KEY_CREDENTIALS")),
+        endpoint=get_config("AZURE_VISION_ENDPOINT", AZURE_VISION_ENDPOINT),
+    )
+
+
+def get_vision_client():
+    """Gemeinsamer Azure-Vision-Client des Prozesses"""
+    return _get_or_create('azure_vision', _create_vision_client)
+
+
+def _configure_genai():
+    import google.generativeai as genai
+    endpoint = get_config("GEMINI_API_ENDPOINT")
+    if endpoint:
+        # Abweichender Endpunkt (z.B. lokaler Stand-in) nur über REST erreichbar
+        genai.configure(api_key=get_config("GEMINI_API_KEY"), transport='rest', client_options={'api_endpoint': endpoint})
+    else:
+        genai.configure(api_key=get_config("GEMINI_API_KEY"))
+    return genai
+
+
+def get_genai():
+    """Das google.generativeai-Modul, einmal pro Prozess konfiguriert"""
+    return _get_or_create('genai', _configure_genai)
+
+
+def get_tiktoken_encoding():
+    """tiktoken-Kodierung für GPT-4, einmal pro Prozess geladen"""
+    def create_encoding():
+        import tiktoken
+        return tiktoken.encoding_for_model("gpt-4")
+    return _get_or_create('tiktoken', create_encoding)
+
+
+def get_redis_client():
+    """Redis-Client auf dem Celery-Broker (Scheduling-Zähler u.ä.), einmal pro Prozess"""
+    def create_client():
+        import redis
+        from celery_config import BROKER_URL
+        return redis.Redis.from_url(BROKER_URL, socket_timeout=5, socket_connect_timeout=5)
+    return _get_or_create('redis', create_client)
+
+
+def get_token_threshold():
+    """Token-Grenze, ab der Gemini statt GPT verwendet wird"""
+    return int(get_config("TOKEN_THRESHOLD", "100000"))
+
+
+# Safety Settings für medizinische Daten
+GEMINI_SAFETY_SETTINGS = (
+    ("HARM_CATEGORY_HARASSMENT", "BLOCK_NONE"),
+    ("HARM_CATEGORY_HATE_SPEECH", "BLOCK_NONE"),
+    ("HARM_CATEGORY_SEXUALLY_EXPLICIT", "BLOCK_NONE"),
+    ("HARM_CATEGORY_DANGEROUS_CONTENT", "BLOCK_NONE"),
+)
+
+
+def schema_hash(example_structure):
+    """Hash der example_structure als Schlüssel für das kompilierte Schema"""
+    return hashlib.sha256((example_structure or "").encode('utf-8')).hexdigest()
+
+
+def get_compiled_schema(example_structure, builder):
+    """
+    Liefert das Response-Schema einer example_structure aus dem Cache.
+
+    :param example_structure: JSON-String der Beispielstruktur
+    :param builder: Funktion, die das Schema aus der example_structure baut
+    :return: Tuple (schema_hash, schema)
+    """
+    key = schema_hash(example_structure)
+    schema = _compiled_schemas.get(key)
+    if schema is None:
+        schema = builder(example_structure)
+        with _cache_lock:
+            _compiled_schemas[key] = schema
+        logger.info(f"Response-Schema kompiliert und gecacht ({key[:12]})")
+    return key, schema
+
+
+def _freeze(value):
+    """Wandelt verschachtelte Konfigurationen in einen hashbaren Schlüssel um"""
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def get_gemini_model(model_name=None, generation_config=None, safety_settings=GEMINI_SAFETY_SETTINGS, response_schema=None, response_schema_key=None):
+    """
+    Liefert eine wiederverwendbare GenerativeModel-Instanz.
+
+    :param model_name: Modellname; Standard ist GEMINI_MODEL aus der Konfiguration
+    :param generation_config: Dictionary ohne response_schema (wird separat übergeben)
+    :param safety_settings: Iterable von (category, threshold)-Paaren
+    :param response_schema: Optionales kompiliertes Schema (siehe get_compiled_schema)
+    :param response_schema_key: Hash des Schemas, Teil des Cache-Schlüssels
+    """
+    model_name = model_name or get_config("GEMINI_MODEL")
+    generation_config = dict(generation_config or {})
+    safety_settings = tuple(tuple(setting) for setting in (safety_settings or ()))
+    key = (model_name, _freeze(generation_config), safety_settings, response_schema_key)
+
+    model = _gemini_models.get(key)
+    if model is None:
+        if response_schema is not None:
+            generation_config["response_schema"] = response_schema
+        model = get_genai().GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config or None,
+            safety_settings=[{"category": category, "threshold": threshold} for category, threshold in safety_settings] or None
+        )
+        with _cache_lock:
+            model = _gemini_models.setdefault(key, model)
+        logger.info(f"Gemini-Modell erstellt und gecacht: {model_name} ({len(_gemini_models)} Instanzen)")
+    return model
+
+
+def clear_caches():
+    """Verwirft alle Clients, Modelle und Schemas (z.B. nach Konfigurationsänderungen)"""
+    with _cache_lock:
+        _instances.clear()
+        _gemini_models.clear()
+        _compiled_schemas.clear()
+
+
+# Konfigurationswerte, mit denen Clients erstellt werden
+PROVIDER_CONFIG_KEYS = {'OPENAI_API_KEY', 'AZURE_KEY_CREDENTIALS', 'GEMINI_API_KEY', 'GEMINI_MODEL'}
+
+
+def _on_config_change(changed):
+    """Erstellt Clients neu, wenn sich Schlüssel oder Modell in der Konfiguration ändern"""
+    if PROVIDER_CONFIG_KEYS & set(changed):
+        logger.info("Provider-Konfiguration geändert - Clients werden beim nächsten Zugriff neu erstellt")
+        clear_caches()
+
+
+subscribe_config_changes(_on_config_change)
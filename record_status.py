@@ -0,0 +1,158 @@
+# record_status.py
+"""
+Verarbeitungsstatus pro Datensatz als Projektion der TaskLogs.
+
+Bisher lud /get_processing_status bei jeder Abfrage alle TaskLogs der letzten zwei Stunden,
+entschlüsselte sie und baute den Status in Python neu auf. Stattdessen pflegen log_task_start,
+log_task_success und log_task_failure (tasks.py) in derselben Transaktion wie den TaskLog eine
+Zeile RecordStatus:
+    - Zähler pro Zustand (laufend, erfolgreich, fehlgeschlagen) aus dem Zustandswechsel des TaskLogs,
+    - zuletzt gestarteter Task, erledigte Kernschritte und letzter Fehler,
+    - version, die bei jeder Änderung hochzählt (die Taskliste wird nur bei Änderung neu geladen).
+Die Zeile wird beim Schreiben gesperrt (SELECT ... FOR UPDATE), parallele Worker zählen daher nicht
+gegeneinander.
+
+Ein Lauf beginnt mit process_pdfs oder mit dem ersten Task, der startet, nachdem die Projektion
+RECORD_STATUS_RUN_GAP_MINUTES unverändert war (entspricht dem bisherigen Zwei-Stunden-Fenster); die
+Zähler beginnen dann neu. Tasks, die nie Erfolg oder Fehler melden (Worker per OOM/SIGKILL beendet,
+hartes Zeitlimit), gelten nach dieser Zeit ebenfalls als beendet, statt den Datensatz dauerhaft als
+laufend zu melden. Die Taskliste eines Laufs liefert task_page() seitenweise und ohne verschlüsselte Spalten.
+Bestehende Datensätze lassen sich mit migrate_record_status.py nachträglich einrechnen.
+"""
+from datetime import datetime, timedelta
+
+from config import get_config
+from models import db, dialect_insert, RecordStatus, TaskLog
+
+COUNTERS = {'started': 'running_count', 'success': 'success_count', 'failed': 'failed_count'}
+MILESTONES = {
+    'process_pdfs': 'pdfs_processed',
+    'combine_extractions': 'extractions_combined',
+    'create_report': 'reports_created',
+}
+RUN_START_TASK = 'process_pdfs'
+
+
+def run_gap():
+    return timedelta(minutes=float(get_config("RECORD_STATUS_RUN_GAP_MINUTES", "120")))
+
+
+def is_stale(status, now=None):
+    """Projektion seit RECORD_STATUS_RUN_GAP_MINUTES unverändert; als laufend gezählte Tasks sind verloren"""
+    return (now or datetime.utcnow()) - status.updated_at > run_gap()
+
+
+def running_tasks(status, now=None):
+    """Laufende Tasks, ohne verlorene Tasks einer veralteten Projektion"""
+    if status is None or is_stale(status, now):
+        return 0
+    return max(0, status.running_count)
+
+
+def _reset(status, now):
+    status.run_started_at = now
+    status.current_task = None
+    for column in COUNTERS.values():
+        setattr(status, column, 0)
+    for column in MILESTONES.values():
+        setattr(status, column, False)
+    status.last_error_task = status.last_error_type = status.last_error_message = status.last_error_at = None
+
+
+def _locked(record_id, now):
+    """Projektion eines Datensatzes, bei Bedarf angelegt und für die laufende Transaktion gesperrt"""
+    db.session.execute(dialect_insert(RecordStatus.__table__).values(
+        health_record_id=record_id, version=0, run_started_at=now, updated_at=now,
+        running_count=0, success_count=0, failed_count=0,
+        pdfs_processed=False, extractions_combined=False, reports_created=False,
+    ).on_conflict_do_nothing(index_elements=['health_record_id']))
+    return RecordStatus.query.filter_by(health_record_id=record_id).with_for_update().populate_existing().one()
+
+
+def apply_transition(record_id, task_name, old_status, new_status, error=None):
+    """
+    Überträgt den Zustandswechsel eines TaskLogs in die Projektion (ohne Commit, der folgt
+    mit dem TaskLog).
+
+    :param old_status: Bisheriger Status des TaskLogs, None für einen neuen Eintrag
+    """
+    now = datetime.utcnow()
+    status = _locked(record_id, now)
+    if new_status == 'started' and (task_name == RUN_START_TASK or is_stale(status, now)):
+        _reset(status, now)
+
+    if old_status != new_status:
+        if old_status in COUNTERS:
+            column = COUNTERS[old_status]
+            setattr(status, column, max(0, getattr(status, column) - 1))
+        if new_status in COUNTERS:
+            column = COUNTERS[new_status]
+            setattr(status, column, getattr(status, column) + 1)
+
+    if new_status == 'started':
+        status.current_task = task_name
+    elif new_status == 'success' and task_name in MILESTONES:
+        setattr(status, MILESTONES[task_name], True)
+    elif new_status == 'failed':
+        status.last_error_task = task_name
+        status.last_error_type = type(error).__name__ if error is not None else None
+        status.last_error_message = str(error)[:1000] if error is not None else None
+        status.last_error_at = now
+    status.version += 1
+    status.updated_at = now
+
+
+def processing_state(status, create_reports):
+    """Status wie bisher: processing, completed, failed oder idle"""
+    if status is None:
+        return 'idle'
+    if running_tasks(status) > 0:
+        return 'processing'
+    reports_done = status.reports_created or not create_reports
+    if status.pdfs_processed and status.extractions_combined and reports_done and not status.failed_count:
+        return 'completed'
+    if status.failed_count:
+        return 'failed'
+    return 'idle'
+
+
+def task_page(record_id, since, page, per_page):
+    """(Anzahl, Zeilen) der TaskLogs seit since, chronologisch, nur unverschlüsselte Spalten"""
+    query = db.session.query(
+        TaskLog.task_name, TaskLog.task_id, TaskLog.status, TaskLog.started_at, TaskLog.completed_at,
+        TaskLog.duration_seconds, TaskLog.retry_count
+    ).filter(TaskLog.health_record_id == record_id, TaskLog.started_at >= since)
+    total = query.count()
+    rows = query.order_by(TaskLog.started_at.asc(), TaskLog.id.asc()).offset((page - 1) * per_page).limit(per_page).all()
+    return total, rows
+
+
+def rebuild(record_id, since):
+    """Baut die Projektion aus den TaskLogs seit since neu auf (migrate_record_status.py)"""
+    now = datetime.utcnow()
+    status = _locked(record_id, now)
+    _reset(status, since)
+    rows = db.session.query(TaskLog.id, TaskLog.task_name, TaskLog.status, TaskLog.started_at) \
+        .filter(TaskLog.health_record_id == record_id, TaskLog.started_at >= since) \
+        .order_by(TaskLog.started_at.asc(), TaskLog.id.asc()).all()
+    last_failed_id = None
+    for row in rows:
+        if row.status in COUNTERS:
+            column = COUNTERS[row.status]
+            setattr(status, column, getattr(status, column) + 1)
+        if row.status == 'started':
+            status.current_task = row.task_name
+        elif row.status == 'success' and row.task_name in MILESTONES:
+            setattr(status, MILESTONES[row.task_name], True)
+        elif row.status == 'failed':
+            last_failed_id = row.id
+    if last_failed_id:
+        # Nur die Fehlermeldung des letzten Fehlers wird entschlüsselt
+        failed = TaskLog.query.get(last_failed_id)
+        status.last_error_task = failed.task_name
+        status.last_error_type = failed.error_type
+        status.last_error_message = (failed.error_message or '')[:1000] or None
+        status.last_error_at = failed.completed_at
+    status.version += 1
+    status.updated_at = now
+    return status
@@ -0,0 +1,145 @@
+# report_cache.py
+"""
+Jahres-Cache für die inkrementelle Berichtserstellung.
+
+Pro (Datensatz, Template, Template-Version, Jahr) wird das Jahresergebnis gespeichert.
+Kommen neue Dokumente hinzu oder werden Dokumente entfernt, werden nur die Jahre
+invalidiert, die im geänderten Text vorkommen - alle anderen Jahre werden aus dem
+Cache übernommen und nur neu zusammengeführt.
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from config import get_config
+from models import db, ReportYearPart
+from providers import get_token_threshold
+from reports import get_system_pdf_path, get_system_pdf_version
+from utils import extract_year_statistics
+
+logger = logging.getLogger(__name__)
+
+
+def year_cache_enabled():
+    return str(get_config("REPORT_YEAR_CACHE", "true")).lower() in ("1", "true", "yes")
+
+
+def template_fingerprint(template, health_record):
+    """
+    Berechnet die Template-Version für den Jahres-Cache.
+
+    Enthalten sind alle Template-Felder, die Version der System-PDF (mtime und Größe wie in der
+    Upload-Registry, ein neuer Upload unter gleichem Namen ändert sie), die Custom Instructions
+    (falls verwendet) und der gewählte Anbieter (GPT/Gemini). Die medizinischen Codes sind bewusst nicht enthalten,
+    da sie aus denselben Dokumenten stammen, deren Jahre ohnehin invalidiert werden.
+    """
+    use_gemini = (health_record.token_count or 0) > get_token_threshold()
+    payload = [
+        template.template_name,
+        template.output_format,
+        template.example_structure,
+        template.system_prompt,
+        template.prompt,
+        bool(template.use_custom_instructions),
+        template.system_pdf_filename,
+        system_pdf_version(template.system_pdf_filename),
+        health_record.custom_instructions if template.use_custom_instructions else None,
+        'gemini' if use_gemini else 'gpt',
+    ]
+    return hashlib.sha256(json.dumps(payload, default=str).encode('utf-8')).hexdigest()
+
+
+def system_pdf_version(filename):
+    """Versionsschlüssel der System-PDF, None ohne PDF bzw. wenn die Datei fehlt"""
+    if not filename:
+        return None
+    try:
+        return get_system_pdf_version(get_system_pdf_path(filename))
+    except OSError:
+        return None
+
+
+def years_in_text(text, birth_date=None):
+    """Alle Jahre, die in einem (neuen oder entfernten) Text erwähnt werden"""
+    stats = extract_year_statistics(text, birth_date)
+    return set(stats['dated_years']) | set(stats['bare_years'])
+
+
+def load_year_parts(record_id, template_id, template_version):
+    """
+    Lädt die gecachten Jahresergebnisse. Einträge einer älteren Template-Version werden verworfen.
+
+    :return: Dictionary {Jahr: serialisiertes Ergebnis}
+    """
+    parts = ReportYearPart.query.filter_by(health_record_id=record_id, report_template_id=template_id).all()
+    cached = {}
+    stale = 0
+    for part in parts:
+        if part.template_version == template_version:
+            cached[part.year] = part.content
+        else:
+            db.session.delete(part)
+            stale += 1
+    if stale:
+        db.session.commit()
+        logger.info(f"Jahres-Cache: {stale} veraltete Einträge für Record {record_id}, Template {template_id} entfernt")
+    return cached
+
+
+def make_year_part_store(record_id, template_id, template_version):
+    """Erzeugt den Callback, mit dem generate_report neu generierte Jahre im Cache speichert"""
+    def store(year, content):
+        try:
+            part = ReportYearPart.query.filter_by(
+                health_record_id=record_id, report_template_id=template_id, year=year
+            ).first()
+            if part is None:
+                part = ReportYearPart(health_record_id=record_id, report_template_id=template_id, year=year)
+                db.session.add(part)
+            part.template_version = template_version
+            part.content = content
+            part.created_at = datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Jahres-Cache: Speichern von Jahr {year} fehlgeschlagen: {e}")
+    return store
+
+
+def year_cache_kwargs(health_record, template):
+    """
+    Liefert cached_year_parts und on_year_part für generate_report.
+    Bei deaktiviertem Cache werden keine zusätzlichen Argumente übergeben.
+    """
+    if not year_cache_enabled():
+        return {}
+    template_version = template_fingerprint(template, health_record)
+    cached = load_year_parts(health_record.id, template.id, template_version)
+    logger.info(f"Jahres-Cache: {len(cached)} Jahre für Record {health_record.id}, Template {template.id} vorhanden")
+    return {
+        'cached_year_parts': cached,
+        'on_year_part': make_year_part_store(health_record.id, template.id, template_version),
+    }
+
+
+def invalidate_years(record_id, years=None):
+    """
+    Invalidiert gecachte Jahresergebnisse eines Datensatzes.
+
+    :param years: Betroffene Jahre; None invalidiert alle Jahre
+    :return: Anzahl gelöschter Einträge
+    """
+    query = ReportYearPart.query.filter_by(health_record_id=record_id)
+    if years is not None:
+        if not years:
+            return 0
+        query = query.filter(ReportYearPart.year.in_(list(years)))
+    deleted = query.delete(synchronize_session=False)
+    logger.info(f"Jahres-Cache: {deleted} Einträge für Record {record_id} invalidiert (Jahre: {sorted(years) if years is not None else 'alle'})")
+    return deleted
+
+
+def invalidate_text_years(record_id, text, birth_date=None):
+    """Invalidiert alle Jahre, die in einem geänderten Textabschnitt vorkommen"""
+    return invalidate_years(record_id, years_in_text(text, birth_date))
@@ -0,0 +1,105 @@
+# report_merge.py
+"""
+Zusammenführung der JSON-Jahresberichte ohne pandas.
+
+Jahresergebnisse sind Listen von Dictionaries, deren 'Datum' als ISO-Datum (YYYY-MM-DD)
+normalisiert ist. ISO-Daten sind lexikographisch sortierbar, daher reicht ein stabiler
+Sortierschlüssel; die Jahreslisten werden per k-Wege-Merge (heapq.merge) zusammengeführt.
+"""
+import heapq
+import json
+import re
+from datetime import date
+
+DATE_FIELD = 'Datum'
+
+# (Regex, Reihenfolge der Gruppen als Jahr/Monat/Tag); deutsche Formate sind Tag-zuerst
+DATE_FORMATS = (
+    (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})(?:[T ].*)?$'), ('y', 'm', 'd')),
+    (re.compile(r'^(\d{1,2})\.(\d{1,2})\.(\d{4})$'), ('d', 'm', 'y')),
+    (re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$'), ('d', 'm', 'y')),
+    (re.compile(r'^(\d{1,2})[./](\d{4})$'), ('m', 'y')),
+    (re.compile(r'^(\d{4})-(\d{1,2})$'), ('y', 'm')),
+    (re.compile(r'^(\d{4})$'), ('y',)),
+)
+
+
+def parse_date(value):
+    """
+    Normalisiert eine Datumsangabe auf YYYY-MM-DD.
+
+    :return: ISO-Datum als String oder None, wenn die Angabe nicht erkannt wird
+    """
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for pattern, order in DATE_FORMATS:
+        match = pattern.match(value)
+        if not match:
+            continue
+        parts = dict(zip(order, (int(group) for group in match.groups())))
+        try:
+            return date(parts['y'], parts.get('m', 1), parts.get('d', 1)).isoformat()
+        except ValueError:
+            return None
+    return None
+
+
+def sort_key(record):
+    """Datumsschlüssel; Einträge ohne erkennbares Datum werden ans Ende sortiert"""
+    value = record.get(DATE_FIELD)
+    iso = value if isinstance(value, str) and parse_date(value) == value else None
+    return (iso is None, iso or '')
+
+
+def prepare_year_records(data):
+    """
+    Bereitet die Einträge eines Jahres auf: Whitespace entfernen, Datum normalisieren
+    und stabil nach Datum sortieren. Nicht erkennbare Daten bleiben unverändert erhalten.
+
+    :param data: Liste von Dictionaries aus der Modell-Antwort
+    :return: Sortierte Liste von Dictionaries
+    """
+    records = []
+    for item in data or []:
+        if not isinstance(item, dict):
+            continue
+        record = {key: value.strip() if isinstance(value, str) else value for key, value in item.items()}
+        if DATE_FIELD in record:
+            record[DATE_FIELD] = parse_date(record[DATE_FIELD]) or record[DATE_FIELD]
+        records.append(record)
+    records.sort(key=sort_key)
+    return records
+
+
+def merge_year_records(year_records):
+    """
+    Stabiler k-Wege-Merge mehrerer bereits sortierter Jahreslisten.
+    Bei gleichem Datum bleibt die Reihenfolge der Eingabelisten erhalten.
+    """
+    return list(heapq.merge(*year_records, key=sort_key))
+
+
+def dedupe_records(records):
+    """Entfernt exakte Duplikate (z.B. aus überlappenden Map-Reduce-Abschnitten)"""
+    seen = set()
+    unique = []
+    for record in records:
+        key = json.dumps(record, sort_keys=True, ensure_ascii=False, default=str)
+        if key not in seen:
+            seen.add(key)
+            unique.append(record)
+    return unique
+
+
+def records_to_json(records):
+    """
+    Serialisiert die Einträge als JSON-Array. Alle Einträge erhalten die Vereinigung der
+    Schlüssel (in Reihenfolge des ersten Auftretens), fehlende Werte werden zu null.
+    """
+    columns = {}
+    for record in records:
+        for key in record:
+            columns.setdefault(key, None)
+    rows = [{key: record.get(key) for key in columns} for record in records]
+    return json.dumps(rows, ensure_ascii=False, default=str)
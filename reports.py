@@ -1,18 +1,20 @@
 import os
 import json
-import pandas as pd
 import base64
 from utils import repair_json
-from openai import OpenAI
-from datetime import datetime
-import google.generativeai as genai
-from google.ai.generativelanguage_v1beta.types import content
-from google.generativeai.types import content_types
+from datetime import datetime, timedelta
 import logging
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from tenacity import retry, stop_after_attempt, wait_exponential
 import httpx
 from config import get_config
+from report_merge import prepare_year_records, merge_year_records, dedupe_records, records_to_json
+from metrics import provider_request, provider_retried
+from usage import carry_context, usage_scope
+from providers import get_gemini_model, get_compiled_schema, get_genai, get_openai_client, get_openai_model, get_token_threshold, GEMINI_SAFETY_SETTINGS
 
 # Konfiguration des Loggings
 logging.basicConfig(
@@ -25,32 +27,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Konfiguration der OpenAI- und Google Gemini-Clients mit Azure Key Vault
-openai_client = OpenAI(
-    api_key=get_config("OPENAI_API_KEY"),
-    timeout=500,
-    max_retries=10,
-    http_client=httpx.Client(
-        timeout=httpx.Timeout(
-            connect=60.0,    # Timeout für den Verbindungsaufbau
-            read=120.0,      # Timeout für das Lesen der Antwort
-            write=60.0,      # Timeout für das Schreiben der Anfrage
-            pool=60.0        # Timeout für Connection-Pool
-        )
-    )
-)
-openai_model = get_config("OPENAI_MODEL")
-token_threshold = int(get_config("TOKEN_THRESHOLD", "100000"))
-logger.info(f"📊 TOKEN_THRESHOLD aus Key Vault geladen: {token_threshold}")
+# Die API-Clients kommen lazy aus der Provider-Registry (providers.py)
+
+# Map-Reduce-Modus für Datensätze, die das Kontextfenster überschreiten
+report_max_split_depth = 3
 
-genai.configure(api_key=get_config("GEMINI_API_KEY"))
-gemini_model = genai.GenerativeModel(model_name=get_config("GEMINI_MODEL"))
+def get_report_chunk_tokens():
+    return int(get_config("REPORT_CHUNK_TOKENS", "700000"))
+
+def get_report_map_workers():
+    return int(get_config("REPORT_MAP_WORKERS", "4"))
 
 
 # Retry-Decorator für OpenAI API Calls
 @retry(
     stop=stop_after_attempt(5),    # Erhöht auf 5 Versuche
     wait=wait_exponential(multiplier=2, min=4, max=60),  # Längeres maximales Warten
+    before_sleep=lambda retry_state: provider_retried('openai'),
     reraise=True
 )
 def make_openai_request(api_params):
@@ -62,7 +55,8 @@ def make_openai_request(api_params):
         logger.debug(f"Request Parameter: {api_params}")
         
         start_time = time.time()
-        response = openai_client.chat.completions.create(**api_params)
+        with provider_request('openai', 'report') as call:
+            response = call.usage(get_openai_client().chat.completions.create(**api_params))
         end_time = time.time()
         
         duration = round(end_time - start_time, 2)
@@ -179,10 +173,25 @@ def generate_gemini_schema_from_example(example_structure):
         logger.info("Verwende Standard-Schema als Fallback")
         return get_default_gemini_schema()
 
+def get_template_schema(example_structure):
+    """
+    Liefert das kompilierte Gemini-Schema einer Template-Struktur aus dem Cache.
+
+    :return: Tuple (schema_hash, schema)
+    """
+    return get_compiled_schema(example_structure, generate_gemini_schema_from_example)
+
+def warm_template_schema(output_format, example_structure):
+    """Kompiliert das Schema beim Speichern eines JSON-Templates vor"""
+    if output_format and output_format.lower() == "json":
+        get_template_schema(example_structure)
+
 def build_schema_recursive(obj, is_root=True):
     """
     Baut rekursiv ein Gemini Schema aus einem JSON-Objekt
     """
+    from google.ai.generativelanguage_v1beta.types import content
+
     if isinstance(obj, dict):
         properties = {}
         required_keys = []
@@ -232,6 +241,8 @@ def get_default_gemini_schema():
     """
     Gibt das Standard-Schema zurück (das bisherige hart codierte)
     """
+    from google.ai.generativelanguage_v1beta.types import content
+
     return content.Schema(
         type=content.Type.OBJECT,
         enum=[],
@@ -285,7 +296,7 @@ def generate_report_gpt5(output_format, example_structure, system_prompt, prompt
 
         # Basis-Parameter für die API-Anfrage
         api_params = {
-            "model": openai_model,
+            "model": get_openai_model(),
             "messages": [
                 {"role": "system", "content": year_focussed_actual_prompt},
                 {"role": "user", "content": f"Das ist deine Datenbasis: {health_record_text}"}
@@ -321,22 +332,8 @@ def generate_report_gpt5(output_format, example_structure, system_prompt, prompt
                 # Extrahieren der Daten aus dem ersten Schlüssel
                 data = json_data.get(first_key, [])
 
-                # Bereinigung von Whitespaces
-                for item in data:
-                    for key, value in item.items():
-                        if isinstance(value, str):
-                            item[key] = value.strip()
-
-                # Konvertiere in DataFrame für einfache Sortierung, falls möglich
-                df = pd.DataFrame(data)
-
-                if 'Datum' in df.columns:
-                    df['Datum'] = pd.to_datetime(df['Datum'])
-                    df_sorted = df.sort_values('Datum')
-                else:
-                    df_sorted = df
-
-                return df_sorted
+                # Whitespaces bereinigen, Datum normalisieren und stabil sortieren
+                return prepare_year_records(data)
 
             else:
                 # Wenn das Ausgabeformat Text ist, gib den Text zurück
@@ -359,8 +356,89 @@ def get_system_pdf_path(filename):
     system_prompts_dir = os.path.join(os.path.dirname(__file__), 'system', 'prompts')
     return os.path.join(system_prompts_dir, filename)
 
+# System-PDF-Cache: pro Dateiname nur die aktuelle Version (mtime + Größe)
+system_pdf_upload_registry = os.path.join(os.path.dirname(__file__), 'system', 'prompts', '.gemini_uploads.json')
+system_pdf_upload_margin = timedelta(hours=1)  # Hochgeladene Dateien rechtzeitig vor Ablauf erneuern
+_system_pdf_cache = {}
+_system_pdf_lock = threading.Lock()
+
+def system_pdf_upload_enabled():
+    return str(get_config("SYSTEM_PDF_UPLOAD", "true")).lower() in ("1", "true", "yes")
+
+def get_system_pdf_version(pdf_path):
+    """Versionsschlüssel einer System-PDF aus mtime und Dateigröße"""
+    stat = os.stat(pdf_path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def read_system_pdf_registry():
+    """Liest die Registry der bei Gemini hochgeladenen System-PDFs"""
+    try:
+        with open(system_pdf_upload_registry, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_system_pdf_registry(registry):
+    """Schreibt die Upload-Registry atomar"""
+    tmp_path = f"{system_pdf_upload_registry}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(registry, f)
+    os.replace(tmp_path, system_pdf_upload_registry)
+
+def upload_system_pdf_to_gemini(pdf_filename, pdf_path, version):
+    """
+    Lädt eine System-PDF einmal pro Version über die Gemini File API hoch.
+    Bereits hochgeladene, noch gültige Dateien werden aus der Registry wiederverwendet.
+
+    :return: Part-Objekt mit Dateiverweis oder None (dann Inline-Fallback)
+    """
+    registry = read_system_pdf_registry()
+    entry = registry.get(pdf_filename)
+    now = datetime.utcnow()
+
+    if not entry or entry.get('version') != version or datetime.fromisoformat(entry['expires_at']) - system_pdf_upload_margin <= now:
+        uploaded = get_genai().upload_file(pdf_path, mime_type="application/pdf", display_name=pdf_filename)
+        expires_at = uploaded.expiration_time.replace(tzinfo=None) if getattr(uploaded, 'expiration_time', None) else now + timedelta(hours=47)
+        entry = {
+            'version': version,
+            'name': uploaded.name,
+            'uri': uploaded.uri,
+            'expires_at': expires_at.isoformat(),
+        }
+        registry[pdf_filename] = entry
+        write_system_pdf_registry(registry)
+        logger.info(f"System-PDF bei Gemini hochgeladen: {pdf_filename} -> {uploaded.name} (gültig bis {entry['expires_at']})")
+
+    from google.generativeai.types import content_types
+    return content_types.to_part({
+        "file_data": {
+            "mime_type": "application/pdf",
+            "file_uri": entry['uri']
+        }
+    })
+
+def load_system_pdf_inline(pdf_filename, pdf_path):
+    """Lädt eine System-PDF als Inline-Daten (Fallback ohne File API)"""
+    with open(pdf_path, 'rb') as f:
+        pdf_data = f.read()
+
+    from google.generativeai.types import content_types
+    pdf_part = content_types.to_part({
+        "inline_data": {
+            "mime_type": "application/pdf",
+            "data": base64.b64encode(pdf_data).decode('utf-8')
+        }
+    })
+    logger.info(f"System-PDF als Inline-Daten geladen: {pdf_filename} ({len(pdf_data)} bytes)")
+    return pdf_part
+
 def load_system_pdf_for_gemini(pdf_filename):
-    """Lädt eine System-PDF für Gemini - als Inline-Daten statt Upload"""
+    """
+    Lädt eine System-PDF für Gemini.
+
+    Das Part-Objekt wird pro Dateiversion (mtime + Größe) im Speicher gecacht. Bevorzugt wird
+    ein Verweis auf die einmal hochgeladene Datei, sonst werden die Daten inline angehängt.
+    """
     if not pdf_filename:
         return None
     
@@ -370,26 +448,34 @@ def load_system_pdf_for_gemini(pdf_filename):
         return None
     
     try:
-        logger.info(f"Lade System-PDF für Gemini: {pdf_path}")
-        
-        # Für Gemini 2.5: PDF als Inline-Daten laden statt Upload
-        # Lese die PDF-Datei als Bytes
-        with open(pdf_path, 'rb') as f:
-            pdf_data = f.read()
-        
-        # Erstelle ein Inline-Datenobjekt für Gemini
-        pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
-        
-        # Erstelle das Part-Objekt für Gemini
-        pdf_part = content_types.to_part({
-            "inline_data": {
-                "mime_type": "application/pdf",
-                "data": pdf_base64
-            }
-        })
-        
-        logger.info(f"System-PDF erfolgreich als Inline-Daten geladen: {pdf_filename} ({len(pdf_data)} bytes)")
-        return pdf_part
+        version = get_system_pdf_version(pdf_path)
+        cached = _system_pdf_cache.get(pdf_filename)
+        if cached and cached[0] == version and (cached[2] is None or cached[2] > datetime.utcnow()):
+            return cached[1]
+
+        with _system_pdf_lock:
+            cached = _system_pdf_cache.get(pdf_filename)
+            if cached and cached[0] == version and (cached[2] is None or cached[2] > datetime.utcnow()):
+                return cached[1]
+
+            pdf_part = None
+            valid_until = None
+            if system_pdf_upload_enabled():
+                try:
+                    pdf_part = upload_system_pdf_to_gemini(pdf_filename, pdf_path, version)
+                    entry = read_system_pdf_registry().get(pdf_filename, {})
+                    valid_until = datetime.fromisoformat(entry['expires_at']) - system_pdf_upload_margin if entry else None
+                except Exception as upload_error:
+                    logger.warning(f"Upload der System-PDF fehlgeschlagen, verwende Inline-Daten: {upload_error}")
+                    pdf_part = None
+                    # Upload später erneut versuchen
+                    valid_until = datetime.utcnow() + timedelta(minutes=10)
+
+            if pdf_part is None:
+                pdf_part = load_system_pdf_inline(pdf_filename, pdf_path)
+
+            _system_pdf_cache[pdf_filename] = (version, pdf_part, valid_until)
+            return pdf_part
         
     except Exception as e:
         logger.error(f"Fehler beim Laden der System-PDF: {e}")
@@ -397,6 +483,29 @@ def load_system_pdf_for_gemini(pdf_filename):
         logger.error(traceback.format_exc())
         return None
 
+def invalidate_system_pdf(pdf_filename):
+    """
+    Verwirft den Cache und die hochgeladene Datei einer System-PDF
+    (nach Upload einer neuen Version oder beim Löschen).
+    """
+    if not pdf_filename:
+        return
+    with _system_pdf_lock:
+        _system_pdf_cache.pop(pdf_filename, None)
+        registry = read_system_pdf_registry()
+        entry = registry.pop(pdf_filename, None)
+        if entry is not None:
+            try:
+                write_system_pdf_registry(registry)
+            except OSError as e:
+                logger.warning(f"Upload-Registry konnte nicht geschrieben werden: {e}")
+    if entry:
+        try:
+            get_genai().delete_file(entry['name'])
+            logger.info(f"Hochgeladene System-PDF gelöscht: {entry['name']}")
+        except Exception as e:
+            logger.warning(f"Hochgeladene System-PDF {entry.get('name')} konnte nicht gelöscht werden: {e}")
+
 # Funktion für die Erstellung des Berichts mit Google Gemini
 def generate_report_gemini(output_format, example_structure, system_prompt, prompt, health_record_text, year, health_record_custom_instructions, use_custom_instructions, record_id=None, medical_codes_text=None, system_pdf_filename=None):
     """
@@ -440,15 +549,16 @@ def generate_report_gemini(output_format, example_structure, system_prompt, prom
         logger.info(f"Gemini Model: {get_config('GEMINI_MODEL')}")
 
         try:
+            response_schema = None
+            response_schema_key = None
             if output_format.lower() == "json":
-                # Generiere Schema aus example_structure
-                response_schema = generate_gemini_schema_from_example(example_structure)
-                logger.info("Verwende dynamisch generiertes Schema basierend auf example_structure")
+                # Schema aus example_structure (einmal pro Template-Version kompiliert)
+                response_schema_key, response_schema = get_template_schema(example_structure)
+                logger.info("Verwende gecachtes Schema basierend auf example_structure")
                 
                 generation_config = {
                     "temperature": 0.2,
                     "max_output_tokens": 32000,  # Erhöht von 8192 auf 32000
-                    "response_schema": response_schema,
                     "response_mime_type": "application/json",
                 }
             else:
@@ -457,33 +567,23 @@ def generate_report_gemini(output_format, example_structure, system_prompt, prom
                     "temperature": 1
                 }
 
-            # Safety Settings für medizinische Daten
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-            
-            gemini_model = genai.GenerativeModel(
-                model_name=get_config("GEMINI_MODEL"),
+            # Wiederverwendbare Modell-Instanz (Safety Settings für medizinische Daten)
+            gemini_model = get_gemini_model(
+                get_config("GEMINI_MODEL"),
                 generation_config=generation_config,
-                safety_settings=safety_settings
-            )
-
-            chat_session = gemini_model.start_chat(
-                history=[]
+                response_schema=response_schema,
+                response_schema_key=response_schema_key
             )
 
             # Erstelle die Nachricht mit oder ohne PDF
             if system_pdf_file:
-                # Mit System-PDF (als Inline-Daten)
+                # Mit System-PDF (hochgeladene Datei oder Inline-Daten, gecacht)
                 message_content = [
                     system_pdf_file,
                     f"{year_focussed_actual_prompt}\n\nDas ist deine Datenbasis: {health_record_text}"
                 ]
                 logger.info(f"📤 Sende Nachricht MIT System-PDF an Gemini: {system_pdf_filename}")
-                logger.info(f"   PDF als Inline-Daten geladen")
+                logger.info(f"   PDF als {'Dateiverweis' if system_pdf_file.file_data.file_uri else 'Inline-Daten'} angehängt")
                 logger.info(f"   Prompt-Länge: {len(year_focussed_actual_prompt)} chars")
                 logger.info(f"   Daten-Länge: {len(health_record_text)} chars")
             else:
@@ -492,7 +592,8 @@ def generate_report_gemini(output_format, example_structure, system_prompt, prom
                 logger.info("📤 Sende Nachricht OHNE System-PDF an Gemini")
                 logger.info(f"   Nachricht-Länge: {len(message_content)} chars")
 
-            response = chat_session.send_message(message_content)
+            with provider_request('gemini', 'report') as call:
+                response = call.usage(gemini_model.generate_content(message_content), gemini_model.model_name)
             logger.info("✅ Antwort von Gemini erhalten")
             
             # Bessere Gemini Response-Behandlung
@@ -539,23 +640,8 @@ def generate_report_gemini(output_format, example_structure, system_prompt, prom
                     # Extrahiere die Daten aus dem ersten Schlüssel
                     data = json_data.get(first_key, [])
                     
-                    # Bereinigung von Whitespaces
-                    for item in data:
-                        if isinstance(item, dict):
-                            for key, value in item.items():
-                                if isinstance(value, str):
-                                    item[key] = value.strip()
-
-                    # Konvertiere in DataFrame
-                    df = pd.DataFrame(data)
-                    
-                    if 'Datum' in df.columns:
-                        df['Datum'] = pd.to_datetime(df['Datum'])
-                        df_sorted = df.sort_values('Datum')
-                    else:
-                        df_sorted = df
-
-                    return df_sorted
+                    # Whitespaces bereinigen, Datum normalisieren und stabil sortieren
+                    return prepare_year_records(data)
 
                 except json.JSONDecodeError as json_err:
                     logger.error(f"Fehler beim Parsen des JSON von Google Gemini für Jahr {year}: {json_err}")
@@ -573,11 +659,190 @@ def generate_report_gemini(output_format, example_structure, system_prompt, prom
         logger.error(f"Fehler bei der Verarbeitung mit Google Gemini: {e}")
         return None
 
+def chunk_record_text(health_record_text, health_record_token_count, max_tokens):
+    """
+    Teilt den Datensatz-Text an Seitengrenzen in Abschnitte von höchstens max_tokens.
+
+    Die Token-Anzahl je Abschnitt wird über das Verhältnis Zeichen/Token des gesamten
+    Datensatzes geschätzt, damit nicht jeder Abschnitt erneut tokenisiert werden muss.
+
+    :return: Liste von Text-Abschnitten (ein Element, wenn keine Teilung nötig ist)
+    """
+    if not health_record_text or not health_record_token_count or health_record_token_count <= max_tokens:
+        return [health_record_text]
+
+    chars_per_token = len(health_record_text) / health_record_token_count
+    max_chars = max(1, int(max_tokens * chars_per_token))
+
+    chunks = []
+    current = []
+    current_len = 0
+    for segment in re.split(r'(?<=</page>)', health_record_text):
+        # Einzelne Seiten, die selbst zu groß sind, hart teilen
+        pieces = [segment[i:i + max_chars] for i in range(0, len(segment), max_chars)] or ['']
+        for piece in pieces:
+            if current and current_len + len(piece) > max_chars:
+                chunks.append(''.join(current))
+                current, current_len = [], 0
+            current.append(piece)
+            current_len += len(piece)
+    if current:
+        chunks.append(''.join(current))
+
+    logger.info(f"Datensatz in {len(chunks)} Abschnitte à max. {max_tokens} Tokens geteilt")
+    return chunks
+
+def generate_year_report(use_gemini, output_format, example_structure, system_prompt, prompt, health_record_text, year, health_record_custom_instructions, use_custom_instructions, record_id=None, medical_codes_text=None, system_pdf_filename=None):
+    """Erzeugt den Bericht eines Jahres für einen (Teil-)Text mit dem gewählten Modell"""
+    if use_gemini:
+        return generate_report_gemini(
+            output_format, example_structure, system_prompt,
+            prompt, health_record_text, year, health_record_custom_instructions,
+            use_custom_instructions, record_id, medical_codes_text, system_pdf_filename
+        )
+    return generate_report_gpt5(
+        output_format, example_structure, system_prompt,
+        prompt, health_record_text, year, health_record_custom_instructions,
+        use_custom_instructions, record_id, medical_codes_text
+    )
+
+def is_max_tokens_result(result):
+    """Prüft, ob ein Teilergebnis am Token-Limit abgebrochen wurde"""
+    return isinstance(result, str) and result.startswith("[MAX_TOKENS]")
+
+# Präfixe der Fehler-Strings aus generate_report_gemini bzw. process_combined_text_gemini
+FAILED_RESULT_PREFIXES = ("[MAX_TOKENS]", "[SAFETY BLOCKED]", "[RECITATION BLOCKED]", "[ERROR]")
+
+def is_failed_result(result):
+    """Prüft, ob ein (Teil-)Ergebnis fehlgeschlagen ist: None nach API-/JSON-Fehler oder ein Fehler-String"""
+    return result is None or (isinstance(result, str) and result.startswith(FAILED_RESULT_PREFIXES))
+
+def generate_chunk_report(use_gemini, chunk_text, chunk_token_count, year, report_args, depth=0):
+    """
+    Map-Schritt: Bericht eines Jahres für einen Abschnitt.
+    Bricht das Modell am Token-Limit ab, wird der Abschnitt halbiert und erneut verarbeitet.
+
+    :return: Liste von Teilergebnissen (Eintragslisten oder Texte, None für fehlgeschlagene Abschnitte)
+    """
+    result = generate_year_report(use_gemini, year=year, health_record_text=chunk_text, **report_args)
+    if is_max_tokens_result(result) and depth < report_max_split_depth and chunk_token_count > 1:
+        logger.warning(f"Jahr {year}: Abschnitt mit ~{chunk_token_count} Tokens am Limit - teile weiter (Tiefe {depth + 1})")
+        half_tokens = max(1, chunk_token_count // 2)
+        partials = []
+        for sub_chunk in chunk_record_text(chunk_text, chunk_token_count, half_tokens):
+            partials.extend(generate_chunk_report(use_gemini, sub_chunk, half_tokens, year, report_args, depth + 1))
+        return partials
+    return [result]
+
+def merge_json_partials(partials):
+    """Reduce-Schritt für JSON: Teilergebnisse zusammenführen, Duplikate entfernen und nach Datum sortieren"""
+    year_records = [records for records in partials if isinstance(records, list) and records]
+    if not year_records:
+        return None
+    return dedupe_records(merge_year_records(year_records))
+
+def generate_year_report_chunked(use_gemini, chunks, chunk_tokens, year, template_name, report_args):
+    """
+    Map-Reduce für ein Jahr: Abschnitte parallel verarbeiten und die Teilergebnisse zusammenführen.
+    JSON wird per concat/dedupe zusammengeführt, Text über process_combined_text_*.
+
+    :return: (Ergebnis, vollständig) - vollständig ist False, sobald ein Abschnitt oder die
+             Zusammenführung fehlgeschlagen ist
+    """
+    output_format = report_args['output_format']
+    report_map_workers = get_report_map_workers()
+    logger.info(f"Jahr {year}: Map-Reduce über {len(chunks)} Abschnitte mit {report_map_workers} Workern")
+
+    partials = []
+    complete = True
+    with ThreadPoolExecutor(max_workers=report_map_workers) as executor:
+        futures = [
+            executor.submit(carry_context(generate_chunk_report), use_gemini, chunk, chunk_tokens, year, report_args)
+            for chunk in chunks
+        ]
+        # Reihenfolge der Abschnitte beibehalten
+        for future in futures:
+            try:
+                partials.extend(future.result())
+            except Exception as e:
+                logger.error(f"Jahr {year}: Abschnitt fehlgeschlagen: {e}")
+                complete = False
+    failed_chunks = sum(1 for p in partials if is_failed_result(p))
+    if failed_chunks:
+        logger.warning(f"Jahr {year}: {failed_chunks} Abschnitte ohne Ergebnis - Jahresergebnis unvollständig")
+        complete = False
+
+    if output_format.lower() == "json":
+        return merge_json_partials(partials), complete
+
+    text_partials = [p for p in partials if isinstance(p, str) and p.strip() and not is_max_tokens_result(p)]
+    if not text_partials:
+        return None, complete
+    if len(text_partials) == 1:
+        return text_partials[0], complete
+    combined_text = "\n".join(f"Teilbericht {i + 1} für Jahr {year}:\n{p}\n" for i, p in enumerate(text_partials))
+    reduce_fn = process_combined_text_gemini if use_gemini else process_combined_text_gpt5
+    reduced = reduce_fn(template_name, output_format, report_args['example_structure'],
+                        report_args['system_prompt'], report_args['prompt'], combined_text)
+    # Bei einem Fehler liefert process_combined_text_* die unverdichteten Teilberichte bzw. einen Fehler-String
+    if reduced == combined_text or is_failed_result(reduced):
+        complete = False
+    return reduced, complete
+
+def serialize_year_part(output_format, yearly_report):
+    """
+    Serialisiert ein vollständiges Jahresergebnis für den Jahres-Cache.
+    None steht hier für ein leeres Jahr und wird ebenfalls gespeichert, Fehler-Strings nicht.
+
+    :return: String oder None, wenn das Ergebnis nicht gecacht werden soll
+    """
+    if output_format.lower() == "json":
+        if yearly_report is None:
+            return "[]"
+        if isinstance(yearly_report, list):
+            return json.dumps(yearly_report, ensure_ascii=False, default=str)
+        return None
+    if yearly_report is None:
+        return ""
+    if is_failed_result(yearly_report):
+        return None
+    return yearly_report
+
+def deserialize_year_part(output_format, content):
+    """Stellt ein gecachtes Jahresergebnis wieder her (Eintragsliste bzw. Text, None für leere Jahre)"""
+    if output_format.lower() == "json":
+        records = json.loads(content) if content else []
+        return prepare_year_records(records) or None
+    return content or None
+
+def generate_year_report_with_fallback(use_gemini, chunks, chunk_tokens, year, template_name, health_record_text, health_record_token_count, report_args):
+    """
+    Bericht eines Jahres - direkt oder im Map-Reduce-Modus, wenn der Datensatz geteilt ist oder das Token-Limit erreicht wird.
+
+    :return: (Ergebnis, vollständig) - nur vollständige Ergebnisse dürfen in den Jahres-Cache
+    """
+    if len(chunks) > 1:
+        return generate_year_report_chunked(use_gemini, chunks, chunk_tokens, year, template_name, report_args)
+
+    yearly_report = generate_year_report(use_gemini, year=year, health_record_text=health_record_text, **report_args)
+    if is_max_tokens_result(yearly_report):
+        # Token-Limit erreicht: dieses Jahr abschnittsweise wiederholen
+        logger.warning(f"Jahr {year}: Token-Limit erreicht - wechsle in den Map-Reduce-Modus")
+        half_tokens = max(1, chunk_tokens // 2)
+        split_chunks = chunk_record_text(health_record_text, health_record_token_count, half_tokens)
+        return generate_year_report_chunked(use_gemini, split_chunks, half_tokens, year, template_name, report_args)
+    return yearly_report, not is_failed_result(yearly_report)
+
 # Hauptfunktion zur Generierung des Berichts
-def generate_report(template_name, output_format, example_structure, system_prompt, prompt, health_record_text, health_record_token_count, health_record_begin, health_record_end, health_record_custom_instructions, use_custom_instructions, record_id=None, medical_codes_text=None, system_pdf_filename=None):
+def generate_report(template_name, output_format, example_structure, system_prompt, prompt, health_record_text, health_record_token_count, health_record_begin, health_record_end, health_record_custom_instructions, use_custom_instructions, record_id=None, medical_codes_text=None, system_pdf_filename=None, cached_year_parts=None, on_year_part=None):
     """
     Generiert einen kombinierten Gesundheitsbericht für den angegebenen Zeitraum (mehrere Jahre).
+
+    :param cached_year_parts: Optionales Dictionary {Jahr: serialisiertes Ergebnis} aus dem Jahres-Cache;
+                              diese Jahre werden nicht neu generiert
+    :param on_year_part: Optionaler Callback (jahr, serialisiertes Ergebnis) für neu und vollständig generierte Jahre
     """
+    cached_year_parts = cached_year_parts or {}
     # Sichere Fallback-Prüfung für None-Datumswerte
     if health_record_begin is None or health_record_end is None:
         current_year = datetime.now().year
@@ -598,6 +863,7 @@ def generate_report(template_name, output_format, example_structure, system_prom
     text_reports = []
 
     # Entscheide, ob GPT-4 oder Gemini verwendet wird basierend auf Token-Threshold
+    token_threshold = get_token_threshold()
     use_gemini = health_record_token_count > token_threshold
     if use_gemini:
         logger.info(f"Verwende Google Gemini (Token-Count: {health_record_token_count} > Threshold: {token_threshold})")
@@ -610,29 +876,48 @@ def generate_report(template_name, output_format, example_structure, system_prom
     end_year = health_record_end.year
     logger.info(f"Verarbeite Jahre von {start_year} bis {end_year}")
 
-    for year in range(start_year, end_year + 1):
-        logger.info(f"Generiere Bericht für das Jahr {year}...")
+    # Datensätze jenseits des Kontextfensters werden abschnittsweise verarbeitet (Map-Reduce)
+    report_chunk_tokens = get_report_chunk_tokens()
+    chunks = chunk_record_text(health_record_text, health_record_token_count, report_chunk_tokens)
+    chunk_tokens = min(health_record_token_count or 0, report_chunk_tokens)
+    report_args = {
+        'output_format': output_format,
+        'example_structure': example_structure,
+        'system_prompt': system_prompt,
+        'prompt': prompt,
+        'health_record_custom_instructions': health_record_custom_instructions,
+        'use_custom_instructions': use_custom_instructions,
+        'record_id': record_id,
+        'medical_codes_text': medical_codes_text,
+        'system_pdf_filename': system_pdf_filename,
+    }
 
+    for year in range(start_year, end_year + 1):
         try:
-            if use_gemini:
-                yearly_report = generate_report_gemini(
-                    output_format, example_structure, system_prompt, 
-                    prompt, health_record_text, year, health_record_custom_instructions, 
-                    use_custom_instructions, record_id, medical_codes_text, system_pdf_filename
-                )
+            if year in cached_year_parts:
+                logger.info(f"Jahr {year}: verwende gecachtes Ergebnis")
+                yearly_report = deserialize_year_part(output_format, cached_year_parts[year])
             else:
-                yearly_report = generate_report_gpt5(
-                    output_format, example_structure, system_prompt,
-                    prompt, health_record_text, year, health_record_custom_instructions,
-                    use_custom_instructions, record_id, medical_codes_text
-                )
+                logger.info(f"Generiere Bericht für das Jahr {year}...")
+                with usage_scope(year=year):
+                    yearly_report, complete = generate_year_report_with_fallback(
+                        use_gemini, chunks, chunk_tokens, year, template_name,
+                        health_record_text, health_record_token_count, report_args
+                    )
+                if on_year_part and not complete:
+                    # Fehlgeschlagene Jahre nicht cachen, damit die nächste Erstellung sie erneut versucht
+                    logger.warning(f"Jahr {year}: Ergebnis unvollständig, wird nicht gecacht")
+                elif on_year_part:
+                    serialized = serialize_year_part(output_format, yearly_report)
+                    if serialized is not None:
+                        on_year_part(year, serialized)
 
             if yearly_report is not None:
                 if output_format.lower() == "json":
-                    # Prüfe ob yearly_report ein DataFrame oder ein String (Fehler) ist
-                    if isinstance(yearly_report, pd.DataFrame):
+                    # Prüfe ob yearly_report eine Eintragsliste oder ein String (Fehler) ist
+                    if isinstance(yearly_report, list):
                         logger.info(f"Jahr {year}: JSON-Report erfolgreich generiert")
-                        logger.debug(f"Jahr {year} Report Inhalt: {yearly_report.to_dict('records')[:2] if len(yearly_report) >= 2 else yearly_report.to_dict('records')}...")  # Zeige die ersten 2 Einträge
+                        logger.debug(f"Jahr {year} Report Inhalt: {yearly_report[:2]}...")  # Zeige die ersten 2 Einträge
                         all_year_reports.append(yearly_report)
                     elif isinstance(yearly_report, str):
                         # Bei Fehlern (z.B. SAFETY BLOCKED) ist yearly_report ein String
@@ -658,26 +943,14 @@ def generate_report(template_name, output_format, example_structure, system_prom
     if output_format.lower() == "json" and all_year_reports:
         try:
             logger.info("Beginne Zusammenführung der JSON-Reports...")
-            logger.info(f"Anzahl der zu kombinierenden DataFrames: {len(all_year_reports)}")
+            logger.info(f"Anzahl der zu kombinierenden Jahreslisten: {len(all_year_reports)}")
             
-            # Log die Struktur jedes DataFrames
-            for i, df in enumerate(all_year_reports):
-                logger.info(f"DataFrame {i} Struktur: {df.shape}, Spalten: {df.columns.tolist()}")
+            # Stabiler Merge der nach Datum sortierten Jahreslisten (Datum bereits als YYYY-MM-DD)
+            combined_report = merge_year_records(all_year_reports)
+            logger.info(f"Jahresberichte zusammengeführt. Einträge: {len(combined_report)}")
             
-            # Kombiniere alle jährlichen Berichte
-            combined_report = pd.concat(all_year_reports, ignore_index=True)
-            logger.info(f"Kombinierter DataFrame erstellt. Größe: {combined_report.shape}")
-            
-            # Konvertiere Datum zu String im YYYY-MM-DD Format vor der JSON-Konvertierung
-            if 'Datum' in combined_report.columns:
-                combined_report['Datum'] = combined_report['Datum'].dt.strftime('%Y-%m-%d')
-            
-            # Konvertiere zu JSON mit angepassten Parametern
-            combined_report_json = combined_report.to_json(
-                orient='records',
-                force_ascii=False,
-                date_format='iso'  # ISO Format für Datums-Strings
-            )
+            # Konvertiere zu JSON (fehlende Felder als null)
+            combined_report_json = records_to_json(combined_report)
             
             logger.info(f"JSON-Konvertierung abgeschlossen. Länge des JSON-Strings: {len(combined_report_json)}")
             logger.debug(f"Preview des kombinierten JSON: {combined_report_json[:500]}...")
@@ -701,14 +974,16 @@ def generate_report(template_name, output_format, example_structure, system_prom
             logger.info("Starte zusätzliche Verarbeitung des kombinierten Textberichts...")
             
             try:
-                if use_gemini:
-                    final_report = process_combined_text_gemini(
-                        template_name, output_format, example_structure, system_prompt, prompt, combined_text_report
-                    )
-                else:
-                    final_report = process_combined_text_gpt5(
-                        template_name, output_format, example_structure, system_prompt, prompt, combined_text_report
-                    )
+                # Eigene Stufe im Token-Verbrauch (der GPT-Pfad läuft über make_openai_request)
+                with usage_scope(stage='combine'):
+                    if use_gemini:
+                        final_report = process_combined_text_gemini(
+                            template_name, output_format, example_structure, system_prompt, prompt, combined_text_report
+                        )
+                    else:
+                        final_report = process_combined_text_gpt5(
+                            template_name, output_format, example_structure, system_prompt, prompt, combined_text_report
+                        )
                 logger.info(f"Zusätzliche Verarbeitung abgeschlossen. Finale Berichtslänge: {len(final_report)} Zeichen")
                 return final_report
             except Exception as e:
@@ -738,7 +1013,7 @@ def process_combined_text_gpt5(template_name, output_format, example_structure,
     )
 
     api_params = {
-        "model": openai_model,
+        "model": get_openai_model(),
         "messages": [
             {"role": "system", "content": final_system_prompt},
             {"role": "user", "content": final_prompt}
@@ -771,45 +1046,22 @@ def process_combined_text_gemini(template_name, output_format, example_structure
 
     try:
         # Generationskonfiguration
-        generation_config = genai.types.GenerationConfig(
-            max_output_tokens=32000,  # Erhöht von 8000 auf 32000
-            temperature=0.7
-        )
-
-        # Konfiguriere minimale Safety Settings für medizinische Daten
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_CIVIC_INTEGRITY",
-                "threshold": "BLOCK_NONE"
-            }
-        ]
+        generation_config = {
+            "max_output_tokens": 32000,  # Erhöht von 8000 auf 32000
+            "temperature": 0.7
+        }
 
-        # Erstelle neue Model-Instanz mit lockeren Safety Settings
-        safe_gemini_model = genai.GenerativeModel(
-            model_name=get_config("GEMINI_MODEL"),
+        # Wiederverwendbare Model-Instanz mit lockeren Safety Settings
+        safe_gemini_model = get_gemini_model(
+            get_config("GEMINI_MODEL"),
             generation_config=generation_config,
-            safety_settings=safety_settings
+            safety_settings=GEMINI_SAFETY_SETTINGS + (("HARM_CATEGORY_CIVIC_INTEGRITY", "BLOCK_NONE"),)
         )
 
-        response = safe_gemini_model.generate_content(
-            f"{final_system_prompt}\n\n{final_prompt}"
-        )
+        with provider_request('gemini', 'combine') as call:
+            response = call.usage(safe_gemini_model.generate_content(
+                f"{final_system_prompt}\n\n{final_prompt}"
+            ), safe_gemini_model.model_name)
         
         # Bessere Gemini Response-Behandlung
         try:
@@ -0,0 +1,142 @@
+# scheduling.py
+"""
+Prioritäten und Fair Share für die PDF-Verarbeitung.
+
+Celery arbeitet mit Redis nur dann wirklich priorisiert, wenn der Broker Prioritätsstufen
+kennt (broker_transport_options['priority_steps'], siehe celery_config). Dann gilt:
+0 ist die höchste, 9 die niedrigste Priorität.
+
+Die Priorität eines Uploads setzt sich zusammen aus
+    - der Basispriorität der Queue (aus CELERY_QUEUES),
+    - einer Größenstufe: kleine Dokumente (<= SCHED_SMALL_JOB_PAGES Seiten) laufen in der
+      Fast Lane, große Bündel werden zurückgestuft,
+    - dem Fair Share: je mehr Seiten ein Benutzer gerade in Verarbeitung hat, desto
+      niedriger die Priorität seiner weiteren Tasks.
+
+Die In-Flight-Seiten pro Benutzer liegen als Zähler in Redis. Ist Redis nicht erreichbar,
+wird ohne Fair Share weitergearbeitet.
+"""
+import logging
+import os
+
+from config import get_config
+from celery_config import queue_priority
+from providers import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+MIN_PRIORITY = 0
+MAX_PRIORITY = 9
+
+INFLIGHT_KEY = 'healthsum:sched:inflight_pages:{user_id}'
+# Läuft ein Aggregat nie (Worker-Absturz), heilt sich der Zähler nach dieser Zeit selbst
+INFLIGHT_TTL_SECONDS = 2 * 60 * 60
+
+# Grobe Schätzung für Uploads, bevor die Seitenzahl bekannt ist (gescannte Seiten)
+ESTIMATED_BYTES_PER_PAGE = 150 * 1024
+
+
+def small_job_pages():
+    return int(get_config("SCHED_SMALL_JOB_PAGES", "10"))
+
+
+def large_job_pages():
+    return int(get_config("SCHED_LARGE_JOB_PAGES", "200"))
+
+
+def fair_share_pages():
+    """Seiten in Verarbeitung, ab denen ein Benutzer pro Vielfachem eine Stufe verliert"""
+    return int(get_config("SCHED_FAIR_SHARE_PAGES", "100"))
+
+
+def clamp_priority(priority):
+    return max(MIN_PRIORITY, min(MAX_PRIORITY, int(priority)))
+
+
+def estimate_pages(file_paths):
+    """Schätzt die Seitenzahl aus der Dateigröße (ohne das PDF zu parsen)"""
+    total_bytes = 0
+    for file_path in file_paths:
+        try:
+            total_bytes += os.path.getsize(file_path)
+        except OSError:
+            continue
+    return max(1, total_bytes // ESTIMATED_BYTES_PER_PAGE)
+
+
+def size_adjustment(page_count):
+    """Fast Lane für kleine Dokumente, Zurückstufung für große Bündel"""
+    if page_count is None:
+        return 0
+    if page_count <= small_job_pages():
+        return -3
+    if page_count >= large_job_pages():
+        return 2
+    return 0
+
+
+def inflight_pages(user_id):
+    """Seiten, die der Benutzer gerade in Verarbeitung hat"""
+    if user_id is None:
+        return 0
+    try:
+        value = get_redis_client().get(INFLIGHT_KEY.format(user_id=user_id))
+        return int(value or 0)
+    except Exception as e:
+        logger.warning(f"Scheduling: In-Flight-Zähler für User {user_id} nicht lesbar: {e}")
+        return 0
+
+
+def fair_share_adjustment(user_id):
+    """Eine Stufe niedriger pro SCHED_FAIR_SHARE_PAGES Seiten in Verarbeitung (max. 4)"""
+    return min(4, inflight_pages(user_id) // max(1, fair_share_pages()))
+
+
+def task_priority(queue, user_id=None, page_count=None):
+    """
+    Broker-Priorität für einen Task.
+
+    :param queue: Ziel-Queue des Tasks (für die Basispriorität)
+    :param user_id: Benutzer, dem der Upload gehört (Fair Share)
+    :param page_count: Seitenzahl des Dokuments (Fast Lane), None wenn unbekannt
+    :return: Priorität 0 (höchste) bis 9 (niedrigste)
+    """
+    priority = queue_priority(queue)
+    priority += size_adjustment(page_count)
+    priority += fair_share_adjustment(user_id)
+    return clamp_priority(priority)
+
+
+def upload_priority(user_id, file_paths, page_count=None):
+    """Priorität für process_pdfs; ohne Seitenzahl aus der Ingestion wird sie geschätzt"""
+    if page_count is None:
+        page_count = estimate_pages(file_paths)
+    return task_priority('pdf_processing', user_id, page_count)
+
+
+def register_inflight(user_id, page_count):
+    """Zählt die Seiten eines Dokuments zum In-Flight-Volumen des Benutzers"""
+    if user_id is None or not page_count:
+        return
+    try:
+        key = INFLIGHT_KEY.format(user_id=user_id)
+        pipe = get_redis_client().pipeline()
+        pipe.incrby(key, int(page_count))
+        pipe.expire(key, INFLIGHT_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Scheduling: In-Flight-Zähler für User {user_id} nicht erhöht: {e}")
+
+
+def release_inflight(user_id, page_count):
+    """Nimmt die Seiten eines fertig extrahierten Dokuments wieder heraus"""
+    if user_id is None or not page_count:
+        return
+    try:
+        key = INFLIGHT_KEY.format(user_id=user_id)
+        client = get_redis_client()
+        if client.decrby(key, int(page_count)) <= 0:
+            client.delete(key)
+    except Exception as e:
+        logger.warning(f"Scheduling: In-Flight-Zähler für User {user_id} nicht verringert: {e}")
+
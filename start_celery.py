@@ -1,14 +1,49 @@
 """
-Celery Worker Start-Script mit eventlet monkey patching
+Celery Worker Start-Script mit Pool-abhängigem Monkey Patching
 
-WICHTIG: eventlet.monkey_patch() MUSS vor allen anderen Imports stehen!
+Der Pool wird aus den Argumenten (-P/--pool) oder der Umgebungsvariable
+CELERY_WORKER_POOL gelesen (Standard: eventlet). Nur für eventlet/gevent wird
+gepatcht - ein Prefork-Worker für CPU-Stufen bleibt ungepatcht.
+
+WICHTIG: Das Monkey Patching MUSS vor allen anderen Imports stehen!
+
+Aufruf:
+    python start_celery.py worker -P prefork -Q extraction_cpu --loglevel=info
+    celery -A start_celery.celery worker -P eventlet --loglevel=info
+
+Für die komplette Topologie (CPU- und I/O-Pool) siehe start_workers.py.
 """
-import eventlet
-eventlet.monkey_patch()
+import os
+import sys
+
+
+def selected_pool(argv):
+    """Liest den Pool aus -P/--pool, sonst aus CELERY_WORKER_POOL"""
+    for index, arg in enumerate(argv):
+        if arg in ('-P', '--pool') and index + 1 < len(argv):
+            return argv[index + 1]
+        if arg.startswith('--pool='):
+            return arg.split('=', 1)[1]
+        if arg.startswith('-P') and len(arg) > 2:
+            return arg[2:]
+    return os.getenv('CELERY_WORKER_POOL', 'eventlet')
+
+
+POOL = selected_pool(sys.argv[1:])
+
+if POOL == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif POOL == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
 
 # Jetzt erst die App importieren
 from app import celery
 
 if __name__ == '__main__':
-    celery.start()
-
+    argv = sys.argv[1:]
+    # Pool explizit setzen, falls er nur über die Umgebung gewählt wurde
+    if argv[:1] == ['worker'] and not any(arg.startswith(('-P', '--pool')) for arg in argv):
+        argv += ['--pool', POOL]
+    celery.start(argv=argv)
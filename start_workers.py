@@ -0,0 +1,117 @@
+"""
+Startet die komplette Worker-Topologie aus celery_config.WORKER_POOLS
+
+Pro Pool wird ein eigener Worker-Prozess über start_celery.py gestartet:
+    cpu  Prefork-Pool für convert/pdf_text/ocr/combine (Queue extraction_cpu)
+    io   Eventlet-Pool für API-Extraktoren, Berichte und alle übrigen Queues
+
+Aufruf:
+    python start_workers.py                  # alle Pools
+    python start_workers.py --pools cpu      # nur bestimmte Pools
+    python start_workers.py --beat           # zusätzlich Celery Beat starten
+    python start_workers.py --dry-run        # nur die Kommandos ausgeben
+
+Jeder Pool bekommt einen eigenen Metrik-Exporter (METRICS_WORKER_PORT_BASE + Index, Standard
+9101/9102) und ein eigenes PROMETHEUS_MULTIPROC_DIR, das beim Start geleert wird (siehe metrics.py).
+
+SIGINT/SIGTERM werden an alle Worker weitergereicht (Warm Shutdown). Beendet sich ein
+Worker unerwartet, werden die übrigen ebenfalls beendet, damit der Prozess-Supervisor
+(systemd, Docker) die gesamte Topologie neu startet.
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from celery_config import WORKER_POOLS
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+START_SCRIPT = os.path.join(PROJECT_DIR, 'start_celery.py')
+METRICS_DIR = os.path.join(tempfile.gettempdir(), 'healthsum_metrics')
+
+
+def worker_command(name, settings, loglevel):
+    """Baut das Kommando für einen Worker-Prozess"""
+    return [
+        sys.executable, START_SCRIPT, 'worker',
+        '--pool', settings['pool'],
+        '--concurrency', str(settings['concurrency']),
+        '--queues', ','.join(settings['queues']),
+        '--hostname', f'{name}@%h',
+        '--max-tasks-per-child', str(settings['max_tasks_per_child']),
+        '--prefetch-multiplier', str(settings['prefetch_multiplier']),
+        '--loglevel', loglevel,
+    ]
+
+
+def worker_env(name, index):
+    """Umgebung eines Worker-Prozesses mit eigenem Metrik-Port und Multiprocess-Verzeichnis"""
+    multiproc_dir = os.path.join(METRICS_DIR, name)
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+    port_base = int(os.getenv('METRICS_WORKER_PORT_BASE', '9101'))
+    return dict(os.environ, PROMETHEUS_MULTIPROC_DIR=multiproc_dir, METRICS_WORKER_PORT=str(port_base + index))
+
+
+def beat_command(loglevel):
+    return [sys.executable, START_SCRIPT, 'beat', '--loglevel', loglevel]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startet CPU- und I/O-Worker-Pools")
+    parser.add_argument('--pools', nargs='+', choices=sorted(WORKER_POOLS), default=sorted(WORKER_POOLS),
+                        help="Zu startende Pools")
+    parser.add_argument('--beat', action='store_true', help="Celery Beat als eigenen Prozess starten")
+    parser.add_argument('--loglevel', default='info')
+    parser.add_argument('--dry-run', action='store_true', help="Kommandos nur ausgeben")
+    args = parser.parse_args()
+
+    commands = {name: worker_command(name, WORKER_POOLS[name], args.loglevel) for name in args.pools}
+    if args.beat:
+        commands['beat'] = beat_command(args.loglevel)
+
+    if args.dry_run:
+        for name, command in commands.items():
+            print(f"{name}: {' '.join(command)}")
+        return 0
+
+    processes = {}
+    pool_names = sorted(WORKER_POOLS)
+    for name, command in commands.items():
+        env = worker_env(name, pool_names.index(name)) if name in WORKER_POOLS else None
+        print(f"🚀 Starte {name}: {' '.join(command[2:])}", flush=True)
+        # Eigene Session, damit ein Ctrl+C im Terminal nicht doppelt ankommt (sonst Cold Shutdown)
+        processes[name] = subprocess.Popen(command, cwd=PROJECT_DIR, start_new_session=True, env=env)
+
+    def shutdown(signum=signal.SIGTERM, frame=None):
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    exit_code = 0
+    try:
+        while processes:
+            for name, process in list(processes.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                del processes[name]
+                print(f"⏹️  {name} beendet (Exit-Code {code})", flush=True)
+                if code != 0:
+                    exit_code = code
+                    shutdown()
+            time.sleep(1)
+    finally:
+        shutdown()
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
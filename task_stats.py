@@ -0,0 +1,249 @@
+# task_stats.py
+"""
+Inkrementell gepflegte Task-Statistiken für die KPI-Seite.
+
+Statt bei jedem Aufruf von /kpi die komplette Historie zu laden, wird jeder abgeschlossene
+Task sofort in zwei Rollup-Tabellen gezählt:
+    - TaskStatRollup: pro Tag und Task Erfolge, Fehler, Retries sowie Summen von Dauer und
+      Queue-Wartezeit,
+    - TaskStatBucket: logarithmische Histogramme (Faktor BUCKET_FACTOR pro Bucket) von Dauer
+      und Wartezeit, aus denen p50/p95/p99 geschätzt werden (Fehler < 25%).
+Die Zählung erfolgt per Upsert mit Inkrement in der Datenbank, damit parallele Worker sich
+nicht gegenseitig überschreiben. Die KPI-Seite liest nur das Zeitfenster KPI_WINDOW_DAYS;
+ihre Laufzeit hängt damit nicht von der Größe der Historie ab.
+
+Die Queue-Wartezeit stammt aus dem Header enqueued_at, den tasks.py beim Publizieren setzt.
+Bestehende TaskLogs lassen sich mit migrate_task_stats.py nachträglich einrechnen.
+"""
+import logging
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from config import get_config
+from models import db, dialect_insert, TaskStatRollup, TaskStatBucket, TaskMonitor, HealthRecord
+from usage import usage_summary
+
+logger = logging.getLogger(__name__)
+
+BUCKET_BASE_SECONDS = 0.05
+BUCKET_FACTOR = 1.25
+MAX_BUCKET = 60  # ~9 Stunden
+PERCENTILES = (0.5, 0.95, 0.99)
+METRIC_DURATION = 'duration'
+METRIC_QUEUE_WAIT = 'queue_wait'
+
+
+def kpi_window_days():
+    return int(get_config("KPI_WINDOW_DAYS", "30"))
+
+
+def bucket_for(seconds):
+    """Bucket-Index einer Dauer (0 für alles bis BUCKET_BASE_SECONDS)"""
+    if seconds is None or seconds <= BUCKET_BASE_SECONDS:
+        return 0
+    return min(MAX_BUCKET, int(math.ceil(math.log(seconds / BUCKET_BASE_SECONDS, BUCKET_FACTOR))))
+
+
+def bucket_upper_bound(bucket):
+    return BUCKET_BASE_SECONDS * BUCKET_FACTOR ** bucket
+
+
+def short_task_name(name):
+    """'tasks.extract_ocr_optimized' -> 'extract_ocr_optimized' (wie in TaskLog)"""
+    return (name or 'unknown').rsplit('.', 1)[-1]
+
+
+def _increment_rollup(day, task_name, **increments):
+    table = TaskStatRollup.__table__
+    statement = dialect_insert(table).values(day=day, task_name=task_name, **{
+        column.name: increments.get(column.name, 0)
+        for column in table.columns if column.name not in ('id', 'day', 'task_name')
+    })
+    statement = statement.on_conflict_do_update(
+        index_elements=['day', 'task_name'],
+        set_={name: table.c[name] + statement.excluded[name] for name in increments}
+    )
+    db.session.execute(statement)
+
+
+def _increment_bucket(day, task_name, metric, seconds):
+    table = TaskStatBucket.__table__
+    statement = dialect_insert(table).values(day=day, task_name=task_name, metric=metric, bucket=bucket_for(seconds), count=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=['day', 'task_name', 'metric', 'bucket'],
+        set_={'count': table.c.count + 1}
+    )
+    db.session.execute(statement)
+
+
+def _record(description, func_, *args):
+    """Führt eine Zählung in eigenem App-Kontext aus; Fehler dürfen keinen Task abbrechen"""
+    try:
+        from app import app
+        with app.app_context():
+            func_(*args)
+            db.session.commit()
+    except Exception as e:
+        logger.warning(f"Task-Statistik ({description}) nicht gespeichert: {e}")
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+
+
+def record_task_outcome(task_name, status, duration_seconds=None, completed_at=None):
+    """Zählt einen abgeschlossenen Task ('success' oder 'failed') samt Dauer"""
+    day = (completed_at or datetime.utcnow()).date()
+
+    def record():
+        increments = {'success_count' if status == 'success' else 'failure_count': 1}
+        if duration_seconds is not None:
+            increments.update(duration_count=1, duration_sum=float(duration_seconds))
+        _increment_rollup(day, task_name, **increments)
+        if duration_seconds is not None:
+            _increment_bucket(day, task_name, METRIC_DURATION, duration_seconds)
+
+    _record(f"{task_name} {status}", record)
+
+
+def record_queue_wait(task_name, wait_seconds):
+    """Zählt die Zeit zwischen Publizieren und Start eines Tasks"""
+    day = datetime.utcnow().date()
+    wait_seconds = max(0.0, float(wait_seconds))
+
+    def record():
+        _increment_rollup(day, task_name, queue_wait_count=1, queue_wait_sum=wait_seconds)
+        _increment_bucket(day, task_name, METRIC_QUEUE_WAIT, wait_seconds)
+
+    _record(f"{task_name} queue wait", record)
+
+
+def record_retry(task_name):
+    day = datetime.utcnow().date()
+    _record(f"{task_name} retry", lambda: _increment_rollup(day, task_name, retry_count=1))
+
+
+def percentiles(bucket_counts, quantiles=PERCENTILES):
+    """
+    Schätzt Perzentile aus einem Histogramm.
+
+    :param bucket_counts: Dictionary {Bucket: Anzahl}
+    :return: Dictionary {Quantil: Sekunden (obere Bucket-Grenze)} bzw. None ohne Daten
+    """
+    total = sum(bucket_counts.values())
+    if not total:
+        return {quantile: None for quantile in quantiles}
+    result = {}
+    for quantile in quantiles:
+        threshold = quantile * total
+        cumulative = 0
+        for bucket in sorted(bucket_counts):
+            cumulative += bucket_counts[bucket]
+            if cumulative >= threshold:
+                result[quantile] = bucket_upper_bound(bucket)
+                break
+    return result
+
+
+def stage_stats(since):
+    """Kennzahlen pro Task im Zeitfenster (ab Datum since)"""
+    rows = db.session.query(
+        TaskStatRollup.task_name,
+        func.sum(TaskStatRollup.success_count),
+        func.sum(TaskStatRollup.failure_count),
+        func.sum(TaskStatRollup.retry_count),
+        func.sum(TaskStatRollup.duration_count),
+        func.sum(TaskStatRollup.duration_sum),
+        func.sum(TaskStatRollup.queue_wait_count),
+        func.sum(TaskStatRollup.queue_wait_sum),
+    ).filter(TaskStatRollup.day >= since).group_by(TaskStatRollup.task_name).all()
+
+    histograms = {}
+    for task_name, metric, bucket, count in db.session.query(
+        TaskStatBucket.task_name, TaskStatBucket.metric, TaskStatBucket.bucket, func.sum(TaskStatBucket.count)
+    ).filter(TaskStatBucket.day >= since).group_by(
+        TaskStatBucket.task_name, TaskStatBucket.metric, TaskStatBucket.bucket
+    ):
+        histograms.setdefault((task_name, metric), {})[bucket] = count
+
+    stages = []
+    for task_name, success, failed, retries, duration_count, duration_sum, wait_count, wait_sum in rows:
+        durations = percentiles(histograms.get((task_name, METRIC_DURATION), {}))
+        waits = percentiles(histograms.get((task_name, METRIC_QUEUE_WAIT), {}))
+        finished = (success or 0) + (failed or 0)
+        stages.append({
+            'task_name': task_name,
+            'success': success or 0,
+            'failed': failed or 0,
+            'retries': retries or 0,
+            'failure_rate': (failed or 0) / finished if finished else 0.0,
+            'avg_duration': duration_sum / duration_count if duration_count else None,
+            'p50': durations[0.5],
+            'p95': durations[0.95],
+            'p99': durations[0.99],
+            'avg_queue_wait': wait_sum / wait_count if wait_count else None,
+            'p95_queue_wait': waits[0.95],
+        })
+    return sorted(stages, key=lambda stage: stage['task_name'])
+
+
+def daily_throughput(since):
+    """Abgeschlossene Tasks pro Tag sowie verarbeitete Datensätze und Tokens (TaskMonitor)"""
+    tasks_per_day = dict(db.session.query(
+        TaskStatRollup.day, func.sum(TaskStatRollup.success_count)
+    ).filter(TaskStatRollup.day >= since).group_by(TaskStatRollup.day).all())
+
+    records_per_day = {}
+    for day, records, tokens in db.session.query(
+        func.date(TaskMonitor.created_at), func.count(TaskMonitor.id), func.sum(HealthRecord.token_count)
+    ).join(HealthRecord, TaskMonitor.health_record_id == HealthRecord.id).filter(
+        TaskMonitor.created_at >= datetime.combine(since, datetime.min.time()), TaskMonitor.end_date != None
+    ).group_by(func.date(TaskMonitor.created_at)):
+        records_per_day[str(day)] = (records, tokens or 0)
+
+    days = []
+    day = since
+    today = datetime.utcnow().date()
+    while day <= today:
+        records, tokens = records_per_day.get(str(day), (0, 0))
+        days.append({'day': day, 'tasks': tasks_per_day.get(day, 0) or 0, 'records': records, 'tokens': tokens})
+        day += timedelta(days=1)
+    return days
+
+
+def _elapsed_seconds(start, end):
+    if db.engine.dialect.name == 'postgresql':
+        return func.extract('epoch', end - start)
+    return (func.julianday(end) - func.julianday(start)) * 86400
+
+
+def tokens_per_second(since, create_reports):
+    """Tokens pro Sekunde über alle abgeschlossenen Verarbeitungen im Zeitfenster"""
+    tokens, total_seconds = db.session.query(
+        func.sum(HealthRecord.token_count), func.sum(_elapsed_seconds(TaskMonitor.start_date, TaskMonitor.end_date))
+    ).join(HealthRecord, TaskMonitor.health_record_id == HealthRecord.id).filter(
+        TaskMonitor.created_at >= since,
+        TaskMonitor.start_date != None,
+        TaskMonitor.end_date != None,
+        HealthRecord.token_count > 0,
+        HealthRecord.create_reports == create_reports,
+    ).one()
+    return (tokens or 0) / total_seconds if total_seconds else 0
+
+
+def kpi_summary(days=None):
+    """Alle Kennzahlen der KPI-Seite für die letzten days Tage"""
+    days = max(1, kpi_window_days() if days is None else days)
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    since_datetime = datetime.combine(since, datetime.min.time())
+    return {
+        'days': days,
+        'since': since,
+        'stages': stage_stats(since),
+        'throughput': daily_throughput(since),
+        'tps_reports': tokens_per_second(since_datetime, True),
+        'tps_no_reports': tokens_per_second(since_datetime, False),
+        'usage': usage_summary(since_datetime),
+    }
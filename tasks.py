@@ -1,28 +1,43 @@
 # tasks.py
 import os
 import logging
+import inspect
 from celery import chain, group, chord, shared_task
 from celery.schedules import crontab
+from celery.signals import worker_process_init, worker_ready, worker_process_shutdown, before_task_publish, task_prerun, task_postrun, task_retry
 from celery.exceptions import Retry, MaxRetriesExceededError, Ignore
 from celery_config import create_celery_app
-from extractors import PDFTextExtractor, OCRExtractor, AzureVisionExtractor, GPT4VisionExtractor, GeminiVisionExtractor, CodeExtractor, vision_azure_client, openai_client, openai_model, gemini_model
+from extractors import PDFTextExtractor, OCRExtractor, AzureVisionExtractor, GPT4VisionExtractor, GeminiVisionExtractor, CodeExtractor
+from config import get_config
+from providers import get_openai_client, get_openai_model, get_vision_client, get_gemini_model, get_redis_client, EXTRACTION_OPENAI_MAX_RETRIES
 from utils import count_tokens, find_patient_info, update_medical_code_description
 from datetime import datetime
 import traceback
-from models import db, HealthRecord, Report, ReportTemplate, TaskMonitor, MedicalCode, TaskLog
-import pytesseract
+from models import db, HealthRecord, Report, ReportTemplate, MedicalCode, TaskLog
 import io
 import base64
-from azure.ai.vision.imageanalysis.models import VisualFeatures
-from reports import generate_report
-from flask import current_app, render_template
-from utils import update_task_monitor, create_task_monitor, mark_notification_sent
-from flask_mail import Mail, Message
+from reports import generate_report, warm_template_schema
+from report_cache import year_cache_kwargs, invalidate_text_years
+from scheduling import task_priority, estimate_pages, register_inflight, release_inflight
+from checkpoints import extract_pages, purge_checkpoints
+from ingestion import upload_path, display_name, content_hash, release_upload
+from task_stats import record_task_outcome, record_queue_wait, record_retry, short_task_name
+from record_status import apply_transition
+import metrics
+import usage
+import artifacts
+import blob_store
+from extraction_planner import (
+    extraction_mode, MODE_ADAPTIVE, score_page_text, pages_needing_ocr, pages_needing_vision, escalation_extractors
+)
+from flask import current_app
+from utils import update_task_monitor, create_task_monitor
+import notifications
 import xml.etree.ElementTree as ET
 import time
-import tempfile
+import uuid
 import pickle
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path
 from functools import wraps
 from PIL import Image
 import re
@@ -60,6 +75,13 @@ def validate_inputs(**validators):
         return wrapper
     return decorator
 
+def claim_check(func):
+    """Große Ergebnisse im Blob-Store ablegen, als Celery-Ergebnis nur die Referenz (siehe blob_store.py)"""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return blob_store.stash(func(self, *args, **kwargs))
+    return wrapper
+
 def safe_db_operation(func):
     """Decorator für sichere DB-Operationen mit automatischem Rollback"""
     @wraps(func)
@@ -179,6 +201,121 @@ def image_to_base64(image, format='webp', quality=85, max_size_kb=19000):
 # Task-Logging-Funktionen
 import json
 
+@worker_process_init.connect
+def reset_db_connections(**kwargs):
+    """Prefork: vom Elternprozess geerbte DB-Verbindungen nicht im Kindprozess weiterverwenden"""
+    try:
+        from app import app
+        with app.app_context():
+            db.engine.dispose(close=False)
+    except Exception as e:
+        logger.warning(f"Zurücksetzen der DB-Verbindungen fehlgeschlagen: {e}")
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    """Zeitpunkt des Publizierens als Header, für die Queue-Wartezeit in den KPIs"""
+    if headers is not None:
+        headers['enqueued_at'] = time.time()
+
+@task_prerun.connect
+def track_queue_wait(task=None, **kwargs):
+    """Zählt die Wartezeit in der Queue (ohne geplante Verzögerung durch countdown/eta)"""
+    try:
+        enqueued_at = task.request.get('enqueued_at')
+        if not enqueued_at:
+            return
+        ready_at = float(enqueued_at)
+        if task.request.eta:
+            ready_at = max(ready_at, datetime.fromisoformat(str(task.request.eta)).timestamp())
+        record_queue_wait(short_task_name(task.name), time.time() - ready_at)
+    except Exception as e:
+        logger.debug(f"Queue-Wartezeit nicht ermittelbar: {e}")
+
+@task_prerun.connect
+def track_task_start(task_id=None, task=None, **kwargs):
+    metrics.task_started(task_id, short_task_name(getattr(task, 'name', None)))
+
+@task_postrun.connect
+def track_task_end(task_id=None, task=None, state=None, **kwargs):
+    metrics.task_finished(task_id, short_task_name(getattr(task, 'name', None)), state)
+
+def task_record_id(task, args, kwargs):
+    """Datensatz eines Tasks: Argument record_id/health_record_id, data['record_id'] oder geerbter Header"""
+    try:
+        arguments = inspect.signature(task.run).bind_partial(*(args or ()), **(kwargs or {})).arguments
+    except (TypeError, ValueError):
+        arguments = dict(kwargs or {})
+    data = arguments.get('data')
+    record_id = (arguments.get('record_id') or arguments.get('health_record_id')
+                 or (data.get('record_id') if isinstance(data, dict) else None))
+    return record_id or task.request.get('usage_record_id')
+
+_usage_tokens = {}
+
+@before_task_publish.connect
+def stamp_usage_record(headers=None, **kwargs):
+    """Aus einem Task publizierte Tasks erben dessen Datensatz (Zuordnung des Token-Verbrauchs)"""
+    record_id = usage.current_record_id()
+    if headers is not None and record_id:
+        headers['usage_record_id'] = record_id
+
+@task_prerun.connect
+def bind_usage_record(task_id=None, task=None, args=None, kwargs=None, **extra):
+    try:
+        _usage_tokens[task_id] = usage.bind_record(task_record_id(task, args, kwargs))
+    except Exception as e:
+        logger.debug(f"Datensatz für Token-Verbrauch nicht ermittelbar: {e}")
+
+@task_postrun.connect
+def release_usage_record(task_id=None, **kwargs):
+    token = _usage_tokens.pop(task_id, None)
+    if token is not None:
+        try:
+            usage.release(token)
+        except ValueError:
+            pass  # Token aus einem anderen Kontext (sollte bei prefork/eventlet nicht vorkommen)
+    usage.flush_if_due()
+
+@task_postrun.connect
+def release_artifact_reference(task_id=None, args=None, kwargs=None, state=None, **extra):
+    """Ein Task mit Bild-Artefakt gibt seine Referenz nach dem letzten Versuch frei (nicht bei RETRY)"""
+    if state == 'RETRY':
+        return
+    path = artifacts.artifact_of(args, kwargs)
+    if path:
+        artifacts.release(path)
+
+@task_retry.connect
+def track_retry(sender=None, **kwargs):
+    task_name = short_task_name(getattr(sender, 'name', None))
+    record_retry(task_name)
+    metrics.task_retried(task_name)
+
+@worker_ready.connect
+def start_metrics_exporter(**kwargs):
+    """HTTP-Exporter im Hauptprozess des Workers (siehe metrics.py)"""
+    metrics.start_worker_exporter()
+
+@worker_process_shutdown.connect
+def release_process_metrics(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+    usage.flush()  # Prefork-Kinder enden ohne atexit
+    notifications.close_connection()
+
+@worker_process_init.connect
+@worker_ready.connect
+def warm_template_schemas(**kwargs):
+    """Kompiliert die Gemini-Schemas aller JSON-Templates beim Start des Worker-Prozesses"""
+    try:
+        from app import app
+        with app.app_context():
+            templates = ReportTemplate.query.filter_by(output_format='JSON').all()
+            for template in templates:
+                warm_template_schema(template.output_format, template.example_structure)
+            logger.info(f"Schemas für {len(templates)} JSON-Templates vorkompiliert")
+    except Exception as e:
+        logger.warning(f"Vorkompilieren der Template-Schemas fehlgeschlagen: {e}")
+
 def set_record_processing_status(record_id, status, error_message=None):
     """Setzt den finalen Verarbeitungsstatus eines HealthRecords"""
     try:
@@ -215,6 +352,7 @@ def log_task_start(health_record_id, task_name, task_id, metadata=None):
                 task_metadata=json.dumps(metadata) if metadata else None
             )
             db.session.add(task_log)
+            apply_transition(health_record_id, task_name, None, 'started')
             db.session.commit()
             logger.info(f"Task started: {task_name} for health_record {health_record_id}")
             return task_log.id
@@ -234,6 +372,7 @@ def log_task_success(health_record_id, task_name, task_id, start_time=None, meta
                 task_name=task_name,
                 task_id=task_id
             ).order_by(TaskLog.started_at.desc()).first()
+            previous_status = task_log.status if task_log else None
             
             if not task_log:
                 # Falls kein Start-Log gefunden wurde, erstelle einen neuen Erfolgs-Log
@@ -262,8 +401,10 @@ def log_task_success(health_record_id, task_name, task_id, start_time=None, meta
                 existing_metadata.update(metadata)
                 task_log.task_metadata = json.dumps(existing_metadata)
             
+            apply_transition(health_record_id, task_name, previous_status, 'success')
             db.session.commit()
             logger.info(f"Task completed successfully: {task_name} for health_record {health_record_id}")
+            record_task_outcome(task_name, 'success', task_log.duration_seconds, task_log.completed_at)
             return task_log.id
     except Exception as e:
         logger.error(f"Failed to log task success: {e}")
@@ -280,6 +421,7 @@ def log_task_failure(health_record_id, task_name, task_id, error, start_time=Non
                 task_name=task_name,
                 task_id=task_id
             ).order_by(TaskLog.started_at.desc()).first()
+            previous_status = task_log.status if task_log else None
             
             if not task_log:
                 # Falls kein Start-Log gefunden wurde, erstelle einen neuen Fehler-Log
@@ -310,8 +452,10 @@ def log_task_failure(health_record_id, task_name, task_id, error, start_time=Non
                 existing_metadata.update(metadata)
                 task_log.task_metadata = json.dumps(existing_metadata)
             
+            apply_transition(health_record_id, task_name, previous_status, 'failed', error)
             db.session.commit()
             logger.error(f"Task failed: {task_name} for health_record {health_record_id} - {error}")
+            record_task_outcome(task_name, 'failed', task_log.duration_seconds, task_log.completed_at)
             return task_log.id
     except Exception as e:
         logger.error(f"Failed to log task failure: {e}")
@@ -342,12 +486,44 @@ def log_task_chain_error(request, exc, traceback, task_name, record_id):
     
     return {'status': 'error', 'task': task_name, 'exception': str(exc)}
 
+def vision_batch_size():
+    """Seiten pro Vision-Subtask; 0 schaltet den Batch-Modus ab (ein Task pro Datei)"""
+    return int(get_config("VISION_PAGE_BATCH_SIZE", "8"))
+
+def image_batch_path(images_path, batch_index, kind='batch'):
+    return f"{images_path}.{kind}{batch_index:04d}"
+
+def write_image_batches(images, images_path, batch_size, page_numbers=None, kind='batch'):
+    """
+    Legt die Seiten in Batches ab, damit jeder Vision-Subtask nur seine Seiten lädt.
+
+    :param page_numbers: Seitennummern zu images (Standard 0..n-1, z.B. eskalierte Seiten)
+    :param kind: Namenszusatz der Dateien ('batch' oder 'escalate')
+    """
+    if page_numbers is None:
+        page_numbers = list(range(len(images)))
+    batches = []
+    for batch_index, start in enumerate(range(0, len(images), batch_size)):
+        batch_path = image_batch_path(images_path, batch_index, kind)
+        with open(batch_path, 'wb') as f:
+            pickle.dump(images[start:start + batch_size], f)
+        batches.append({
+            'images_path': batch_path,
+            'artifact': images_path,
+            'page_numbers': list(page_numbers[start:start + batch_size])
+        })
+    return batches
+
+def artifact_consumers(signatures):
+    """Anzahl der Signaturen, die ein Bild-Artefakt lesen (eine Referenz pro Task)"""
+    return sum(1 for sig in signatures if artifacts.artifact_of(sig.args, sig.kwargs))
+
 @celery.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
 @validate_inputs(file_path=lambda x: isinstance(x, str) and x.strip() and os.path.exists(x))
 def convert_pdf_to_images(self, file_path):
     """Konvertiert PDF einmal zu Bildern und speichert sie temporär"""
     logger.info(f"Converting PDF to images: {file_path}")
-    temp_file = None
+    images_path = None
     
     # Versuche record_id aus dem file_path zu extrahieren (optional)
     health_record_id = getattr(self, '_health_record_id', None)
@@ -362,39 +538,47 @@ def convert_pdf_to_images(self, file_path):
         if not file_path.lower().endswith('.pdf'):
             raise ValueError(f"File is not a PDF: {file_path}")
         
-        logger.info(f"PDF2IMG: Reading PDF bytes from {file_path}")
-        with open(file_path, 'rb') as file:
-            pdf_bytes = file.read()
-        
-        logger.info(f"PDF2IMG: Read {len(pdf_bytes)} bytes from PDF")
+        # Das PDF wird nicht in den Speicher gelesen: pdf2image/poppler arbeitet direkt auf der Datei
+        file_size = os.path.getsize(file_path)
+        logger.info(f"PDF2IMG: PDF has {file_size} bytes")
         
-        if len(pdf_bytes) == 0:
+        if file_size == 0:
             raise ValueError(f"PDF file is empty: {file_path}")
         
-        logger.info(f"PDF2IMG: Converting PDF bytes to images using pdf2image")
-        images = convert_from_bytes(pdf_bytes)
+        logger.info(f"PDF2IMG: Converting PDF file to images using pdf2image")
+        images = convert_from_path(file_path)
         
         logger.info(f"PDF2IMG: Converted to {len(images) if images else 0} images")
         
         if not images:
             raise ValueError(f"No images could be extracted from PDF: {file_path}")
         
-        # Speichere Bilder temporär mit pickle
+        # Speichere Bilder temporär mit pickle (Artefakt mit Referenz für distribute_extraction_tasks)
         logger.info(f"PDF2IMG: Creating temporary file for {len(images)} images")
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pkl')
+        images_path = artifacts.create(suffix='.pkl')
         
-        logger.info(f"PDF2IMG: Saving images to pickle file {temp_file.name}")
-        with open(temp_file.name, 'wb') as f:
+        logger.info(f"PDF2IMG: Saving images to pickle file {images_path}")
+        with open(images_path, 'wb') as f:
             pickle.dump(images, f)
         
-        logger.info(f"PDF2IMG: Successfully saved {len(images)} images to {temp_file.name}")
+        logger.info(f"PDF2IMG: Successfully saved {len(images)} images to {images_path}")
         
         result = {
-            'images_path': temp_file.name,
+            'images_path': images_path,
+            # Referenzzählung und Bereinigung über artifacts.py
+            'artifact': images_path,
             'pdf_path': file_path,
-            'page_count': len(images)
+            'page_count': len(images),
+            # Schlüssel für die seitenweisen Checkpoints der Extraktoren (aus der Ingestion)
+            'document_hash': content_hash(file_path)
             # pdf_bytes entfernt - verhindert große Redis-Transfers!
         }
+
+        # Große Dokumente: Seiten-Batches für die Vision-Extraktoren separat ablegen
+        batch_size = vision_batch_size()
+        if batch_size and len(images) > batch_size:
+            result['batches'] = write_image_batches(images, images_path, batch_size)
+            logger.info(f"PDF2IMG: Wrote {len(result['batches'])} page batches of up to {batch_size} pages")
         
         logger.info(f"PDF2IMG: Returning result: {result}")
         
@@ -407,12 +591,8 @@ def convert_pdf_to_images(self, file_path):
         
     except Exception as exc:
         # Cleanup bei Fehler
-        if temp_file and os.path.exists(temp_file.name):
-            try:
-                os.remove(temp_file.name)
-                logger.info(f"Cleaned up temp file after error: {temp_file.name}")
-            except Exception as cleanup_exc:
-                logger.warning(f"Failed to cleanup temp file: {cleanup_exc}")
+        if images_path:
+            artifacts.discard(images_path)
         
         # Log Failure
         if health_record_id:
@@ -447,7 +627,7 @@ def process_pdfs(self, filenames, patient_name, record_id=None, create_reports=F
         
         # Validiere, dass alle Dateien existieren
         for filename in filenames:
-            file_path = os.path.join('uploads', filename)
+            file_path = upload_path(filename)
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"File not found: {file_path}")
         
@@ -477,7 +657,9 @@ def process_pdfs(self, filenames, patient_name, record_id=None, create_reports=F
 
         for i, filename in enumerate(filenames):
             # Status-Update entfernt (WebSockets wurden entfernt)
-            file_path = os.path.join('uploads', filename)
+            file_path = upload_path(filename)
+            # Task-IDs und Dokumenttitel nutzen den Dateinamen ohne Hash-Verzeichnis
+            filename = display_name(filename)
             
             # Log einzelne Tasks für bessere Sichtbarkeit
             log_task_start(record_id, 'convert_pdf_to_images', f"convert_{i}_{filename}", 
@@ -494,9 +676,13 @@ def process_pdfs(self, filenames, patient_name, record_id=None, create_reports=F
                          {'file_path': file_path, 'filename': filename})
             
             # Erstelle Chain: Erst Bilder konvertieren, dann alle Extraktoren parallel
+            # Priorität nach geschätzter Seitenzahl (Fast Lane) und Fair Share des Benutzers
+            estimated_pages = estimate_pages([file_path])
             pdf_chain = (
-                convert_pdf_to_images.s(file_path) | 
-                distribute_extraction_tasks.s(file_path, record_id)
+                convert_pdf_to_images.s(file_path).set(
+                    priority=task_priority('extraction_cpu', user_id, estimated_pages)) |
+                distribute_extraction_tasks.s(file_path, record_id, user_id=user_id).set(
+                    priority=task_priority('extraction_io', user_id, estimated_pages))
             )
             extraction_tasks.append(pdf_chain)
 
@@ -516,12 +702,17 @@ def process_pdfs(self, filenames, patient_name, record_id=None, create_reports=F
         logger.info("Building workflow chain from extraction group → combine_extractions → process_record → (optional) create_report...")
         
         # Füge Monitoring-Callbacks hinzu
+        total_pages = estimate_pages([upload_path(filename) for filename in filenames])
         combine_sig = combine_extractions.s(
             filenames, patient_name, record_id, create_reports, start_time, original_task_id, user_id
+        ).set(
+            priority=task_priority('extraction_cpu', user_id, total_pages)
         ).on_error(log_task_chain_error.s(task_name='combine_extractions', record_id=record_id))
         
         process_sig = process_record.s(
             original_task_id=original_task_id
+        ).set(
+            priority=task_priority('refinement', user_id, total_pages)
         ).on_error(log_task_chain_error.s(task_name='process_record', record_id=record_id))
         
         workflow_chain = extraction_group | combine_sig | process_sig
@@ -531,6 +722,8 @@ def process_pdfs(self, filenames, patient_name, record_id=None, create_reports=F
         if create_reports:
             create_sig = create_report.s(
                 original_task_id=original_task_id
+            ).set(
+                priority=task_priority('summary', user_id, total_pages)
             ).on_error(log_task_chain_error.s(task_name='create_report', record_id=record_id))
             workflow_chain |= create_sig
         
@@ -575,15 +768,49 @@ def process_pdfs(self, filenames, patient_name, record_id=None, create_reports=F
         pass
 
 
+def full_extraction_header(images_info, file_path, cpu_priority, io_priority):
+    """Alle Extraktoren auf allen Seiten (EXTRACTION_MODE=full bzw. Fallback)"""
+    header = [
+        extract_pdf_text.s(file_path).set(soft_time_limit=300, time_limit=600, priority=cpu_priority),
+        extract_ocr_optimized.s(images_info).set(soft_time_limit=300, time_limit=600, priority=cpu_priority),
+    ]
+    if images_info.get('batches'):
+        # Batch-Modus: ein Subtask pro Seiten-Batch, Wiederholungen betreffen nur den Batch
+        header += vision_batch_signatures(extract_azure_vision_batch, images_info,
+                                          soft_time_limit=300, time_limit=600, priority=io_priority)
+        header += vision_batch_signatures(extract_gpt4_vision_batch, images_info,
+                                          soft_time_limit=300, time_limit=600, priority=io_priority)
+    else:
+        header += [
+            extract_azure_vision_optimized.s(images_info).set(soft_time_limit=300, time_limit=600, priority=io_priority),
+            extract_gpt4_vision_optimized.s(images_info).set(soft_time_limit=300, time_limit=600, priority=io_priority)
+            # extract_gemini_vision_optimized.s(images_info)  # optional
+        ]
+    return header
+
+def aggregate_signature(images_info, file_path, record_id, user_id, priority, *args, **kwargs):
+    """Chord-Callback bzw. abschließender Task der Extraktion einer Datei"""
+    # Setze Timeout für den Chord-Callback
+    return aggregate_extraction_results.s(
+        *args,
+        file_path=file_path,
+        record_id=record_id,
+        temp_file_path=images_info.get('images_path'),
+        user_id=user_id,
+        page_count=images_info.get('page_count'),
+        **kwargs
+    ).set(soft_time_limit=60, time_limit=120, priority=priority)
+
 @celery.task(bind=True)
 @validate_inputs(
     images_info=lambda x: isinstance(x, dict) and 'images_path' in x and 'pdf_path' in x,
     file_path=lambda x: isinstance(x, str) and x.strip()
 )
-def distribute_extraction_tasks(self, images_info, file_path, record_id=None):
+def distribute_extraction_tasks(self, images_info, file_path, record_id=None, user_id=None):
     """Verteilt die Extraktions-Tasks mit den vorkonvertierten Bildern"""
     logger.info(f"Distributing extraction tasks for {file_path}")
     temp_file_path = images_info.get('images_path')
+    page_count = images_info.get('page_count')
     
     # Log Task Start
     if record_id:
@@ -591,35 +818,44 @@ def distribute_extraction_tasks(self, images_info, file_path, record_id=None):
                       {'file_path': file_path, 'images_path': temp_file_path})
     
     start_time = datetime.utcnow()
+    registered = False
+    acquired = 0
     
     try:
         # Validiere temporäre Datei
         if not os.path.exists(temp_file_path):
             raise FileNotFoundError(f"Temporary image file not found: {temp_file_path}")
         
-        # Erstelle Tasks mit den Bildern und record_id
-        header = [
-            extract_pdf_text.s(file_path).set(soft_time_limit=300, time_limit=600),
-            extract_ocr_optimized.s(images_info).set(soft_time_limit=300, time_limit=600),
-            extract_azure_vision_optimized.s(images_info).set(soft_time_limit=300, time_limit=600),
-            extract_gpt4_vision_optimized.s(images_info).set(soft_time_limit=300, time_limit=600)
-            # extract_gemini_vision_optimized.s(images_info)  # optional
-        ]
-
-        logger.info(f"Scheduling chord with {len(header)} extraction tasks for {file_path}")
-        # Setze Timeout für den Chord-Callback
-        callback_sig = aggregate_extraction_results.s(
-            file_path=file_path, 
-            record_id=record_id, 
-            temp_file_path=temp_file_path
-        ).set(soft_time_limit=60, time_limit=120)
-        
-        # Ersetze diesen Task durch den Chord-Signature (nicht ausführen!), Callback aggregiert die Ergebnisse
-        chord_sig = chord(header, callback_sig)
+        # Priorität aus der tatsächlichen Seitenzahl (Fast Lane) und dem Fair Share des Benutzers
+        cpu_priority = task_priority('extraction_cpu', user_id, page_count)
+        io_priority = task_priority('extraction_io', user_id, page_count)
+
+        if extraction_mode() == MODE_ADAPTIVE:
+            # Adaptiv: erst Textebene bewerten (+ OCR schwacher Seiten), danach nur bei Bedarf Vision
+            logger.info(f"Scheduling adaptive extraction for {file_path} "
+                        f"({page_count} pages, priority cpu={cpu_priority}/io={io_priority})")
+            workflow_sig = chain(
+                assess_text_layer.s(images_info, file_path).set(soft_time_limit=600, time_limit=900, priority=cpu_priority),
+                escalate_extraction.s(images_info, file_path, record_id=record_id, user_id=user_id).set(priority=io_priority)
+            )
+            consumers = workflow_sig.tasks
+        else:
+            header = full_extraction_header(images_info, file_path, cpu_priority, io_priority)
+            logger.info(f"Scheduling chord with {len(header)} extraction tasks for {file_path} "
+                        f"({page_count} pages, priority cpu={cpu_priority}/io={io_priority})")
+            # Ersetze diesen Task durch den Chord-Signature (nicht ausführen!), Callback aggregiert die Ergebnisse
+            workflow_sig = chord(header, aggregate_signature(images_info, file_path, record_id, user_id, io_priority))
+            consumers = header
+
+        # Seiten zählen ab jetzt zum In-Flight-Volumen des Benutzers (bis zum Aggregat)
+        register_inflight(user_id, page_count)
+        registered = True
+        # Jeder Task, der die Bilder liest, hält eine Referenz; die eigene gibt task_postrun frei
+        acquired = artifacts.acquire(images_info.get('artifact'), artifact_consumers(consumers))
         
         # self.replace() wirft eine Ignore Exception - das ist normal und gewollt!
         # Diese Exception darf NICHT gefangen werden
-        return self.replace(chord_sig)
+        return self.replace(workflow_sig)
         
     except Ignore:
         # Ignore Exception ist erwartetes Verhalten bei self.replace() - einfach weiterwerfen
@@ -631,6 +867,12 @@ def distribute_extraction_tasks(self, images_info, file_path, record_id=None):
         
         logger.exception(f"Error in distribute_extraction_tasks for {file_path}")
         
+        # Nichts eingeplant: Seiten und Referenzen zurücknehmen, ein Retry zählt sie erneut
+        if registered:
+            release_inflight(user_id, page_count)
+        if acquired:
+            artifacts.release(images_info['artifact'], acquired)
+        
         # Bei echten Fehlern: Retry mit Backoff
         max_retries = 2
         current_retries = self.request.retries if hasattr(self.request, 'retries') else 0
@@ -645,11 +887,46 @@ def distribute_extraction_tasks(self, images_info, file_path, record_id=None):
         # Cleanup findet im Callback statt
         pass
 
+def fetch_results(results):
+    """Löst Blob-Referenzen auf; ein nicht lesbarer Blob wird zum Fehlerobjekt"""
+    fetched = []
+    for result in results:
+        try:
+            fetched.append(blob_store.fetch(result))
+        except Exception as exc:
+            logger.error(f"Blob {result} not readable: {exc}")
+            fetched.append(create_error_response(exc, "blob_store"))
+    return fetched
+
+def forward_results(received, fetched, results):
+    """
+    Ergebnisse für combine_extractions als Referenzen: unveränderte Eingaben behalten ihre Referenz,
+    neue Werte (zusammengesetzte Seiten-Batches, Fehlerobjekte) werden abgelegt.
+
+    Die gelesenen Blobs bleiben liegen, damit eine erneute Zustellung (acks_late) sie noch lesen kann;
+    combine_extractions löscht nach dem Commit, in Batches aufgegangene Eingaben entfernt purge().
+    """
+    refs = {id(value): ref for ref, value in zip(received, fetched) if blob_store.is_ref(ref)}
+    return [refs.get(id(result)) or blob_store.stash(result) for result in results]
+
 @celery.task(bind=True)
-def aggregate_extraction_results(self, extraction_results, file_path, record_id=None, temp_file_path=None):
-    """Callback für den Chord: wertet die Ergebnisse aus, loggt und bereinigt Ressourcen"""
+def aggregate_extraction_results(self, extraction_results, file_path, record_id=None, temp_file_path=None, user_id=None, page_count=None,
+                                 base_results=None, task_names=None, skipped_tasks=None):
+    """
+    Callback für den Chord: wertet die Ergebnisse aus, loggt und bereinigt Ressourcen
+
+    Im adaptiven Modus kommen PDF-Text und OCR als base_results aus der Bewertung der Textebene;
+    task_names benennt dann die tatsächlich gelaufenen Extraktoren, skipped_tasks die übersprungenen.
+    """
     start_time = datetime.utcnow()
+    received, fetched = [], []
     try:
+        if base_results:
+            extraction_results = list(base_results) + list(extraction_results or [])
+        received = list(extraction_results or [])
+        fetched = fetch_results(received)
+        extraction_results = list(fetched)
+
         logger.info(f"Aggregating extraction results for {file_path}")
         logger.info(f"Received {len(extraction_results) if extraction_results else 0} extraction results")
         
@@ -657,11 +934,14 @@ def aggregate_extraction_results(self, extraction_results, file_path, record_id=
         if not extraction_results:
             logger.error(f"No extraction results received for {file_path}")
             extraction_results = []  # Leere Liste als Fallback
+
+        # Seiten-Batches der Vision-Extraktoren in Seitenreihenfolge zusammensetzen
+        extraction_results = reassemble_vision_batches(extraction_results)
         
         if record_id:
             filename = os.path.basename(file_path)
             file_index = '0'
-            task_names = ['extract_pdf_text', 'extract_ocr_optimized', 'extract_azure_vision_optimized', 'extract_gpt4_vision_optimized']
+            task_names = task_names or ['extract_pdf_text', 'extract_ocr_optimized', 'extract_azure_vision_optimized', 'extract_gpt4_vision_optimized']
             
             # Stelle sicher, dass wir die richtige Anzahl von Ergebnissen haben
             while len(extraction_results) < len(task_names):
@@ -676,46 +956,195 @@ def aggregate_extraction_results(self, extraction_results, file_path, record_id=
                     log_task_failure(record_id, task_name, f"{task_name}_{file_index}_{filename}", 
                                    Exception(error_msg), start_time)
 
+            for task_name in skipped_tasks or []:
+                log_task_success(record_id, task_name, f"{task_name}_{file_index}_{filename}", start_time,
+                                 {'skipped': 'adaptive extraction'})
+
             # Log convert/distribute success als abgeschlossen
             log_task_success(record_id, 'convert_pdf_to_images', f"convert_{file_index}_{filename}", start_time)
             log_task_success(record_id, 'distribute_extraction_tasks', self.request.id, start_time, 
                            {'extraction_tasks_count': len(extraction_results)})
 
-        return extraction_results
+        # Weiter an combine_extractions nur als Referenzen
+        return forward_results(received, fetched, extraction_results)
     except Exception as exc:
         logger.exception(f"Error in aggregate_extraction_results for {file_path}")
-        # Gib trotzdem die Ergebnisse zurück, damit die Pipeline weiterlaufen kann
-        return extraction_results if 'extraction_results' in locals() else []
+        # Gib trotzdem die Ergebnisse zurück (ebenfalls als Referenzen), damit die Pipeline weiterlaufen kann
+        try:
+            return forward_results(received, fetched, extraction_results or [])
+        except Exception:
+            return received
     finally:
-        # Cleanup der temporären Bilddatei mit Verzögerung
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                # Plane das Löschen der temporären Datei nach 5 Minuten
-                # Dies gibt allen Tasks genug Zeit, die Datei zu lesen
-                cleanup_task = cleanup_temp_file.apply_async(
-                    args=[temp_file_path], 
-                    countdown=300  # 5 Minuten Verzögerung
-                )
-                logger.info(f"Scheduled cleanup of temp file {temp_file_path} in 5 minutes (task: {cleanup_task.id})")
-            except Exception as e:
-                logger.warning(f"Could not schedule temp file cleanup: {e}")
+        # Extraktion abgeschlossen: Seiten aus dem Fair-Share-Zähler des Benutzers nehmen
+        release_inflight(user_id, page_count)
+
+        # Alle Extraktoren sind fertig: Bilder sofort entfernen (meist schon mit der letzten Referenz geschehen)
+        if temp_file_path:
+            artifacts.discard(temp_file_path)
 
 @celery.task(bind=True)
 def cleanup_temp_file(self, file_path):
-    """Bereinigt temporäre Dateien nach einer Verzögerung"""
-    if file_path and os.path.exists(file_path):
+    """Bereinigt temporäre Dateien (inkl. Seiten-Batches); nur noch für bereits eingeplante Aufrufe"""
+    if not file_path:
+        return "File not found: None"
+    freed = artifacts.discard(file_path)
+    return f"Deleted: {file_path}" if freed else f"File not found: {file_path}"
+
+@celery.task(bind=True)
+def clean_artifacts(self):
+    """Janitor: verwaiste Seitenbilder nach Alter und Plattenbudget, verwaiste Uploads und Blobs (siehe artifacts.py)"""
+    try:
+        result = artifacts.janitor()
+        metrics.observe_evictions(result['freed'])
+        return result
+    except Exception as exc:
+        logger.exception("Error cleaning artifacts")
+        return create_error_response(exc, "clean_artifacts")
+
+VISION_TASK_NAMES = {
+    'azure_vision': 'extract_azure_vision_optimized',
+    'gpt4_vision': 'extract_gpt4_vision_optimized',
+}
+
+@celery.task(bind=True, autoretry_for=(Exception,), max_retries=2, retry_kwargs={'countdown': 30})
+def assess_text_layer(self, images_info, file_path):
+    """
+    Adaptive Extraktion, günstige Stufe: bewertet die Textebene pro Seite, liest schwache
+    Seiten per OCR und bestimmt die Seiten, die an die Vision-APIs eskaliert werden.
+    Die Bilder werden nur geladen, wenn mindestens eine Seite OCR braucht.
+    """
+    page_count = images_info.get('page_count') or 0
+    pdf_name = os.path.basename(file_path)
+    try:
         try:
-            os.remove(file_path)
-            logger.info(f"Successfully deleted temporary file: {file_path}")
-            return f"Deleted: {file_path}"
-        except Exception as e:
-            logger.warning(f"Could not delete temp file {file_path}: {e}")
-            return f"Failed to delete: {file_path} - {str(e)}"
-    else:
-        logger.info(f"Temp file already deleted or doesn't exist: {file_path}")
-        return f"File not found: {file_path}"
+            page_texts = PDFTextExtractor().extract_page_texts(file_path)
+        except Exception as exc:
+            logger.warning(f"PLANNER: PdfReader failed for {file_path}, treating all pages as poor: {exc}")
+            page_texts = []
+        page_texts = [text or "" for text in page_texts][:page_count] + [""] * max(0, page_count - len(page_texts))
+
+        scores = [score_page_text(text) for text in page_texts]
+        ocr_pages = pages_needing_ocr(scores)
+        # PDF-Text und OCR gehen über escalate_extraction als base_results an den Callback (Claim-Check)
+        result = {
+            'pdf_text': blob_store.stash(PDFTextExtractor().create_structured_output("pdf_text", pdf_name, page_texts)),
+            'ocr': None,
+            'escalation_batches': [],
+            'stats': {'pages': page_count, 'text_layer_pages': page_count - len(ocr_pages), 'ocr_pages': len(ocr_pages)}
+        }
+        if not ocr_pages:
+            logger.info(f"PLANNER: {pdf_name}: all {page_count} pages have a good text layer - no OCR/vision needed")
+            return result
+
+        with open(images_info['images_path'], 'rb') as f:
+            images = pickle.load(f)
+
+        import pytesseract
+        def ocr_page_text(image, page):
+            return pytesseract.image_to_string(image, lang='deu')
+
+        ocr_list = extract_pages(images_info.get('document_hash'), 'ocr', ocr_pages,
+                                 lambda: [images[page] for page in ocr_pages], ocr_page_text)
+        ocr_texts = dict(zip(ocr_pages, ocr_list))
+        result['ocr'] = blob_store.stash(OCRExtractor().create_structured_output("ocr", pdf_name, ocr_list, ocr_pages))
+
+        vision_pages = pages_needing_vision(page_texts, ocr_texts)
+        if vision_pages:
+            batch_size = vision_batch_size() or len(vision_pages)
+            result['escalation_batches'] = write_image_batches(
+                [images[page] for page in vision_pages], images_info['images_path'], batch_size,
+                page_numbers=vision_pages, kind='escalate'
+            )
+        result['stats']['vision_pages'] = len(vision_pages)
+        logger.info(f"PLANNER: {pdf_name}: {result['stats']}")
+        return result
+    except Exception as exc:
+        logger.exception(f"PLANNER: assessment failed for {file_path}")
+        # Nach dem letzten Versuch ein Fehlerobjekt liefern: escalate_extraction fällt dann auf die volle Extraktion zurück
+        if self.request.retries >= self.max_retries:
+            return create_error_response(exc, f"assess_text_layer for {file_path}")
+        raise
+
+@celery.task(bind=True)
+def escalate_extraction(self, assessment, images_info, file_path, record_id=None, user_id=None):
+    """
+    Adaptive Extraktion, teure Stufe: schickt nur die eskalierten Seiten an die Vision-APIs
+    (Chord mit aggregate_extraction_results als Callback). Ohne eskalierte Seiten wird direkt
+    aggregiert; schlug die Bewertung fehl, laufen wie bisher alle Extraktoren.
+    """
+    page_count = images_info.get('page_count')
+    cpu_priority = task_priority('extraction_cpu', user_id, page_count)
+    io_priority = task_priority('extraction_io', user_id, page_count)
+    try:
+        if not isinstance(assessment, dict) or assessment.get('status') == 'error' or 'pdf_text' not in assessment:
+            logger.warning(f"PLANNER: assessment failed for {file_path} - falling back to full extraction")
+            header = full_extraction_header(images_info, file_path, cpu_priority, io_priority)
+            artifacts.acquire(images_info.get('artifact'), artifact_consumers(header))
+            return self.replace(chord(header, aggregate_signature(images_info, file_path, record_id, user_id, io_priority)))
+
+        base_results = [assessment['pdf_text']]
+        task_names = ['extract_pdf_text']
+        if assessment.get('ocr'):
+            base_results.append(assessment['ocr'])
+            task_names.append('extract_ocr_optimized')
+
+        batches = assessment.get('escalation_batches') or []
+        extractors = escalation_extractors() if batches else []
+        batch_tasks = {'azure_vision': extract_azure_vision_batch, 'gpt4_vision': extract_gpt4_vision_batch}
+        header = []
+        for method in extractors:
+            if method not in batch_tasks:
+                logger.warning(f"PLANNER: unknown escalation extractor '{method}' ignored")
+                continue
+            header += vision_batch_signatures(
+                batch_tasks[method],
+                {**images_info, 'batches': batches},
+                soft_time_limit=300, time_limit=600, priority=io_priority
+            )
+            task_names.append(VISION_TASK_NAMES[method])
+        skipped_tasks = [name for name in ['extract_ocr_optimized', *VISION_TASK_NAMES.values()] if name not in task_names]
+
+        if not header:
+            return self.replace(aggregate_signature(
+                images_info, file_path, record_id, user_id, io_priority, base_results,
+                task_names=task_names, skipped_tasks=skipped_tasks
+            ))
+
+        logger.info(f"PLANNER: escalating {sum(len(b['page_numbers']) for b in batches)} pages of {file_path} "
+                    f"to {', '.join(extractors)} ({len(header)} subtasks)")
+        artifacts.acquire(images_info.get('artifact'), artifact_consumers(header))
+        return self.replace(chord(header, aggregate_signature(
+            images_info, file_path, record_id, user_id, io_priority,
+            base_results=base_results, task_names=task_names, skipped_tasks=skipped_tasks
+        )))
+    except Ignore:
+        # self.replace() wirft Ignore - erwartetes Verhalten
+        raise
+    except Exception as exc:
+        logger.exception(f"Error in escalate_extraction for {file_path}")
+        error = create_error_response(exc, f"escalate_extraction for {file_path}")
+        try:
+            # Fehler als Ergebnis an den Callback: Logging, In-Flight-Freigabe und Bilder wie bei jeder Extraktion
+            return self.replace(aggregate_signature(images_info, file_path, record_id, user_id, io_priority, [error]))
+        except Ignore:
+            raise
+        except Exception:
+            logger.exception(f"Error scheduling aggregation after failed escalation for {file_path}")
+            release_inflight(user_id, page_count)
+            artifacts.discard(images_info.get('images_path'))
+            return error
+
+@celery.task(bind=True)
+def purge_extraction_checkpoints(self):
+    """Entfernt abgelaufene Seiten-Checkpoints (EXTRACTION_CHECKPOINT_DAYS)"""
+    try:
+        return {'deleted': purge_checkpoints()}
+    except Exception as exc:
+        logger.exception("Error purging extraction checkpoints")
+        return create_error_response(exc, "purge_extraction_checkpoints")
 
 @celery.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 30})
+@claim_check
 @validate_inputs(file_path=lambda x: isinstance(x, str) and x.strip() and os.path.exists(x))
 def extract_pdf_text(self, file_path):
     logger.info(f"Starting PDF text extraction for file: {file_path}")
@@ -756,6 +1185,7 @@ def extract_pdf_text(self, file_path):
 
 
 @celery.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 45})
+@claim_check
 @validate_inputs(images_info=lambda x: isinstance(x, dict) and 'images_path' in x and 'pdf_path' in x)
 def extract_ocr_optimized(self, images_info):
     """OCR mit vorkonvertierten Bildern"""
@@ -788,20 +1218,20 @@ def extract_ocr_optimized(self, images_info):
         if not images:
             raise ValueError("No images found in pickle file")
         
+        import pytesseract
         extractor = OCRExtractor()
         logger.info(f"OCR: Processing {len(images)} images with pytesseract")
         
+        def ocr_page_text(image, i):
+            logger.info(f"OCR: Processing image {i+1}/{len(images)}")
+            page_text = pytesseract.image_to_string(image, lang='deu')
+            logger.info(f"OCR: Image {i} extracted {len(page_text)} characters")
+            return page_text
+
         # Nutze die create_structured_output Methode direkt mit den extrahierten Texten
-        page_texts = []
-        for i, image in enumerate(images):
-            try:
-                logger.info(f"OCR: Processing image {i+1}/{len(images)}")
-                page_text = pytesseract.image_to_string(image, lang='deu')
-                logger.info(f"OCR: Image {i} extracted {len(page_text)} characters")
-                page_texts.append(page_text)
-            except Exception as img_exc:
-                logger.warning(f"OCR failed for image {i}: {img_exc}")
-                page_texts.append("")  # Leere Seite bei Fehler
+        # Bereits extrahierte Seiten kommen aus den Checkpoints (Retry/erneuter Upload)
+        page_texts = extract_pages(images_info.get('document_hash'), 'ocr', range(len(images)),
+                                   lambda: images, ocr_page_text)
         
         logger.info(f"OCR: Creating structured output from {len(page_texts)} page texts")
         result = extractor.create_structured_output("ocr", os.path.basename(images_info['pdf_path']), page_texts)
@@ -843,7 +1273,58 @@ def extract_ocr(self, file_path):
         logger.exception(f"Error in OCR extraction for file: {file_path}")
         return create_error_response(exc, f"extract_ocr for {file_path}")
 
+def azure_vision_page_text(image, index):
+    """Liest eine Seite mit Azure Vision (30 Sekunden Timeout); leerer Text bei Timeout"""
+    # Konvertiere PIL Image zu optimiertem Stream (WebP oder PNG als Fallback)
+    try:
+        # Versuche WebP zuerst (kleinere Dateigröße)
+        image_stream = optimize_image_format(image, 'webp', quality=90)
+    except Exception:
+        # Fallback zu PNG für Azure Vision Kompatibilität
+        image_stream = optimize_image_format(image, 'png')
+    
+    # API-Call mit Timeout-Handling über Threading
+    import threading
+    result_container = [None]
+    exception_container = [None]
+    
+    def azure_api_call():
+        try:
+            from azure.ai.vision.imageanalysis.models import VisualFeatures
+            with metrics.provider_request('azure_vision', 'page'):
+                result_container[0] = get_vision_client().analyze(
+                    image_data=image_stream,
+                    visual_features=[VisualFeatures.READ]
+                )
+        except Exception as e:
+            exception_container[0] = e
+    
+    # Starte API-Call in separatem Thread mit Timeout
+    thread = threading.Thread(target=usage.carry_context(azure_api_call))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout=30)  # 30 Sekunden Timeout
+    
+    if thread.is_alive():
+        logger.error(f"Azure Vision API timeout for image {index} after 30 seconds")
+        return ""
+    
+    if exception_container[0]:
+        raise exception_container[0]
+    
+    result = result_container[0]
+    
+    if result and result.read is not None:
+        page_text = ' '.join(
+            [' '.join([word.text for word in line.words]) for block in result.read.blocks for line in block.lines]
+        )
+        logger.info(f"AZURE: Successfully extracted {len(page_text)} characters from image {index}")
+        return page_text
+    logger.warning(f"No text extracted from image {index} via Azure Vision")
+    return ""
+
 @celery.task(bind=True)
+@claim_check
 @validate_inputs(images_info=lambda x: isinstance(x, dict) and 'images_path' in x and 'pdf_path' in x)
 def extract_azure_vision_optimized(self, images_info):
     """Azure Vision mit vorkonvertierten Bildern"""
@@ -874,65 +1355,11 @@ def extract_azure_vision_optimized(self, images_info):
             raise ValueError("No images found in pickle file")
         
         extractor = AzureVisionExtractor()
-        page_texts = []
-        
         logger.info(f"AZURE: Starting to process {len(images)} images")
         
-        for i, image in enumerate(images):
-            try:
-                logger.info(f"AZURE: Processing image {i+1}/{len(images)}")
-                
-                # Konvertiere PIL Image zu optimiertem Stream (WebP oder PNG als Fallback)
-                try:
-                    # Versuche WebP zuerst (kleinere Dateigröße)
-                    image_stream = optimize_image_format(image, 'webp', quality=90)
-                except Exception:
-                    # Fallback zu PNG für Azure Vision Kompatibilität
-                    image_stream = optimize_image_format(image, 'png')
-                
-                # API-Call mit Timeout-Handling über Threading
-                import threading
-                result_container = [None]
-                exception_container = [None]
-                
-                def azure_api_call():
-                    try:
-                        result_container[0] = vision_azure_client.analyze(
-                            image_data=image_stream,
-                            visual_features=[VisualFeatures.READ]
-                        )
-                    except Exception as e:
-                        exception_container[0] = e
-                
-                # Starte API-Call in separatem Thread mit Timeout
-                thread = threading.Thread(target=azure_api_call)
-                thread.daemon = True
-                thread.start()
-                thread.join(timeout=30)  # 30 Sekunden Timeout
-                
-                if thread.is_alive():
-                    logger.error(f"Azure Vision API timeout for image {i} after 30 seconds")
-                    page_texts.append("")
-                    continue
-                
-                if exception_container[0]:
-                    raise exception_container[0]
-                
-                result = result_container[0]
-                
-                if result and result.read is not None:
-                    page_text = ' '.join(
-                        [' '.join([word.text for word in line.words]) for block in result.read.blocks for line in block.lines]
-                    )
-                    page_texts.append(page_text)
-                    logger.info(f"AZURE: Successfully extracted {len(page_text)} characters from image {i}")
-                else:
-                    logger.warning(f"No text extracted from image {i} via Azure Vision")
-                    page_texts.append("")
-                    
-            except Exception as img_exc:
-                logger.error(f"Azure Vision failed for image {i}: {img_exc}")
-                page_texts.append("")  # Leere Seite bei Fehler
+        # Bereits extrahierte Seiten kommen aus den Checkpoints (Retry/erneuter Upload)
+        page_texts = extract_pages(images_info.get('document_hash'), 'azure_vision', range(len(images)),
+                                   lambda: images, azure_vision_page_text)
         
         result = extractor.create_structured_output("azure_vision", os.path.basename(images_info['pdf_path']), page_texts)
         
@@ -976,7 +1403,46 @@ def extract_azure_vision(self, file_path):
         logger.exception(f"Error in Azure Vision extraction for file: {file_path}")
         return create_error_response(exc, f"extract_azure_vision for {file_path}")
 
+def gpt4_vision_page_text(image, index):
+    """Liest eine Seite mit GPT-4 Vision; leerer Text bei Fehlern"""
+    try:
+        # Konvertiere zu optimiertem base64 (WebP mit JPEG Fallback)
+        base64_image = image_to_base64(image, format='webp', quality=85, max_size_kb=19000)
+        
+        # Bestimme MIME-Type basierend auf dem tatsächlich verwendeten Format
+        # Da image_to_base64 intern Fallback macht, verwenden wir data:image/jpeg für Kompatibilität
+        data_url = f"data:image/jpeg;base64,{base64_image}"
+        
+        with metrics.provider_request('openai', 'vision_page') as call:
+            response = call.usage(get_openai_client(max_retries=EXTRACTION_OPENAI_MAX_RETRIES).chat.completions.create(
+                model=get_openai_model(),
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": "Wandele bitte das Bild in ein Json-Format um."},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": data_url,
+                            },
+                        },
+                    ],
+                }],
+                timeout=60  # 60 Sekunden Timeout pro API-Call
+            ))
+        
+        if not response.choices or not response.choices[0].message.content:
+            logger.warning(f"Empty response from GPT-4 Vision for image {index}")
+            return ""
+            
+        return response.choices[0].message.content
+        
+    except Exception as img_exc:
+        logger.error(f"GPT-4 Vision failed for image {index}: {img_exc}")
+        return ""  # Leere Antwort bei Fehler
+
 @celery.task(bind=True)
+@claim_check
 @validate_inputs(images_info=lambda x: isinstance(x, dict) and 'images_path' in x and 'pdf_path' in x)
 def extract_gpt4_vision_optimized(self, images_info):
     """GPT-4 Vision mit vorkonvertierten Bildern und Batch-Verarbeitung"""
@@ -1003,51 +1469,9 @@ def extract_gpt4_vision_optimized(self, images_info):
         
         extractor = GPT4VisionExtractor()
         
-        # Batch-Verarbeitung mit ThreadPoolExecutor
-        from concurrent.futures import ThreadPoolExecutor, TimeoutError
-        
-        def process_image(image_with_index):
-            image, index = image_with_index
-            try:
-                # Konvertiere zu optimiertem base64 (WebP mit JPEG Fallback)
-                base64_image = image_to_base64(image, format='webp', quality=85, max_size_kb=19000)
-                
-                # Bestimme MIME-Type basierend auf dem tatsächlich verwendeten Format
-                # Da image_to_base64 intern Fallback macht, verwenden wir data:image/jpeg für Kompatibilität
-                data_url = f"data:image/jpeg;base64,{base64_image}"
-                
-                response = openai_client.chat.completions.create(
-                    model=openai_model,
-                    messages=[{
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Wandele bitte das Bild in ein Json-Format um."},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": data_url,
-                                },
-                            },
-                        ],
-                    }],                
-                    timeout=60  # 60 Sekunden Timeout pro API-Call
-                )
-                
-                if not response.choices or not response.choices[0].message.content:
-                    logger.warning(f"Empty response from GPT-4 Vision for image {index}")
-                    return ""
-                    
-                return response.choices[0].message.content
-                
-            except Exception as img_exc:
-                logger.error(f"GPT-4 Vision failed for image {index}: {img_exc}")
-                return ""  # Leere Antwort bei Fehler
-        
-        # Parallele API-Calls mit max 3 gleichzeitig und Timeout
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            # Nummeriere Bilder für besseres Error-Handling
-            images_with_index = [(image, i) for i, image in enumerate(images)]
-            page_texts = list(executor.map(process_image, images_with_index))
+        # Parallele API-Calls mit max 3 gleichzeitig; fertige Seiten kommen aus den Checkpoints
+        page_texts = extract_pages(images_info.get('document_hash'), 'gpt4_vision', range(len(images)),
+                                   lambda: images, gpt4_vision_page_text, max_workers=3)
         
         result = extractor.create_structured_output("gpt4_vision", os.path.basename(images_info['pdf_path']), page_texts)
         
@@ -1089,7 +1513,129 @@ def extract_gpt4_vision(self, file_path):
         logger.exception(f"Error in GPT-4 Vision extraction for file: {file_path}")
         return create_error_response(exc, f"extract_gpt4_vision for {file_path}")
 
+VISION_BATCH_QUALITY_RATIO = 0.3
+
+def run_vision_batch(task, batch_info, method, page_func, max_workers, max_retries, countdown):
+    """
+    Führt einen Seiten-Batch eines Vision-Extraktors aus.
+
+    Schlägt der Batch fehl (Exception oder zu wenige Seiten mit Text), wird nur dieser
+    Batch wiederholt. Nach der letzten Wiederholung wird ein Fehlerobjekt mit Methode und
+    Seitennummern zurückgegeben, damit aggregate_extraction_results die Lücke füllen kann.
+
+    :return: Dictionary mit method, page_numbers und page_texts
+    """
+    page_numbers = batch_info['page_numbers']
+    pages_label = f"{method} pages {page_numbers[0]}-{page_numbers[-1]}"
+    try:
+        def load_batch_images():
+            images_path = batch_info['images_path']
+            if not os.path.exists(images_path):
+                raise FileNotFoundError(f"Batch images file not found: {images_path}")
+            with open(images_path, 'rb') as f:
+                images = pickle.load(f)
+            if not images:
+                raise ValueError("No images found in batch file")
+            return images
+
+        # Bilder werden nur geladen, wenn nicht alle Seiten schon als Checkpoint vorliegen
+        page_texts = extract_pages(batch_info.get('document_hash'), method, page_numbers,
+                                   load_batch_images, page_func, max_workers=max_workers)
+
+        non_empty_pages = sum(1 for t in page_texts if isinstance(t, str) and t.strip())
+        logger.info(f"VISION BATCH: {pages_label} quality {non_empty_pages}/{len(page_texts)}")
+        if non_empty_pages == 0 or non_empty_pages / len(page_texts) < VISION_BATCH_QUALITY_RATIO:
+            raise Exception(f"{pages_label} low quality: {non_empty_pages}/{len(page_texts)} non-empty pages")
+
+        return {
+            'status': 'batch',
+            'method': method,
+            'pdf_name': os.path.basename(batch_info['pdf_path']),
+            'page_numbers': page_numbers,
+            'page_texts': page_texts
+        }
+    except Exception as exc:
+        logger.exception(f"Error in vision batch {pages_label}")
+        if getattr(task.request, 'retries', 0) < max_retries:
+            raise task.retry(exc=exc, countdown=countdown)
+        error = create_error_response(exc, f"vision batch {pages_label}")
+        error.update({'method': method, 'page_numbers': page_numbers})
+        return error
+
+@celery.task(bind=True)
+@claim_check
+def extract_azure_vision_batch(self, batch_info):
+    """Azure Vision für einen Seiten-Batch (Batch-Modus für große Dokumente)"""
+    return run_vision_batch(self, batch_info, 'azure_vision', azure_vision_page_text,
+                            max_workers=1, max_retries=4, countdown=60)
+
+@celery.task(bind=True)
+@claim_check
+def extract_gpt4_vision_batch(self, batch_info):
+    """GPT-4 Vision für einen Seiten-Batch (Batch-Modus für große Dokumente)"""
+    return run_vision_batch(self, batch_info, 'gpt4_vision', gpt4_vision_page_text,
+                            max_workers=3, max_retries=3, countdown=120)
+
+def vision_batch_signatures(task, images_info, **options):
+    """Ein Subtask pro Seiten-Batch; der Batch kennt PDF-Pfad und Seitennummern"""
+    return [
+        task.s({**batch, 'pdf_path': images_info['pdf_path'], 'document_hash': images_info.get('document_hash')}).set(**options)
+        for batch in images_info['batches']
+    ]
+
+def is_vision_batch_result(result):
+    return isinstance(result, dict) and 'method' in result and 'page_numbers' in result
+
+def reassemble_vision_batches(extraction_results):
+    """
+    Setzt die Ergebnisse der Seiten-Batches pro Methode wieder zu einem Extraktions-XML
+    zusammen. Das zusammengesetzte Ergebnis steht an der Position des ersten Batches, so
+    dass die Reihenfolge pdf_text, ocr, azure_vision, gpt4_vision erhalten bleibt.
+    Fehlgeschlagene Batches werden als leere Seiten eingesetzt; sind alle Batches einer
+    Methode fehlgeschlagen, wird ein Fehlerobjekt weitergegeben.
+    """
+    batches_by_method = {}
+    ordered = []
+    for result in extraction_results:
+        if is_vision_batch_result(result):
+            method = result['method']
+            if method not in batches_by_method:
+                batches_by_method[method] = []
+                ordered.append(('batches', method))
+            batches_by_method[method].append(result)
+        else:
+            ordered.append(('result', result))
+
+    if not batches_by_method:
+        return extraction_results
+
+    reassembled = []
+    for kind, value in ordered:
+        if kind == 'result':
+            reassembled.append(value)
+            continue
+        batches = batches_by_method[value]
+        pages = {}
+        failed = [batch for batch in batches if batch.get('status') == 'error']
+        for batch in batches:
+            texts = batch.get('page_texts') or [''] * len(batch['page_numbers'])
+            pages.update(zip(batch['page_numbers'], texts))
+        if len(failed) == len(batches):
+            logger.error(f"All {len(batches)} {value} batches failed")
+            reassembled.append(create_error_response(
+                Exception(failed[0].get('exc_message', 'All batches failed')), f"{value} batches"))
+            continue
+        if failed:
+            logger.warning(f"{len(failed)}/{len(batches)} {value} batches failed - their pages stay empty")
+        pdf_name = next(batch['pdf_name'] for batch in batches if batch.get('pdf_name'))
+        page_numbers = sorted(pages)
+        extractor = AzureVisionExtractor() if value == 'azure_vision' else GPT4VisionExtractor()
+        reassembled.append(extractor.create_structured_output(
+            value, pdf_name, [pages[number] for number in page_numbers], page_numbers))
+    return reassembled
+
 @celery.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 120})
+@claim_check
 @validate_inputs(images_info=lambda x: isinstance(x, dict) and 'images_path' in x and 'pdf_path' in x)
 def extract_gemini_vision_optimized(self, images_info):
     """Gemini Vision mit vorkonvertierten Bildern und Batch-Verarbeitung"""
@@ -1124,6 +1670,12 @@ def extract_gemini_vision_optimized(self, images_info):
         logger.info(f"GEMINI DEBUG: Imports successful")
         
         def process_image_with_timeout(image_with_index):
+            start = time.perf_counter()
+            text = extract_gemini_page(image_with_index)
+            metrics.observe_page('gemini_vision', time.perf_counter() - start, ok=bool(text))
+            return text
+
+        def extract_gemini_page(image_with_index):
             image, index = image_with_index
             logger.info(f"GEMINI DEBUG: Processing image {index}, type: {type(image)}")
             try:
@@ -1142,14 +1694,15 @@ def extract_gemini_vision_optimized(self, images_info):
                 def gemini_api_call():
                     try:
                         logger.info(f"GEMINI DEBUG: Starting Gemini API call for image {index}")
-                        logger.info(f"GEMINI DEBUG: gemini_model type: {type(gemini_model)}")
-                        response = gemini_model.generate_content([
-                            {
-                                "mime_type": "image/jpeg",
-                                "data": img_bytes.read()
-                            },
-                            "Wandele bitte das Bild in ein Json-Format um."
-                        ])
+                        vision_model = get_gemini_model(safety_settings=None)
+                        with metrics.provider_request('gemini', 'vision_page') as call:
+                            response = call.usage(vision_model.generate_content([
+                                {
+                                    "mime_type": "image/jpeg",
+                                    "data": img_bytes.read()
+                                },
+                                "Wandele bitte das Bild in ein Json-Format um."
+                            ]), vision_model.model_name)
                         logger.info(f"GEMINI DEBUG: Gemini API call successful for image {index}")
                         result_container[0] = response.text
                     except Exception as e:
@@ -1157,7 +1710,7 @@ def extract_gemini_vision_optimized(self, images_info):
                         exception_container[0] = e
                 
                 # Starte API-Call in separatem Thread mit Timeout
-                thread = threading.Thread(target=gemini_api_call)
+                thread = threading.Thread(target=usage.carry_context(gemini_api_call))
                 thread.daemon = True
                 thread.start()
                 thread.join(timeout=60)  # 60 Sekunden Timeout
@@ -1181,7 +1734,7 @@ def extract_gemini_vision_optimized(self, images_info):
             images_with_index = [(image, i) for i, image in enumerate(images)]
             
             # Verwende as_completed für besseres Monitoring
-            futures = {executor.submit(process_image_with_timeout, img): img[1] 
+            futures = {executor.submit(usage.carry_context(process_image_with_timeout), img): img[1] 
                       for img in images_with_index}
             
             page_texts = [""] * len(images)  # Vorinitialisiere mit leeren Strings
@@ -1239,6 +1792,10 @@ def combine_extractions(self, extraction_results, filenames, patient_name, recor
         # Status-Update entfernt (WebSockets wurden entfernt)
         task_id_to_emit = original_task_id or self.request.id
 
+        # Die Group über die Datei-Chains liefert pro Datei eine Liste (bei einer Datei entpackt Celery sie)
+        received = [item for result in extraction_results for item in (result if isinstance(result, list) else [result])]
+        extraction_results = fetch_results(received)
+
         valid_results = []
         errors = []
 
@@ -1321,10 +1878,12 @@ def combine_extractions(self, extraction_results, filenames, patient_name, recor
                 record.text = combined_extractions
             else:
                 record.text += "\n\n" + combined_extractions
+                # Nur die Jahre der neuen Dokumente müssen in den Berichten neu generiert werden
+                invalidate_text_years(record_id, combined_extractions, record.birth_date)
 
             # Filenames als String behandeln, da sie verschlüsselt sind
             current_filenames = record.filenames if record.filenames else ""
-            new_filenames = ",".join(filenames)
+            new_filenames = ",".join(display_name(filename) for filename in filenames)
             record.filenames = current_filenames + ("," if current_filenames else "") + new_filenames
 
             record.token_count = count_tokens(record.text)
@@ -1335,7 +1894,7 @@ def combine_extractions(self, extraction_results, filenames, patient_name, recor
         else:
             record = HealthRecord(
                 text=combined_extractions,
-                filenames=",".join(filenames),  # Wird automatisch verschlüsselt
+                filenames=",".join(display_name(filename) for filename in filenames),  # Wird automatisch verschlüsselt
                 token_count=token_count,
                 patient_name=patient_name,
                 medical_history_begin=None,
@@ -1356,18 +1915,19 @@ def combine_extractions(self, extraction_results, filenames, patient_name, recor
             logger.error(f"Database commit failed: {db_exc}")
             raise db_exc
 
+        # Extraktionen liegen jetzt im Datensatz, die Blobs werden nicht mehr gebraucht
+        blob_store.delete(received)
+
         # Löschen der verarbeiteten PDF-Dateien
         deleted_files = []
         failed_deletions = []
         for filename in filenames:
-            file_path = os.path.join('uploads', filename)
+            file_path = upload_path(filename)
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+                # Gelöscht wird erst, wenn keine andere Verarbeitung denselben Inhalt nutzt
+                if release_upload(filename):
                     deleted_files.append(file_path)
                     logger.info(f"Deleted file: {file_path}")
-                else:
-                    logger.warning(f"File not found for deletion: {file_path}")
             except OSError as e:
                 failed_deletions.append(file_path)
                 logger.warning(f"Error deleting file {file_path}: {e}")
@@ -1440,7 +2000,11 @@ def process_record(self, data, original_task_id=None):
             logger.info(f"Record text length: {len(record.text) if record.text else 0}")
             logger.info(f"Record token count: {record.token_count}")
             
-            start_year, end_year, patient_name = find_patient_info(record.text, record.token_count)
+            start_year, end_year, patient_name = find_patient_info(
+                record.text, record.token_count,
+                known_patient_name=record.patient_name,
+                birth_date=record.birth_date
+            )
             
             logger.info(f"📥 find_patient_info returned: start_year={start_year}, end_year={end_year}, patient_name={patient_name}")
             
@@ -1496,6 +2060,7 @@ def process_record(self, data, original_task_id=None):
             end_time = datetime.utcnow()
             task_monitor = create_task_monitor(record_id)
             update_task_monitor(task_monitor.id, start_time, end_time, token_count=record.token_count)
+            schedule_notifications()
         
         return {
             'status': 'Record processing completed', 
@@ -1545,22 +2110,24 @@ def regenerate_report_task(self, report_id):
         ]
 
         # Generieren des Berichts unter Verwendung des aktuellen Templates
-        report_content = generate_report(
-            template_name=template.template_name,
-            output_format=template.output_format,
-            example_structure=template.example_structure,
-            health_record_custom_instructions=health_record.custom_instructions,
-            system_prompt=template.system_prompt,
-            prompt=template.prompt,
-            health_record_text=health_record.text,
-            health_record_token_count=health_record.token_count,
-            health_record_begin=health_record.medical_history_begin,
-            health_record_end=health_record.medical_history_end,
-            use_custom_instructions=template.use_custom_instructions,
-            record_id=health_record.id,
-            medical_codes_text=medical_codes_list,
-            system_pdf_filename=template.system_pdf_filename
-        )
+        with usage.usage_scope(record_id=health_record.id, template_id=template.id):
+            report_content = generate_report(
+                template_name=template.template_name,
+                output_format=template.output_format,
+                example_structure=template.example_structure,
+                health_record_custom_instructions=health_record.custom_instructions,
+                system_prompt=template.system_prompt,
+                prompt=template.prompt,
+                health_record_text=health_record.text,
+                health_record_token_count=health_record.token_count,
+                health_record_begin=health_record.medical_history_begin,
+                health_record_end=health_record.medical_history_end,
+                use_custom_instructions=template.use_custom_instructions,
+                record_id=health_record.id,
+                medical_codes_text=medical_codes_list,
+                system_pdf_filename=template.system_pdf_filename,
+                **year_cache_kwargs(health_record, template)
+            )
 
         if report_content:
             # Aktualisieren des Berichts
@@ -1646,22 +2213,24 @@ def create_report(self, data, original_task_id=None):
 
         for template in report_templates:
             # Generiere den Report
-            report_content = generate_report(
-                template_name=template.template_name,
-                output_format=template.output_format,
-                example_structure=template.example_structure,
-                health_record_custom_instructions=health_record.custom_instructions,
-                system_prompt=template.system_prompt,
-                prompt=template.prompt,
-                health_record_text=health_record.text,
-                health_record_token_count=health_record.token_count,
-                health_record_begin=health_record.medical_history_begin,
-                health_record_end=health_record.medical_history_end,
-                use_custom_instructions=template.use_custom_instructions,
-                record_id=health_record_id,
-                medical_codes_text=medical_codes_list,
-                system_pdf_filename=template.system_pdf_filename
-            )
+            with usage.usage_scope(record_id=health_record_id, template_id=template.id):
+                report_content = generate_report(
+                    template_name=template.template_name,
+                    output_format=template.output_format,
+                    example_structure=template.example_structure,
+                    health_record_custom_instructions=health_record.custom_instructions,
+                    system_prompt=template.system_prompt,
+                    prompt=template.prompt,
+                    health_record_text=health_record.text,
+                    health_record_token_count=health_record.token_count,
+                    health_record_begin=health_record.medical_history_begin,
+                    health_record_end=health_record.medical_history_end,
+                    use_custom_instructions=template.use_custom_instructions,
+                    record_id=health_record_id,
+                    medical_codes_text=medical_codes_list,
+                    system_pdf_filename=template.system_pdf_filename,
+                    **year_cache_kwargs(health_record, template)
+                )
 
             # Erstelle einen neuen Report
             report = Report(
@@ -1682,6 +2251,7 @@ def create_report(self, data, original_task_id=None):
         duration = end_time - start_time
         task_monitor = create_task_monitor(health_record_id)
         update_task_monitor(task_monitor.id, start_date=start_time, end_date=end_time, token_count=health_record.token_count)
+        schedule_notifications()
 
         # Setze Status auf "completed" nach erfolgreicher Report-Erstellung
         set_record_processing_status(health_record_id, 'completed')
@@ -1758,22 +2328,24 @@ def generate_single_report(self, record_id, template_id, report_id=None):
          ]
 
         # Generieren des Berichts
-        report_content = generate_report(
-            template_name=template.template_name,
-            output_format=template.output_format,
-            example_structure=template.example_structure,
-            system_prompt=template.system_prompt,
-            prompt=template.prompt,
-            health_record_text=record.text,
-            health_record_token_count=record.token_count,
-            health_record_begin=record.medical_history_begin,
-            health_record_end=record.medical_history_end,
-            health_record_custom_instructions=record.custom_instructions,
-            use_custom_instructions=template.use_custom_instructions,
-            record_id=record_id,
-            medical_codes_text=medical_codes_list,
-            system_pdf_filename=template.system_pdf_filename
-        )    
+        with usage.usage_scope(record_id=record_id, template_id=template_id):
+            report_content = generate_report(
+                template_name=template.template_name,
+                output_format=template.output_format,
+                example_structure=template.example_structure,
+                system_prompt=template.system_prompt,
+                prompt=template.prompt,
+                health_record_text=record.text,
+                health_record_token_count=record.token_count,
+                health_record_begin=record.medical_history_begin,
+                health_record_end=record.medical_history_end,
+                health_record_custom_instructions=record.custom_instructions,
+                use_custom_instructions=template.use_custom_instructions,
+                record_id=record_id,
+                medical_codes_text=medical_codes_list,
+                system_pdf_filename=template.system_pdf_filename,
+                **year_cache_kwargs(record, template)
+            )    
 
         if report_content:
             # Report erfolgreich generiert
@@ -1811,59 +2383,54 @@ def generate_single_report(self, record_id, template_id, report_id=None):
         logger.exception(f"Fehler beim Generieren des Berichts für Record {record_id}, Template {template_id}: {e}")
         return f"Fehler beim Generieren des Berichts: {str(e)}"
 
-@celery.task(bind=True)
+def schedule_notifications():
+    """
+    Plant den Benachrichtigungs-Versand nach einem Abschluss (siehe notifications.py).
+    Alle Abschlüsse innerhalb von NOTIFY_BATCH_SECONDS teilen sich einen Dispatcher-Lauf.
+    """
+    delay = notifications.batch_seconds()
+    try:
+        if not get_redis_client().set(notifications.SCHEDULED_KEY, 1, nx=True, ex=int(delay) + 60):
+            return False
+    except Exception as e:
+        logger.warning(f"Benachrichtigungs-Bündelung nicht möglich, plane direkt: {e}")
+    try:
+        send_notifications_task.apply_async(countdown=delay)
+    except Exception as e:
+        # Der stündliche Beat-Lauf versendet offene Benachrichtigungen nach
+        logger.warning(f"Benachrichtigungs-Versand nicht eingeplant: {e}")
+        return False
+    return True
+
+@celery.task(bind=True, max_retries=10)
 def send_notifications_task(self):
-    with current_app.app_context():
-
-        current_app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
-        current_app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT'))
-        current_app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-        current_app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-        current_app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS') == 'True'
-        current_app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL') == 'True'
-        # Initialisierung von Mail
-        mail = Mail(current_app)
-
-        # Abfrage der TaskMonitors, bei denen end_date gesetzt ist und notification_sent False ist
-        pending_notifications = TaskMonitor.query.filter(
-            TaskMonitor.end_date.isnot(None),
-            TaskMonitor.notification_sent == False
-        ).all()
-
-        for task in pending_notifications:
-            health_record = task.health_record
-            user = health_record.user
-            duration = None
-            if task.start_date and task.end_date:
-                duration_td = task.end_date - task.start_date
-                total_seconds = int(duration_td.total_seconds())
-                hours, remainder = divmod(total_seconds, 3600)
-                minutes, seconds = divmod(remainder, 60)
-                duration = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-
-            subject = f"Verarbeitung abgeschlossen für Datensatz ID {health_record.id}"
-
-            # Rendern der E-Mail-Vorlage
-            html_body = render_template(
-                'e-mails/notification_template.html',
-                user=user,
-                health_record=health_record,
-                duration=duration
-            )
+    """Versendet offene Benachrichtigungen gebündelt; angestoßen bei Abschluss, stündlich vom Beat als Fallback"""
+    redis_client = get_redis_client()
+    lock_owner = self.request.id or uuid.uuid4().hex
+    try:
+        # Abschlüsse ab jetzt planen einen neuen Lauf, dieser liest die offenen Zeilen erst danach
+        redis_client.delete(notifications.SCHEDULED_KEY)
+        locked = redis_client.set(notifications.LOCK_KEY, lock_owner, nx=True, ex=notifications.LOCK_SECONDS)
+    except Exception as e:
+        logger.warning(f"Benachrichtigungs-Lock nicht verfügbar: {e}")
+        redis_client, locked = None, True
+    if not locked:
+        # Ein anderer Worker versendet gerade; danach erneut prüfen
+        raise self.retry(countdown=max(notifications.batch_seconds(), 5))
 
-            # E-Mail erstellen und senden
-            msg = Message(subject=subject, sender=current_app.config['MAIL_USERNAME'], recipients=[user.email])
-            msg.html = html_body
+    try:
+        with current_app.app_context():
+            sent, failed = notifications.dispatch_pending()
+        if sent or failed:
+            logger.info(f"📧 Benachrichtigungen: {sent} gesendet, {failed} fehlgeschlagen")
+        return {'sent': sent, 'failed': failed}
+    finally:
+        if redis_client is not None:
             try:
-                mail.send(msg)
-                print(f"E-Mail an {user.email} gesendet.")
+                if not notifications.release_lock(redis_client, lock_owner):
+                    logger.warning("Benachrichtigungs-Lock war abgelaufen und gehört einem anderen Lauf")
             except Exception as e:
-                print(f"Fehler beim Senden der E-Mail an {user.email}: {e}")
-                continue  # Fährt mit dem nächsten Task fort, ohne notification_sent zu setzen
-
-            # Aktualisieren des notification_sent Feldes
-            task.notification_sent = True
-            db.session.commit()
+                logger.warning(f"Benachrichtigungs-Lock nicht freigegeben: {e}")
 
 @celery.task(bind=True)
 def extract_medical_codes(self, text):
@@ -1873,8 +2440,9 @@ def extract_medical_codes(self, text):
     logger.info("Starting medical code extraction")
     try:
         extractor = CodeExtractor()
-        result = extractor.extract(text)
-        logger.info("Medical code extraction completed")
+        # Kompakte Liste statt XML-String - spart Serialisierung und das erneute Parsen
+        result = extractor.extract_codes(text)
+        logger.info(f"Medical code extraction completed: {len(result)} codes")
         return result
     except Exception as exc:
         logger.exception("Error in medical code extraction")
@@ -1904,21 +2472,29 @@ def save_medical_codes(self, extraction_result, record_id):
         deleted_count = MedicalCode.query.filter_by(health_record_id=record_id).delete()
         logger.info(f"Gelöschte Codes für Record {record_id}: {deleted_count}")
         
-        # Füge die neuen Codes hinzu
-        codes_added = 0
+        # Baue die Zeilen für einen Bulk-Insert auf (kein ORM-Objekt pro Code)
+        created_at = datetime.utcnow()
+        mappings = []
+        seen = set()
         for item in extraction_result:
             try:
-                new_code = MedicalCode(
-                    health_record_id=record_id,
-                    code=item['code'],
-                    code_type=item['type'],
-                    description=None  # Wird später durch API-Abfrage gefüllt
-                )
-                db.session.add(new_code)
-                codes_added += 1
-                logger.info(f"Code {item['code']} ({item['type']}) für Record {record_id} hinzugefügt")
-            except Exception as e:
-                logger.exception(f"Fehler beim Hinzufügen des Codes {item['code']}: {str(e)}")
+                key = (item['code'], item['type'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                mappings.append({
+                    'health_record_id': record_id,
+                    'code': item['code'],
+                    'code_type': item['type'],
+                    'description': None,  # Wird später durch API-Abfrage gefüllt
+                    'created_at': created_at
+                })
+            except (KeyError, TypeError) as e:
+                logger.error(f"Ungültiger Code-Eintrag {item!r}: {str(e)}")
+        
+        if mappings:
+            db.session.bulk_insert_mappings(MedicalCode, mappings)
+        codes_added = len(mappings)
         
         db.session.commit()
         logger.info(f"Erfolgreich {codes_added} neue Codes für Record {record_id} gespeichert")
@@ -1946,8 +2522,7 @@ def process_codes_for_record(record_id, record_text):
         
         # Ergebnis speichern
         if not isinstance(extraction_result, dict) or 'exc_type' not in extraction_result:
-            # Parse XML extraction result into list of dictionaries
-            parsed_result = parse_medical_codes_xml(extraction_result)
+            parsed_result = coerce_medical_codes(extraction_result)
             if parsed_result:
                 save_result = save_medical_codes.apply_async((parsed_result, record_id)).get()
                 logger.info(f"Saved medical codes for record {record_id}: {save_result}")
@@ -1969,6 +2544,27 @@ def process_codes_for_record(record_id, record_text):
         logger.exception(f"Error processing codes for record {record_id}")
         return False
 
+def coerce_medical_codes(extraction_result):
+    """
+    Normalisiert das Ergebnis von extract_medical_codes in eine Liste von Dictionaries
+    
+    Neue Ergebnisse sind bereits Listen; XML-Strings (z.B. von Tasks, die vor dem
+    Update eingereiht wurden) werden weiterhin über parse_medical_codes_xml gelesen.
+    
+    :param extraction_result: Liste von Codes oder XML-String
+    :return: Liste von Dictionaries mit 'code' und 'type' Keys oder None bei ungültigem Input
+    """
+    if isinstance(extraction_result, list):
+        return [
+            {'code': item['code'], 'type': item['type']}
+            for item in extraction_result
+            if isinstance(item, dict) and item.get('code') and item.get('type') in CodeExtractor.CODE_TYPES
+        ]
+    if isinstance(extraction_result, str):
+        return parse_medical_codes_xml(extraction_result)
+    logger.error(f"Unexpected medical code extraction result type: {type(extraction_result)}")
+    return None
+
 def parse_medical_codes_xml(xml_string):
     """
     Parst das XML-Ergebnis der Code-Extraktion in eine Liste von Dictionaries
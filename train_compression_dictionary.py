@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Trainiert ein zstd-Dictionary auf Datensatztexten und Berichten.
+
+Das Extraktions-XML (<extraction method=...><document title=...><page number=...>) und die
+Berichtsstrukturen wiederholen sich über alle Datensätze; ein Dictionary verbessert die
+Kompression gerade kleiner Werte deutlich. Die Stichprobe wird in Blöcke der Größe
+--sample-size zerlegt und daraus das Dictionary trainiert.
+
+Das Dictionary wird unter BLOB_DICTIONARY_DIR/<id>.zdict abgelegt und erst aktiv, wenn
+BLOB_DICTIONARY_ID=<id> gesetzt ist. Anschließend schreibt migrate_encryption.py die
+Bestandsdaten mit dem Dictionary neu. Alte Dictionaries nicht löschen, solange noch Werte
+mit ihrer ID gespeichert sind.
+
+Aufruf:
+    python train_compression_dictionary.py [--records 500] [--dict-size 112640] [--sample-size 16384]
+"""
+import argparse
+import os
+import sys
+
+from app import app, db
+from compression import dictionary_dir, dictionary_path, zstandard
+from models import HealthRecord, Report
+
+
+def collect_samples(max_records, sample_size):
+    """Zerlegt die neuesten Datensatztexte und Berichte in Trainingsblöcke"""
+    samples = []
+    queries = [
+        db.session.query(HealthRecord.text).order_by(HealthRecord.id.desc()).limit(max_records),
+        db.session.query(Report.content).order_by(Report.id.desc()).limit(max_records),
+    ]
+    for query in queries:
+        for (value,) in query:
+            if not value:
+                continue
+            data = value.encode('utf-8')
+            samples.extend(data[offset:offset + sample_size] for offset in range(0, len(data), sample_size))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zstd-Dictionary für EncryptedBlobType trainieren")
+    parser.add_argument('--records', type=int, default=500, help="Anzahl Datensätze und Berichte für die Stichprobe")
+    parser.add_argument('--dict-size', type=int, default=112640, help="Größe des Dictionaries in Bytes")
+    parser.add_argument('--sample-size', type=int, default=16384, help="Größe der Trainingsblöcke in Bytes")
+    args = parser.parse_args()
+
+    if zstandard is None:
+        print("✗ Das Paket zstandard ist nicht installiert (pip install zstandard)")
+        return False
+
+    with app.app_context():
+        samples = collect_samples(args.records, args.sample_size)
+    if len(samples) < 10:
+        print(f"✗ Zu wenig Trainingsdaten ({len(samples)} Blöcke)")
+        return False
+
+    print(f"→ Trainiere Dictionary aus {len(samples)} Blöcken ({sum(map(len, samples)) // 1024} KB)")
+    dictionary = zstandard.train_dictionary(args.dict_size, samples)
+    dict_id = dictionary.dict_id()
+
+    os.makedirs(dictionary_dir(), exist_ok=True)
+    path = dictionary_path(dict_id)
+    with open(path, 'wb') as f:
+        f.write(dictionary.as_bytes())
+
+    plain = sum(map(len, samples))
+    without = sum(len(zstandard.ZstdCompressor(level=9).compress(sample)) for sample in samples)
+    with_dict = sum(len(zstandard.ZstdCompressor(level=9, dict_data=dictionary).compress(sample)) for sample in samples)
+    print(f"✓ Dictionary {dict_id} gespeichert: {path}")
+    print(f"  Kompression ohne Dictionary: {plain / max(1, without):.1f}x, mit Dictionary: {plain / max(1, with_dict):.1f}x")
+    print(f"\nAktivieren mit BLOB_DICTIONARY_ID={dict_id}, danach: python migrate_encryption.py")
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,258 @@
+# usage.py
+"""
+Token- und Kostenbuchhaltung pro Datensatz.
+
+Jeder erfolgreiche Provider-Aufruf (metrics.provider_request) wird mit Prompt-, Cache- und
+Completion-Tokens sowie der Latenz gebucht, zugeordnet zu
+    (Datensatz, Stufe, Template, Jahr, Provider, Modell).
+Datensatz, Template und Jahr kommen aus dem aktuellen Kontext (contextvars):
+    - tasks.py bindet den Datensatz beim Start eines Tasks (Argument record_id bzw. data['record_id']
+      oder der Header usage_record_id, den jeder aus einem Task heraus publizierte Task erbt),
+    - generate_report setzt Template und Jahr über usage_scope().
+Threads und Executor übernehmen den Kontext nur über carry_context().
+
+Die Buchungen werden pro Prozess gepuffert, je Schlüssel aufsummiert und gebündelt in
+UsageLedger geschrieben: sobald USAGE_FLUSH_CALLS Aufrufe gepuffert sind oder der älteste
+länger als USAGE_FLUSH_SECONDS wartet (geprüft bei jeder Buchung und nach jedem Task), sowie
+beim Beenden des Prozesses.
+
+Kosten werden erst bei der Auswertung aus USAGE_PRICES berechnet (USD pro 1 Mio. Tokens:
+Eingabe, Eingabe aus dem Cache, Ausgabe), Preisänderungen wirken damit auch rückwirkend.
+"""
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import func
+
+from config import get_config
+
+logger = logging.getLogger(__name__)
+
+# Listenpreise in USD pro 1 Mio. Tokens (Eingabe, Eingabe aus Cache, Ausgabe); längster Präfix gewinnt
+DEFAULT_PRICES = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-5-mini': (0.25, 0.025, 2.00),
+    'gpt-5': (1.25, 0.125, 10.00),
+    'gemini-2.5-pro': (1.25, 0.31, 10.00),
+    'gemini-2.5-flash': (0.30, 0.075, 2.50),
+    'gemini-2.0-flash': (0.10, 0.025, 0.40),
+}
+
+_context = contextvars.ContextVar('usage_context', default={})
+_buffer = {}
+_buffer_calls = 0
+_buffer_since = None
+_lock = threading.Lock()
+
+
+# --- Kontext ---
+
+@contextmanager
+def usage_scope(**fields):
+    """Ergänzt den Kontext (record_id, template_id, year, stage) für alle Aufrufe im Block"""
+    token = _context.set({**_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_record(record_id):
+    """Bindet einen Datensatz an den laufenden Task; liefert das Token für release()"""
+    return _context.set({'record_id': int(record_id)} if record_id else {})
+
+
+def release(token):
+    _context.reset(token)
+
+
+def current_record_id():
+    return _context.get().get('record_id')
+
+
+def carry_context(func_):
+    """
+    Bindet func_ an eine Kopie des aktuellen Kontexts, für threading.Thread und Executor.
+    Jeder Aufruf liefert einen eigenen Kontext, also pro Thread bzw. submit() einmal aufrufen.
+    """
+    return functools.partial(contextvars.copy_context().run, func_)
+
+
+# --- Buchung ---
+
+def token_counts(response):
+    """(Prompt, davon aus Cache, Completion) einer OpenAI- oder Gemini-Antwort, sonst None"""
+    usage = getattr(response, 'usage', None)
+    if usage is not None and hasattr(usage, 'prompt_tokens'):
+        details = getattr(usage, 'prompt_tokens_details', None)
+        return (usage.prompt_tokens or 0, getattr(details, 'cached_tokens', None) or 0,
+                getattr(usage, 'completion_tokens', None) or 0)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        return (getattr(usage, 'prompt_token_count', None) or 0,
+                getattr(usage, 'cached_content_token_count', None) or 0,
+                getattr(usage, 'candidates_token_count', None) or 0)
+    return None
+
+
+def model_name(response, model=None):
+    name = model or getattr(response, 'model', None) or getattr(response, 'model_version', None)
+    return name.split('/', 1)[-1] if isinstance(name, str) else None
+
+
+def flush_calls():
+    return int(get_config("USAGE_FLUSH_CALLS", "50"))
+
+
+def flush_seconds():
+    return float(get_config("USAGE_FLUSH_SECONDS", "30"))
+
+
+def record_call(provider, operation, model, tokens, latency_seconds):
+    """Bucht einen erfolgreichen Provider-Aufruf in den Puffer dieses Prozesses"""
+    global _buffer_calls, _buffer_since
+    context = _context.get()
+    key = (context.get('record_id'), context.get('stage') or operation, context.get('template_id'),
+           context.get('year'), provider, model)
+    prompt, cached, completion = tokens or (0, 0, 0)
+    with _lock:
+        entry = _buffer.setdefault(key, [0, 0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += prompt
+        entry[2] += cached
+        entry[3] += completion
+        entry[4] += latency_seconds
+        _buffer_calls += 1
+        _buffer_since = _buffer_since or time.monotonic()
+    flush_if_due()
+
+
+def flush_if_due():
+    with _lock:
+        due = _buffer_calls and (_buffer_calls >= flush_calls() or time.monotonic() - _buffer_since >= flush_seconds())
+    if due:
+        flush()
+
+
+def flush():
+    """Schreibt den Puffer als eine Zeile pro Schlüssel; Fehler dürfen keinen Task abbrechen"""
+    global _buffer, _buffer_calls, _buffer_since
+    with _lock:
+        pending, _buffer, _buffer_calls, _buffer_since = _buffer, {}, 0, None
+    if not pending:
+        return 0
+    rows = [{
+        'health_record_id': record_id, 'stage': stage, 'report_template_id': template_id, 'year': year,
+        'provider': provider, 'model': model, 'calls': calls, 'prompt_tokens': prompt,
+        'cached_tokens': cached, 'completion_tokens': completion, 'latency_seconds': latency,
+    } for (record_id, stage, template_id, year, provider, model), (calls, prompt, cached, completion, latency)
+        in pending.items()]
+    try:
+        from app import app
+        from models import db, UsageLedger
+        with app.app_context():
+            db.session.execute(UsageLedger.__table__.insert(), rows)
+            db.session.commit()
+    except Exception as e:
+        logger.warning(f"Token-Verbrauch ({len(rows)} Zeilen) nicht gespeichert: {e}")
+        return 0
+    return len(rows)
+
+
+atexit.register(flush)
+
+
+# --- Auswertung ---
+
+def prices():
+    configured = get_config("USAGE_PRICES", "")
+    if not configured:
+        return DEFAULT_PRICES
+    try:
+        return {**DEFAULT_PRICES, **{model: tuple(values) for model, values in json.loads(configured).items()}}
+    except (ValueError, TypeError) as e:
+        logger.warning(f"USAGE_PRICES ungültig, verwende Listenpreise: {e}")
+        return DEFAULT_PRICES
+
+
+def cost_usd(model, prompt_tokens, cached_tokens, completion_tokens, price_table=None):
+    """Kosten in USD oder None für Modelle ohne Preis"""
+    price_table = price_table or prices()
+    matches = [name for name in price_table if model and model.startswith(name)]
+    if not matches:
+        return None
+    input_price, cached_price, output_price = price_table[max(matches, key=len)]
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1_000_000
+
+
+def _aggregate(group_columns, *filters):
+    from models import UsageLedger
+    columns = [getattr(UsageLedger, name) for name in group_columns]
+    query = UsageLedger.query.with_entities(
+        *columns, UsageLedger.model,
+        func.sum(UsageLedger.calls), func.sum(UsageLedger.prompt_tokens), func.sum(UsageLedger.cached_tokens),
+        func.sum(UsageLedger.completion_tokens), func.sum(UsageLedger.latency_seconds),
+    ).filter(*filters).group_by(*columns, UsageLedger.model)
+
+    # Kosten pro Modell berechnen, danach über die Modelle einer Gruppe summieren
+    price_table = prices()
+    groups = {}
+    for row in query:
+        key, model = tuple(row[:len(columns)]), row[len(columns)]
+        calls, prompt, cached, completion, latency = (value or 0 for value in row[len(columns) + 1:])
+        group = groups.setdefault(key, {
+            **dict(zip(group_columns, key)), 'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+            'completion_tokens': 0, 'latency_seconds': 0.0, 'cost_usd': 0.0, 'unpriced_calls': 0,
+        })
+        group['calls'] += calls
+        group['prompt_tokens'] += prompt
+        group['cached_tokens'] += cached
+        group['completion_tokens'] += completion
+        group['latency_seconds'] += latency
+        cost = cost_usd(model, prompt, cached, completion, price_table)
+        if cost is not None:
+            group['cost_usd'] += cost
+        elif prompt or completion:  # Aufrufe ohne Tokens (Azure Vision) haben keinen Token-Preis
+            group['unpriced_calls'] += calls
+    return sorted(groups.values(), key=lambda group: (group['cost_usd'], group['latency_seconds']), reverse=True)
+
+
+def _with_template_names(groups):
+    from models import ReportTemplate
+    names = dict(ReportTemplate.query.with_entities(ReportTemplate.id, ReportTemplate.template_name))
+    for group in groups:
+        template_id = group.get('report_template_id')
+        group['template_name'] = names.get(template_id, f"Template {template_id}") if template_id else None
+    return groups
+
+
+def _totals(groups):
+    return {key: sum(group[key] for group in groups)
+            for key in ('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'latency_seconds', 'cost_usd')}
+
+
+def record_usage(record_id):
+    """Verbrauch eines Datensatzes, aufgeschlüsselt nach Stufe, Template, Jahr und Provider"""
+    from models import UsageLedger
+    rows = _with_template_names(_aggregate(['stage', 'report_template_id', 'year', 'provider'],
+                                           UsageLedger.health_record_id == record_id))
+    return {'total': _totals(rows), 'rows': rows}
+
+
+def usage_summary(since):
+    """Verbrauch seit since für die KPI-Seite: nach Stufe/Provider und nach Template"""
+    from models import UsageLedger
+    stages = _aggregate(['stage', 'provider'], UsageLedger.created_at >= since)
+    templates = _with_template_names(_aggregate(['report_template_id'], UsageLedger.created_at >= since,
+                                                UsageLedger.report_template_id.isnot(None)))
+    return {'total': _totals(stages), 'stages': stages, 'templates': templates}
@@ -1,11 +1,9 @@
 # utils.py
-import tiktoken
 import re
 import os
 import time
 import json
-from extractors import openai_client
-import google.generativeai as genai
+from collections import Counter
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 from datetime import datetime
 from models import db, TaskMonitor
@@ -13,18 +11,11 @@ import requests
 from requests.auth import HTTPBasicAuth
 import logging
 from config import get_config
+from metrics import provider_request
+from providers import get_gemini_model, get_openai_client, get_openai_model, get_tiktoken_encoding, get_token_threshold, EXTRACTION_OPENAI_MAX_RETRIES
 
 logger = logging.getLogger(__name__)
 
-# Verwende get_config() statt os.environ für Azure Key Vault Integration
-openai_model = get_config("OPENAI_MODEL")
-token_threshold = int(get_config("TOKEN_THRESHOLD", "100000"))
-gemini_model_name = get_config("GEMINI_MODEL")  # Kein Fallback - muss im Key Vault sein
-genai.configure(api_key=get_config("GEMINI_API_KEY"))
-gemini_model = genai.GenerativeModel(gemini_model_name)
-logger.info(f"📊 utils.py - TOKEN_THRESHOLD aus Key Vault geladen: {token_threshold}")
-logger.info(f"📊 utils.py - GEMINI_MODEL aus Key Vault geladen: {gemini_model_name}")
-
 
 def count_tokens(text):
     """
@@ -33,8 +24,27 @@ def count_tokens(text):
     :param text: Der zu zählende Text
     :return: Anzahl der Tokens
     """
-    encoding = tiktoken.encoding_for_model("gpt-4")
-    return len(encoding.encode(text))
+    return len(get_tiktoken_encoding().encode(text))
+
+# Muster für vollständige Datumsangaben - deutlich verlässlicher als alleinstehende Jahreszahlen
+GERMAN_MONTHS = r"(?:Januar|Jänner|Februar|März|Maerz|April|Mai|Juni|Juli|August|September|Oktober|November|Dezember)"
+DATE_PATTERNS = [
+    re.compile(r'\b(?:0?[1-9]|[12]\d|3[01])\.(?:0?[1-9]|1[0-2])\.((?:19|20)\d{2})\b'),  # 31.12.2019
+    re.compile(r'\b((?:19|20)\d{2})-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01])\b'),          # 2019-12-31
+    re.compile(r'\b(?:0?[1-9]|1[0-2])/((?:19|20)\d{2})\b'),                                  # 12/2019
+    re.compile(r'\b' + GERMAN_MONTHS + r'\s+((?:19|20)\d{2})\b', re.IGNORECASE),              # Dezember 2019
+]
+BIRTH_DATE_CONTEXT = re.compile(r'(geb\.|geboren|Geburtsdatum|Geb\.-Datum)', re.IGNORECASE)
+YEAR_PATTERN = re.compile(r'\b((?:19|20)\d{2})\b')
+PAGE_PATTERN = re.compile(r'<page number="\d+">(.*?)</page>', re.DOTALL)
+
+# Schwellwerte für die regelbasierte Stufe von find_patient_info (werden beim Aufruf gelesen)
+def patient_info_min_dated_mentions():
+    return int(get_config("PATIENT_INFO_MIN_DATED_MENTIONS", "3"))
+
+def patient_info_sample_tokens():
+    return int(get_config("PATIENT_INFO_SAMPLE_TOKENS", "8000"))
+
 
 def extract_years(text):
     """
@@ -43,16 +53,153 @@ def extract_years(text):
     :param text: Der zu durchsuchende Text
     :return: Tuple mit (niedrigste_jahreszahl, höchste_jahreszahl) oder (None, None) wenn keine Jahreszahlen gefunden wurden
     """
-    years = re.findall(r'\b(19|20)\d{2}\b', text)
-    if years:
-        years = [int(year) for year in years]
-        return min(years), max(years)
-    return None, None
+    stats = extract_year_statistics(text)
+    return stats['start_year'], stats['end_year']
+
+
+def extract_year_statistics(text, birth_date=None):
+    """
+    Sammelt Jahreszahl-Statistiken aus einem Text.
+
+    Vollständige Datumsangaben (z.B. 31.12.2019) zählen als belastbare Belege, alleinstehende
+    Jahreszahlen nur als Fallback. Das Geburtsdatum und Jahre vor dem Geburtsjahr werden ignoriert.
+
+    :param text: Der zu durchsuchende Text
+    :param birth_date: Optionales Geburtsdatum (datetime) des Patienten
+    :return: Dictionary mit start_year, end_year, dated_mentions, dated_years und bare_years
+    """
+    current_year = datetime.now().year
+    min_year = birth_date.year if birth_date else 1900
+    birth_date_strings = set()
+    if birth_date:
+        birth_date_strings = {
+            birth_date.strftime('%d.%m.%Y'),
+            f"{birth_date.day}.{birth_date.month}.{birth_date.year}",
+            birth_date.strftime('%Y-%m-%d'),
+        }
+
+    dated_years = Counter()
+    bare_years = Counter()
+    if text:
+        for pattern in DATE_PATTERNS:
+            for match in pattern.finditer(text):
+                if match.group(0) in birth_date_strings or BIRTH_DATE_CONTEXT.search(text, max(0, match.start() - 20), match.start()):
+                    continue
+                year = int(match.group(1))
+                if min_year <= year <= current_year + 1:
+                    dated_years[year] += 1
+        for match in YEAR_PATTERN.finditer(text):
+            year = int(match.group(1))
+            if min_year <= year <= current_year + 1:
+                bare_years[year] += 1
+
+    years = dated_years or bare_years
+    return {
+        'start_year': min(years) if years else None,
+        'end_year': max(years) if years else None,
+        'dated_mentions': sum(dated_years.values()),
+        'dated_years': dated_years,
+        'bare_years': bare_years,
+    }
+
+
+def match_patient_name(text, patient_name):
+    """
+    Prüft, ob alle Namensbestandteile des bekannten Patientennamens im Text vorkommen.
 
+    :param text: Der zu durchsuchende Text
+    :param patient_name: Der bekannte Name (z.B. aus dem Upload-Formular)
+    :return: True wenn alle Bestandteile gefunden wurden
+    """
+    if not text or not patient_name:
+        return False
+    parts = [part for part in re.split(r'[\s,]+', patient_name.strip()) if len(part) > 1]
+    if not parts:
+        return False
+    return all(re.search(r'\b' + re.escape(part) + r'\b', text, re.IGNORECASE) for part in parts)
 
 
+def sample_record_pages(input_text, max_tokens=None):
+    """
+    Wählt eine kleine, repräsentative Seitenauswahl aus einem Datensatz.
 
-def find_patient_info(input_text, token_count):
+    Bevorzugt werden erste und letzte Seite sowie Seiten mit Datumsangaben, gleichmäßig
+    über den Datensatz verteilt, bis das Token-Budget (geschätzt über 4 Zeichen/Token) erreicht ist.
+
+    :param input_text: Der vollständige Datensatz-Text (Extraktions-XML)
+    :param max_tokens: Token-Budget der Stichprobe
+    :return: Der Stichproben-Text
+    """
+    max_chars = (max_tokens or patient_info_sample_tokens()) * 4
+    pages = [page.strip() for page in PAGE_PATTERN.findall(input_text or '') if page and page.strip()]
+    if not pages:
+        # Kein Seiten-Markup: in gleich große Abschnitte teilen
+        chunk_size = 4000
+        pages = [input_text[i:i + chunk_size] for i in range(0, len(input_text or ''), chunk_size)]
+    if not pages:
+        return ''
+
+    dated = [i for i, page in enumerate(pages) if any(p.search(page) for p in DATE_PATTERNS)]
+    candidates = [0, len(pages) - 1]
+    if dated:
+        step = max(1, len(dated) // 20)
+        candidates += [dated[0], dated[-1]] + dated[::step]
+
+    selected = []
+    used_chars = 0
+    for index in dict.fromkeys(candidates):
+        page = pages[index][:max_chars // 4]
+        if used_chars + len(page) > max_chars:
+            break
+        selected.append((index, page))
+        used_chars += len(page)
+
+    return "\n\n".join(page for _, page in sorted(selected))
+
+
+def find_patient_info(input_text, token_count, known_patient_name=None, birth_date=None):
+    """
+    Findet Start- und Endjahr der Behandlungen sowie den Patientennamen - gestuft und ohne Volltext-LLM-Aufruf.
+
+    Stufe 1 wertet Datumsangaben per Regex aus und gleicht den bekannten Namen ab. Nur wenn dabei
+    zu wenige belastbare Datumsangaben gefunden werden, geht eine kleine Seiten-Stichprobe an das LLM.
+
+    :param input_text: Der zu durchsuchende Text
+    :param token_count: Anzahl der Tokens im Input (nur für das Logging)
+    :param known_patient_name: Bereits bekannter Patientenname (z.B. aus dem Upload-Formular)
+    :param birth_date: Optionales Geburtsdatum, um es aus der Jahresstatistik auszuschließen
+    :return: Tuple mit (start_year, end_year, patient_name) oder (aktuelle Jahreszahl, aktuelle Jahreszahl, None) wenn keine Informationen gefunden wurden
+    """
+    current_year = datetime.now().year
+    stats = extract_year_statistics(input_text, birth_date)
+    name_matched = match_patient_name(input_text, known_patient_name)
+    logger.info(f"🔍 find_patient_info Stufe 1: {stats['dated_mentions']} Datumsangaben, "
+                f"Jahre {stats['start_year']}-{stats['end_year']}, Name gefunden: {name_matched} (Token count: {token_count})")
+
+    patient_name = known_patient_name.strip() if known_patient_name and known_patient_name.strip() else None
+    if stats['dated_mentions'] >= patient_info_min_dated_mentions() and (name_matched or not patient_name):
+        logger.info(f"✅ find_patient_info ohne LLM: start_year={stats['start_year']}, end_year={stats['end_year']}, patient={patient_name}")
+        return stats['start_year'], stats['end_year'], patient_name
+
+    # Stufe 2: geringe Konfidenz - nur eine Stichprobe an das LLM senden
+    sample_text = sample_record_pages(input_text)
+    sample_token_count = count_tokens(sample_text)
+    logger.info(f"🔍 find_patient_info Stufe 2: Stichprobe mit {sample_token_count} Tokens statt {token_count}")
+    start_year, end_year, llm_patient_name = find_patient_info_llm(sample_text, sample_token_count)
+
+    llm_failed = start_year == current_year and end_year == current_year and llm_patient_name is None
+    if llm_failed and stats['start_year']:
+        logger.warning("⚠️ LLM-Stichprobe ohne Ergebnis - verwende Regex-Statistik")
+        start_year, end_year = stats['start_year'], stats['end_year']
+    elif stats['dated_years']:
+        # Belastbare Datumsangaben aus dem Volltext erweitern den Zeitraum der Stichprobe
+        start_year = min(start_year, stats['start_year'])
+        end_year = max(end_year, stats['end_year'])
+
+    return start_year, end_year, patient_name or llm_patient_name
+
+
+def find_patient_info_llm(input_text, token_count):
     """
     Findet die Start- und Endjahre der Behandlungen sowie den Namen des Patienten im Text mittels GPT-4 oder Gemini.
 
@@ -62,13 +209,14 @@ def find_patient_info(input_text, token_count):
     """
     current_year = datetime.now().year
     logger.info("="*80)
-    logger.info(f"🔍 STARTING find_patient_info")
+    logger.info(f"🔍 STARTING find_patient_info_llm")
     logger.info(f"Input text length: {len(input_text) if input_text else 0} chars")
     logger.info(f"Input text preview: {input_text[:200] if input_text else 'EMPTY'}...")
     logger.info(f"Token count: {token_count}")
     
     try:
         # Verwende den TOKEN_THRESHOLD aus dem Key Vault
+        token_threshold = get_token_threshold()
         use_gpt4 = token_count <= token_threshold
         model_used = "GPT-4" if use_gpt4 else "Google Gemini"
         logger.info(f"📊 Token count = {token_count}, Threshold = {token_threshold}")
@@ -76,18 +224,19 @@ def find_patient_info(input_text, token_count):
         
         if use_gpt4:
             # GPT-4 wird verwendet
-            response = openai_client.chat.completions.create(
-                model=openai_model,  # Stellen Sie sicher, dass Sie das korrekte Modell verwenden
-                messages=[
-                    {"role": "system",
-                     "content": "You are a helpful AI assistant specialized in the extraction of unstructured patient medical data. Your result is a valid JSON object."},
-                    {"role": "user",
-                     "content": f"Take a deep breath now! Concentrate! Find me across the whole medical history and all files the earliest year (start_year) and the latest year (end_year) of treatments, as well as the patient's name in this input. Give it back as a JSON object: {input_text}. It can be that start_year equals end_year because the medical history is just one year long. If you can't find a specific piece of information, use null for that field."},
-                ],
-                max_completion_tokens=500,
-                temperature=0.1,
-                response_format={"type": "json_object"}
-            )
+            with provider_request('openai', 'patient_info') as call:
+                response = call.usage(get_openai_client(max_retries=EXTRACTION_OPENAI_MAX_RETRIES).chat.completions.create(
+                    model=get_openai_model(),  # Stellen Sie sicher, dass Sie das korrekte Modell verwenden
+                    messages=[
+                        {"role": "system",
+                         "content": "You are a helpful AI assistant specialized in the extraction of unstructured patient medical data. Your result is a valid JSON object."},
+                        {"role": "user",
+                         "content": f"Take a deep breath now! Concentrate! Find me across the whole medical history and all files the earliest year (start_year) and the latest year (end_year) of treatments, as well as the patient's name in this input. Give it back as a JSON object: {input_text}. It can be that start_year equals end_year because the medical history is just one year long. If you can't find a specific piece of information, use null for that field."},
+                    ],
+                    max_completion_tokens=500,
+                    temperature=0.1,
+                    response_format={"type": "json_object"}
+                ))
             response_content = response.choices[0].message.content
         else:
             example_response = {
@@ -109,23 +258,16 @@ Medical text:
 {input_text}
 """
             
-            # Safety Settings für medizinische Daten
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-            
-            response = gemini_model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=8192,  # Erhöht, um genug Platz zu haben
-                    temperature=0.0,  # Deterministisch für konsistente Ergebnisse
-                    response_mime_type="application/json"
-                ),
-                safety_settings=safety_settings
+            # Wiederverwendbare Modell-Instanz mit Safety Settings für medizinische Daten
+            patient_info_model = get_gemini_model(
+                generation_config={
+                    "max_output_tokens": 8192,  # Erhöht, um genug Platz zu haben
+                    "temperature": 0.0,  # Deterministisch für konsistente Ergebnisse
+                    "response_mime_type": "application/json"
+                }
             )
+            with provider_request('gemini', 'patient_info') as call:
+                response = call.usage(patient_info_model.generate_content(prompt), patient_info_model.model_name)
             
             # Prüfe auf Probleme BEVOR wir response.text aufrufen
             if not response.candidates or not response.candidates[0].content.parts:
@@ -282,11 +424,14 @@ def update_task_monitor(task_monitor_id, start_date=None, end_date=None, token_c
 def mark_notification_sent(task_monitor_id):
     return update_task_monitor(task_monitor_id, notification_sent=True)
 
+ICD_TOKEN_ENDPOINT = "https://icdaccessmanagement.who.int/connect/token"
+ICD_API_BASE = "https://id.who.int"
+
 def get_icd_access_token():
     """
     Holt einen Access Token von der WHO ICD API
     """
-    token_endpoint = "https://icdaccessmanagement.who.int/connect/token"
+    token_endpoint = get_config("ICD_TOKEN_ENDPOINT", ICD_TOKEN_ENDPOINT)
     client_id = get_config("ICD_API_CLIENT_ID", os.getenv("ICD_API_CLIENT_ID"))
     client_secret = get_config("ICD_API_CLIENT_SECRET", os.getenv("ICD_API_CLIENT_SECRET"))
     scope = "icdapi_access"
@@ -319,7 +464,7 @@ def get_icd10_description(code):
     if not token:
         return None
     
-    api_url = f"https://id.who.int/icd/release/10/2016/{code}"
+    api_url = f"{get_config('ICD_API_BASE', ICD_API_BASE)}/icd/release/10/2016/{code}"
     headers = {
         "Authorization": f"Bearer {token}",
         "Accept": "application/json",
@@ -357,7 +502,7 @@ def get_icd11_description(code):
     if not token:
         return None
     
-    api_url = f"https://id.who.int/icd/release/11/2025-01/mms/describe"
+    api_url = f"{get_config('ICD_API_BASE', ICD_API_BASE)}/icd/release/11/2025-01/mms/describe"
     params = {
         'code': code,
         'simplify': 'false',